@@ -17,7 +17,9 @@ async def allergy_check(request: AllergyCheckRequest):
     drug_code = request.drug_code
     allergy = request.allergy
 
-    return StreamingResponse(heliot.dss_check(drug_code, allergy), media_type='text/event-stream')
+    # Reject the request with 503 if the service pools are saturated
+    heliot.executors.check_capacity()
+    return StreamingResponse(heliot.adss_check(drug_code, allergy, request.bypass_cache), media_type='text/event-stream')
 
 
 @router.post("/allergy_check_enhanced")
@@ -27,4 +29,40 @@ async def allergy_check(request: AllergyCheckEnhancedRequest):
     clinical_notes = request.clinical_notes
     store = request.store
 
-    return StreamingResponse(heliot.dss_check_enhanced(patient_id, drug_code, clinical_notes, store), media_type='text/event-stream')
\ No newline at end of file
+    heliot.executors.check_capacity()
+    return StreamingResponse(heliot.adss_check_enhanced(patient_id, drug_code, clinical_notes, store, request.bypass_cache), media_type='text/event-stream')
+
+
+@router.post("/allergy_check_batch")
+async def allergy_check_batch(request: AllergyCheckBatchRequest):
+    items = [{"patient_id": item.patient_id, "drug_code": item.drug_code, "clinical_notes": item.clinical_notes, "store": item.store}
+             for item in request.items]
+
+    heliot.executors.check_capacity()
+    # One JSON object per line, in completion order: the index field refers to the position of the item in the request
+    return StreamingResponse(heliot.adss_check_batch(items, request.concurrency, request.bypass_cache), media_type='application/x-ndjson')
+
+
+@router.get("/drug_cache_stats")
+async def drug_cache_stats():
+    return heliot.drug_cache_stats()
+
+
+@router.get("/executor_stats")
+async def executor_stats():
+    return heliot.executor_stats()
+
+
+@router.get("/translation_cache_stats")
+async def translation_cache_stats():
+    return heliot.translation_cache_stats()
+
+
+@router.get("/response_cache_stats")
+async def response_cache_stats():
+    return heliot.response_cache_stats()
+
+
+@router.get("/write_behind_stats")
+async def write_behind_stats():
+    return heliot.write_behind_stats()
@@ -1,8 +1,17 @@
-from fastapi import FastAPI
-from .heliot_endpoints import router as api_router
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from .heliot_endpoints import router as api_router, heliot
+from .services.executors import ExecutorSaturated
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+# Write the notes still in the write-behind queue before the server exits
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    heliot.close()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000"
@@ -18,6 +27,11 @@ app.add_middleware(
 
 app.include_router(api_router, prefix="/api")
 
+# Back-pressure: the service pools are full, the client should retry later
+@app.exception_handler(ExecutorSaturated)
+async def executor_saturated_handler(request: Request, exc: ExecutorSaturated):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,12 +1,28 @@
 from pydantic import BaseModel
+from typing import List
 
 class AllergyCheckRequest(BaseModel):
     drug_code: str
     allergy: str
+    bypass_cache: bool = False
 
 
 class AllergyCheckEnhancedRequest(BaseModel):
     patient_id: str 
     drug_code: str 
     clinical_notes: str
-    store: bool = False
\ No newline at end of file
+    store: bool = False
+    bypass_cache: bool = False
+
+
+class AllergyCheckBatchItem(BaseModel):
+    patient_id: str
+    drug_code: str
+    clinical_notes: str
+    store: bool = False
+
+
+class AllergyCheckBatchRequest(BaseModel):
+    items: List[AllergyCheckBatchItem]
+    concurrency: int = 8
+    bypass_cache: bool = False
@@ -0,0 +1,114 @@
+import re
+import time
+from typing import Dict, List
+
+from ...ingredient_matcher import allergy_mentions, unresolved_allergy_spans
+from .response_cache import context_cues, reaction_types
+
+# Status of an allergen in the patient profile
+ALLERGY = "allergy"
+INTOLERANCE = "intolerance"
+TOLERATED = "tolerated"
+
+# Lines of the compact profile, written like the clinical notes so that the cues of the rule engine and of the cache still apply
+STATUS_LINES = {
+    ALLERGY: "allergia a {allergen}",
+    INTOLERANCE: "intolleranza a {allergen}",
+    TOLERATED: "tollera {allergen}",
+}
+
+# Label of each reaction type of response_cache.REACTION_TYPES, matched again by reaction_types when the profile is read
+REACTION_LABELS = {
+    "anaphylaxis": "anaphylaxis",
+    "angioedema": "angioedema",
+    "urticaria": "urticaria",
+    "rash": "rash",
+    "pruritus": "pruritus",
+    "bronchospasm": "bronchospasm",
+    "severe_cutaneous": "stevens-johnson / necrolysis",
+    "gastrointestinal": "nausea / vomiting / diarrhea",
+}
+
+_SENTENCE_RE = re.compile(r"[^.;\n]+")
+# Words after which an unresolved allergen goes on with the clinical details, e.g. "cefalosporine con orticaria"
+_DETAILS_RE = re.compile(r"\s+(?:con|dopo|durante|in|nel|nella|with|after)\b.*", re.IGNORECASE | re.DOTALL)
+# Tolerance and negation apply to their clause only, e.g. "allergia alla penicillina, tollera le cefalosporine"
+_CLAUSE_RE = re.compile(r"[^.;\n,:]+")
+
+def extract_allergen_profile(ont, text: str) -> List[Dict]:
+    """
+    Extract the allergen profile from the clinical notes: the allergens, intolerances and tolerated substances of the patient, with the reactions described.
+
+    Parameters:
+    - ont: the SynonymManager used to find the ingredients in the notes.
+    - text: the clinical notes, with the ingredients already replaced by their standard names.
+
+    Returns:
+    - A list of {"allergen", "status", "reactions"}, one per allergen, the last mention in the notes deciding the status.
+    """
+    if not text:
+        return []
+    matches = ont.find_ingredients(text)
+    mentions = set(allergy_mentions(text, matches))
+    unresolved = unresolved_allergy_spans(text, matches)
+
+    tolerated, negated = [], []
+    for clause in _CLAUSE_RE.finditer(text):
+        cues = set(context_cues(clause.group()))
+        if cues & {"tolerated", "desensitized"}:
+            tolerated.append(clause.span())
+        elif "negated" in cues:
+            negated.append(clause.span())
+
+    def inside(spans, start, end):
+        return any(s <= start and end <= e for s, e in spans)
+
+    profile = {}
+    for sentence in _SENTENCE_RE.finditer(text):
+        start, end = sentence.span()
+        reactions = reaction_types(sentence.group())
+        intolerance = "intolerance" in context_cues(sentence.group())
+
+        found = []
+        for m in matches:
+            if not (start <= m.start and m.end <= end):
+                continue
+            if inside(tolerated, m.start, m.end):
+                found.append((m.start, m.value, TOLERATED))
+            elif m in mentions and not inside(negated, m.start, m.end):
+                found.append((m.start, m.value, INTOLERANCE if intolerance else ALLERGY))
+        # Allergens missing from the dictionary, e.g. drug classes, are kept as written
+        for s, e in unresolved:
+            if start <= s and e <= end and not inside(negated, s, e) and not inside(tolerated, s, e):
+                found.append((s, _DETAILS_RE.sub("", text[s:e]).strip(), INTOLERANCE if intolerance else ALLERGY))
+
+        for _, allergen, status in sorted(found, key=lambda f: f[0]):
+            key = allergen.casefold()
+            if not key:
+                continue
+            entry = profile.setdefault(key, {"allergen": key, "status": status, "reactions": []})
+            entry["status"] = status
+            if status != TOLERATED:
+                entry["reactions"] = list(dict.fromkeys(entry["reactions"] + reactions))
+    return list(profile.values())
+
+def format_allergen_profile(entries: List[Dict]) -> str:
+    """
+    Format the allergen profile of a patient as compact notes, one line per allergen, e.g. "allergia a amoxicillin (anaphylaxis), 2024-05-02".
+
+    Parameters:
+    - entries: the profile records, with allergen, status, reactions and last_seen (ms).
+
+    Returns:
+    - The formatted profile, empty if there are no entries.
+    """
+    lines = []
+    for entry in entries:
+        line = STATUS_LINES.get(entry["status"], STATUS_LINES[ALLERGY]).format(allergen=entry["allergen"])
+        reactions = [REACTION_LABELS.get(r, r) for r in entry.get("reactions") or []]
+        if reactions:
+            line += f" ({'; '.join(reactions)})"
+        if entry.get("last_seen"):
+            line += ", " + time.strftime("%Y-%m-%d", time.gmtime(int(entry["last_seen"]) / 1000))
+        lines.append(line)
+    return "\n".join(lines)
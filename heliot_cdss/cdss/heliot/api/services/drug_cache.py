@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+# Copy the record and its lists, so that callers cannot alter the cached one
+def _copy_record(record: Dict) -> Dict:
+    return {k: list(v) if isinstance(v, list) else v for k, v in record.items()}
+
+# Bounded LRU cache of the assembled drug records, with a time to live.
+# The whole cache is invalidated as soon as the drugs database has a new fragment
+class DrugRecordCache:
+    def __init__(self, version_fn: Callable[[], int], max_size: int = 1024, ttl: float = 3600, check_interval: float = 5.0):
+        """
+        Initialize the cache.
+
+        Parameters:
+        - version_fn: function returning the timestamp of the last fragment of the drugs database.
+        - max_size: maximum number of drug records kept in memory.
+        - ttl: seconds after which a record is considered expired.
+        - check_interval: minimum number of seconds between two checks of the database version.
+        """
+        self.version_fn = version_fn
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self._last_check = 0.0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        """
+        Clear the cache if the database changed since the last check. The check is done at most every check_interval seconds.
+        """
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            version = self.version_fn()
+        except Exception as e:
+            print(f"Unable to read the drugs database version: {e}")
+            return
+        if version != self._version:
+            if self._version is not None:
+                self.invalidations += 1
+                print("Drugs database changed, clearing the drug cache")
+            self._records.clear()
+            self._version = version
+
+    def version(self):
+        """
+        Return the version of the drugs database the cached records belong to.
+        """
+        with self._lock:
+            self._check_version()
+            return self._version
+
+    def get(self, key, fallback_key=None) -> Optional[Dict]:
+        """
+        Look for a drug record in the cache.
+
+        Parameters:
+        - key: key of the record, the drug code and the attributes projection.
+        - fallback_key: key looked for when key is missing, e.g. the record with all the attributes.
+
+        Returns:
+        - A copy of the cached record or None if it is missing or expired.
+        """
+        with self._lock:
+            self._check_version()
+            record = self._lookup(key)
+            if record is None and fallback_key is not None:
+                record = self._lookup(fallback_key)
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return _copy_record(record)
+
+    def _lookup(self, key) -> Optional[Dict]:
+        """
+        Return the record if present and not expired, removing it if expired. The lock must be held.
+        """
+        entry = self._records.get(key)
+        if entry is None:
+            return None
+        expires_at, record = entry
+        if expires_at < time.monotonic():
+            del self._records[key]
+            return None
+        self._records.move_to_end(key)
+        return record
+
+    def put(self, key, record: Dict):
+        """
+        Store a drug record in the cache, evicting the least recently used one if the cache is full.
+
+        Parameters:
+        - key: key of the record, the drug code and the attributes projection.
+        - record: the drug record.
+        """
+        if record is None:
+            return
+        with self._lock:
+            self._records[key] = (time.monotonic() + self.ttl, _copy_record(record))
+            self._records.move_to_end(key)
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Remove all the records from the cache.
+        """
+        with self._lock:
+            self._records.clear()
+
+    def stats(self) -> Dict:
+        """
+        Return the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._records),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Dict
+
+# Raised when a pool has no free worker and its wait queue is full
+class ExecutorSaturated(Exception):
+    def __init__(self, name: str, pending: int, capacity: int):
+        super().__init__(f"The {name} executor is saturated ({pending}/{capacity} pending tasks)")
+        self.name = name
+        self.pending = pending
+        self.capacity = capacity
+
+# ThreadPoolExecutor with a fixed number of workers and a bounded wait queue.
+# Tasks submitted beyond the capacity are rejected with ExecutorSaturated instead of being queued without bound
+class BoundedExecutor(Executor):
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        """
+        Initialize the pool.
+
+        Parameters:
+        - name: the pool name, used in the thread names and in the metrics.
+        - max_workers: number of threads of the pool.
+        - max_queue: maximum number of tasks waiting for a free thread.
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"heliot-{name}")
+        self._lock = threading.Lock()
+
+        self._pending = 0
+        self._running = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def saturated(self) -> bool:
+        """
+        Return True if a new task would be rejected.
+        """
+        return self._pending >= self.capacity
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            if self._pending >= self.capacity:
+                self.rejected += 1
+                raise ExecutorSaturated(self.name, self._pending, self.capacity)
+            self._pending += 1
+            self.submitted += 1
+            self.max_pending = max(self.max_pending, self._pending)
+
+        def run():
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._pending -= 1
+                    self.completed += 1
+
+        try:
+            return self._executor.submit(run)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+    def stats(self) -> Dict:
+        """
+        Return the pool counters. queued is the number of tasks waiting for a free thread.
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "max_pending": self.max_pending,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+# Bounded number of asyncio calls to the language model in flight, with the same back-pressure as BoundedExecutor:
+# at most max_concurrent calls run, at most max_queue wait for a free slot, the others are rejected with ExecutorSaturated
+class AsyncLimiter:
+    def __init__(self, name: str, max_concurrent: int, max_queue: int):
+        """
+        Initialize the limiter.
+
+        Parameters:
+        - name: the limiter name, used in the metrics.
+        - max_concurrent: maximum number of calls running at the same time.
+        - max_queue: maximum number of calls waiting for a free slot.
+        """
+        self.name = name
+        self.max_workers = max_concurrent
+        self.max_queue = max_queue
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+        self._pending = 0
+        self._running = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def saturated(self) -> bool:
+        """
+        Return True if a new call would be rejected.
+        """
+        return self._pending >= self.capacity
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Hold a slot for the duration of a call, e.g. while a streamed answer is read.
+        """
+        with self._lock:
+            if self._pending >= self.capacity:
+                self.rejected += 1
+                raise ExecutorSaturated(self.name, self._pending, self.capacity)
+            self._pending += 1
+            self.submitted += 1
+            self.max_pending = max(self.max_pending, self._pending)
+        try:
+            # Created at the first use, inside the event loop of the service
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.max_workers)
+            async with self._semaphore:
+                with self._lock:
+                    self._running += 1
+                try:
+                    yield
+                finally:
+                    with self._lock:
+                        self._running -= 1
+                        self.completed += 1
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def stats(self) -> Dict:
+        """
+        Return the limiter counters. queued is the number of calls waiting for a free slot.
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "max_pending": self.max_pending,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "rejected": self.rejected
+            }
+
+# Service-wide pools: one for the I/O-bound calls to the language model, one for the database lookups,
+# and the limiter of the calls to the language model made by the asyncio service path
+class ExecutorPools:
+    def __init__(self, llm_workers: int = 32, llm_queue: int = 256, db_workers: int = 8, db_queue: int = 128):
+        """
+        Initialize the pools.
+
+        Parameters:
+        - llm_workers, llm_queue: threads and wait queue size of the language model pool, and concurrent calls and wait queue size of the asyncio limiter.
+        - db_workers, db_queue: threads and wait queue size of the database pool.
+        """
+        self.llm = BoundedExecutor("llm", llm_workers, llm_queue)
+        self.db = BoundedExecutor("db", db_workers, db_queue)
+        self.allm = AsyncLimiter("allm", llm_workers, llm_queue)
+
+    @staticmethod
+    def from_env() -> "ExecutorPools":
+        """
+        Build the pools reading the sizes from the HELIOT_LLM_WORKERS, HELIOT_LLM_QUEUE,
+        HELIOT_DB_WORKERS and HELIOT_DB_QUEUE environment variables.
+        """
+        return ExecutorPools(llm_workers=int(os.environ.get("HELIOT_LLM_WORKERS", 32)),
+                             llm_queue=int(os.environ.get("HELIOT_LLM_QUEUE", 256)),
+                             db_workers=int(os.environ.get("HELIOT_DB_WORKERS", 8)),
+                             db_queue=int(os.environ.get("HELIOT_DB_QUEUE", 128)))
+
+    def check_capacity(self):
+        """
+        Raise ExecutorSaturated if one of the pools cannot accept new tasks, so that a request is rejected before it starts.
+        """
+        for pool in (self.llm, self.allm, self.db):
+            if pool.saturated():
+                with pool._lock:
+                    pool.rejected += 1
+                raise ExecutorSaturated(pool.name, pool._pending, pool.capacity)
+
+    def shutdown(self, wait: bool = True):
+        self.llm.shutdown(wait=wait)
+        self.db.shutdown(wait=wait)
+
+    def stats(self) -> Dict:
+        return {"llm": self.llm.stats(), "allm": self.allm.stats(), "db": self.db.stats()}
+
+
+_pools = None
+_pools_lock = threading.Lock()
+
+# Return the process-wide executor pools
+def get_executor_pools() -> ExecutorPools:
+    global _pools
+    if _pools is None:
+        with _pools_lock:
+            if _pools is None:
+                _pools = ExecutorPools.from_env()
+    return _pools
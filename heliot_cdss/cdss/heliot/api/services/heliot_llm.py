@@ -2,19 +2,61 @@ from ...db_management import *
 from ...patient_management import *
 from ...ingredients_onthology import *
 from ...dss_prompts import *
+from ...tiledb_handles import get_handle_manager
+from ...translation_cache import TranslationCache, default_cache_path
+from ...ingredient_matcher import replace_matches, unresolved_allergy_spans
+from .allergen_profile import extract_allergen_profile, format_allergen_profile
+from .drug_cache import DrugRecordCache
+from .executors import ExecutorPools, get_executor_pools
+from .response_cache import ResponseCache, context_fingerprint
+from .rule_engine import AllergyRuleEngine
+from .token_budget import fit_drug_fields
+from .write_behind import PatientWriteBehind
 import os
-from openai import OpenAI
-from concurrent.futures import ThreadPoolExecutor #, as_completed
-#import asyncio
+from openai import OpenAI, AsyncOpenAI
+import asyncio
+import time
 import traceback
 import json
-#from typing import AsyncGenerator
+from typing import AsyncGenerator
+
+# Model used for the checks and the translations
+LLM_MODEL = "gpt-4o"
+
+# Drug attributes read by each check, besides composition and excipients
+CHECK_DRUG_ATTRS = ["drug_name"]
+CHECK_ENHANCED_DRUG_ATTRS = ["drug_name", "contraindications"] + CROSS_REACTIVITY_ATTRIBUTES
+
+# Upper bound of the checks of a batch running at the same time, whatever the request asks for
+BATCH_MAX_CONCURRENCY = int(os.environ.get("HELIOT_BATCH_MAX_CONCURRENCY", "32"))
 
 class HeliotLLM:
-    def __init__(self, db_uri:str ="drugs_db", synonym_csv:str ="ingredients_synonyms.csv", pt_db_uri:str ="medical_narrative"):
-        self.dbm = DatabaseManagement(db_uri=db_uri, store_lower_case=True)
+    def __init__(self, db_uri:str ="drugs_db", synonym_csv:str ="ingredients_synonyms.csv", pt_db_uri:str ="medical_narrative", normalized_db:bool =False, drug_cache_size:int =1024, drug_cache_ttl:float =3600, executors:ExecutorPools =None, translation_cache:TranslationCache =None, translation_cache_path:str =None, response_cache_size:int =2048, response_cache_ttl:float =3600, field_budgets:Dict =None, rule_engine:bool =True, patient_context:str =None):
+        # Both databases share the long-lived read handles and the tiledb.Ctx
+        handles = get_handle_manager()
+        self.dbm = DatabaseManagement(db_uri=db_uri, store_lower_case=True, normalized=normalized_db, handles=handles)
+        # In-process cache of the drug records, invalidated when the drugs database changes
+        self.drug_cache = DrugRecordCache(self.dbm.last_fragment_timestamp, max_size=drug_cache_size, ttl=drug_cache_ttl)
         self.ont = SynonymManager(synonym_csv)
-        self.ptm = MedicalNarrativeDB(db_uri=pt_db_uri)
+        self.ptm = MedicalNarrativeDB(db_uri=pt_db_uri, handles=handles)
+        # Consolidate the fragments of the notes in the background, so the reads do not slow down as the notes are updated (0 disables it)
+        compaction_interval = float(os.environ.get("HELIOT_NARRATIVE_COMPACTION_INTERVAL", "300"))
+        if compaction_interval > 0:
+            self.ptm.start_compaction(compaction_interval, int(os.environ.get("HELIOT_NARRATIVE_COMPACTION_FRAGMENTS", "16")))
+        # Deterministic answers of the clear-cut enhanced checks, without calling the model
+        self.rules = AllergyRuleEngine(self.ont) if rule_engine else None
+        # Stored patient context sent to the model: "narrative" (all the stored notes) or "profile" (the compact allergen profile)
+        self.patient_context = patient_context or os.environ.get("HELIOT_PATIENT_CONTEXT", "narrative")
+        # Notes stored by the checks are written in batches by a background thread (HELIOT_WRITE_BEHIND_MS=0 writes them before the check ends)
+        write_behind_ms = float(os.environ.get("HELIOT_WRITE_BEHIND_MS", "200"))
+        self.write_behind = PatientWriteBehind(self._store_patients, write_behind_ms / 1000, int(os.environ.get("HELIOT_WRITE_BEHIND_ITEMS", "64")),
+                                               int(os.environ.get("HELIOT_WRITE_BEHIND_MAX_PENDING", "10000"))) if write_behind_ms > 0 else None
+        # Token budgets of the long drug sections of the prompt (see token_budget.py)
+        self.field_budgets = field_budgets
+        # Answers of the model, keyed on the drug and on the canonical patient context
+        self.response_cache = ResponseCache(max_size=response_cache_size, ttl=response_cache_ttl)
+        # Translations of allergies and ingredients, persisted across restarts in the data directory unless a path is given
+        self.translation_cache = translation_cache or TranslationCache(translation_cache_path or os.environ.get("HELIOT_TRANSLATION_CACHE") or default_cache_path())
 
         # Initialize the OPENAI API
         OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
@@ -22,6 +64,12 @@ class HeliotLLM:
             # This is the default and can be omitted
             api_key=os.environ.get("OPENAI_API_KEY"),
         )
+        # Client used by the asyncio service path
+        self.aclient = AsyncOpenAI(
+            api_key=os.environ.get("OPENAI_API_KEY"),
+        )
+        # Shared bounded pools for the model calls and the blocking TileDB lookups
+        self.executors = executors or get_executor_pools()
 
     def _extract_composition_from_clinical_notes(self, text:str) -> str:
         try:
@@ -38,25 +86,182 @@ class HeliotLLM:
 
     # Translate the text in English
     def _translate_in_english(self, text:str) -> str:
+        cached = self.translation_cache.get(text, LLM_MODEL)
+        if cached is not None:
+            return cached
         try:
-            response = self.client.chat.completions.create(model="gpt-4o",
+            response = self.client.chat.completions.create(model=LLM_MODEL,
                                     messages=[{"role": "system", "content": ""},
                                             {"role": "user", "content":  USER_ENGLISH_TRANSLATION.format(text=text)}],
                                     max_tokens=3000,
                                     temperature = 0)
             cleaned_text = response.choices[0].message.content
+            self.translation_cache.put(text, cleaned_text, LLM_MODEL)
+            return cleaned_text
+        except Exception as e:
+            print(f"Failed to process translation with GPT-4: {e}")
+            return None
+
+    async def _aextract_composition_from_clinical_notes(self, text:str) -> str:
+        try:
+            async with self.executors.allm.slot():
+                response = await self.aclient.chat.completions.create(model="gpt-4o",
+                                        messages=[{"role": "system", "content": ""},
+                                                {"role": "user", "content":  USER_EXTRACT_COMPOSITION.format(narrative=text)}],
+                                        max_tokens=3000,
+                                        temperature = 0)
+            return response.choices[0].message.content
+        except Exception as e:
+            print(f"Failed to process text with GPT-4: {e}")
+            return None
+
+    # Translate the text in English, asyncio version. The cache reads and writes SQLite, so it runs in the database executor
+    async def _atranslate_in_english(self, text:str) -> str:
+        cached = await self._arun_db(self.translation_cache.get, text, LLM_MODEL)
+        if cached is not None:
+            return cached
+        try:
+            async with self.executors.allm.slot():
+                response = await self.aclient.chat.completions.create(model=LLM_MODEL,
+                                        messages=[{"role": "system", "content": ""},
+                                                {"role": "user", "content":  USER_ENGLISH_TRANSLATION.format(text=text)}],
+                                        max_tokens=3000,
+                                        temperature = 0)
+            cleaned_text = response.choices[0].message.content
+            await self._arun_db(self.translation_cache.put, text, cleaned_text, LLM_MODEL)
             return cleaned_text
         except Exception as e:
             print(f"Failed to process translation with GPT-4: {e}")
             return None
 
-    def _internal_search_drug(self,drug_code:str)-> Dict:
+    # Run a blocking database call in the bounded database executor, without blocking the event loop
+    async def _arun_db(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executors.db, fn, *args)
+
+    # Return the prefetched record if present, otherwise run the lookup in the database executor
+    async def _afetch(self, prefetched:Dict, key:str, fn, *args):
+        if prefetched is not None and key in prefetched:
+            return prefetched[key]
+        return await self._arun_db(fn, *args)
+
+    # Look for a drug in the cache. A full record can serve any projection
+    def _cached_drug(self, drug_code:str, attrs:List = None) -> Dict:
+        if attrs is None:
+            return self.drug_cache.get((drug_code, None))
+        return self.drug_cache.get((drug_code, tuple(attrs)), fallback_key=(drug_code, None))
+
+    # Search a drug, reading only the attrs projection if given
+    def _internal_search_drug(self,drug_code:str, attrs:List = None)-> Dict:
+        drg = self._cached_drug(drug_code, attrs)
+        if drg is not None:
+            return drg
         print("SEARCHING...", drug_code)
-        return self.dbm.search_drug(drug_code)
+        drg = self.dbm.search_drug(drug_code, attrs)
+        self.drug_cache.put((drug_code, tuple(attrs) if attrs is not None else None), drg)
+        return drg
+
+    # Search many drugs at once: cached records are served from the cache, the others with a single database read
+    def search_drugs(self, drug_codes: List, attrs: List = None) -> Dict:
+        result = {}
+        missing = []
+        for drug_code in dict.fromkeys(drug_codes):
+            drg = self._cached_drug(drug_code, attrs)
+            if drg is not None:
+                result[drug_code] = drg
+            else:
+                missing.append(drug_code)
+
+        if missing:
+            print("SEARCHING...", len(missing), "drugs")
+            for drug_code, drg in self.dbm.search_drugs(missing, attrs).items():
+                self.drug_cache.put((drug_code, tuple(attrs) if attrs is not None else None), drg)
+                result[drug_code] = drg
+        return result
+
+    def executor_stats(self) -> Dict:
+        return self.executors.stats()
+
+    def translation_cache_stats(self) -> Dict:
+        return self.translation_cache.stats()
+
+    def response_cache_stats(self) -> Dict:
+        return self.response_cache.stats()
+
+    # Hit/miss counters of the drug cache
+    def drug_cache_stats(self) -> Dict:
+        return self.drug_cache.stats()
+
+    def write_behind_stats(self) -> Dict:
+        return self.write_behind.stats() if self.write_behind is not None else {}
 
     def _internal_search_patient(self, patient_id:str)-> Dict:
         print("SEARCHING...", patient_id)
-        return self.ptm.search_patient(patient_id)
+        pt = None
+        if self.patient_context == "profile":
+            profile = self.ptm.search_profile(patient_id)
+            if profile:
+                pt = self._profile_patient(patient_id, profile)
+        # Patients stored before the profile existed fall back to the narrative
+        if pt is None:
+            pt = self.ptm.search_patient(patient_id)
+        return self._with_pending(patient_id, pt)
+
+    # Bulk version of _internal_search_patient, returning the found patients by id
+    def _search_patients(self, patient_ids:List)-> Dict:
+        patients = {}
+        if self.patient_context == "profile":
+            patients = {pid: self._profile_patient(pid, profile) for pid, profile in self.ptm.search_profiles(patient_ids).items()}
+        missing = [pid for pid in patient_ids if pid not in patients]
+        if missing:
+            patients.update(self.ptm.search_patients(missing))
+        for pid in dict.fromkeys(patient_ids):
+            pt = self._with_pending(pid, patients.get(pid))
+            if pt is not None:
+                patients[pid] = pt
+        return patients
+
+    # Read-your-writes: apply to the stored patient record the notes still waiting in the write-behind queue
+    def _with_pending(self, patient_id:str, pt:Dict)-> Dict:
+        pending = self.write_behind.pending(patient_id) if self.write_behind is not None else []
+        if not pending:
+            return pt
+        if self.patient_context == "profile":
+            profile = {row['allergen']: row for row in (pt or {}).get('profile', [])}
+            for update in pending:
+                for row in MedicalNarrativeDB.merge_profile(list(profile.values()), update.get('profile') or [], update['timestamp']):
+                    profile[row['allergen']] = row
+            if profile:
+                return self._profile_patient(patient_id, sorted(profile.values(), key=lambda row: row['allergen']))
+        return {'patient_id': patient_id, 'clinical_notes': pending[-1]['clinical_notes']}
+
+    # Patient record with the allergen profile formatted as compact notes in place of the narrative, so the rest of the check is unchanged
+    def _profile_patient(self, patient_id:str, profile:List)-> Dict:
+        return {'patient_id': patient_id, 'clinical_notes': format_allergen_profile(profile), 'profile': profile}
+
+    # Store the notes of the patient and update the allergen profile with the allergens they mention.
+    # With the write-behind queue the update is only queued, and written with the other pending ones
+    def _store_patient(self, patient_id:str, clinical_notes:str) -> bool:
+        profile = extract_allergen_profile(self.ont, clinical_notes)
+        if self.write_behind is not None:
+            self.write_behind.put(patient_id, clinical_notes, profile=profile)
+            return True
+        return self._store_patients([{'patient_id': patient_id, 'clinical_notes': clinical_notes, 'timestamp': None, 'profile': profile}])
+
+    # Write a batch of updates of the notes: one write of the notes, one of the log and one of the allergen profiles
+    def _store_patients(self, updates:List[Dict]) -> bool:
+        stored = self.ptm.update_patients(updates)
+        profiles = {}
+        for update in updates:
+            profiles.setdefault(update['patient_id'], []).extend(update.get('profile') or [])
+        timestamp = max((update['timestamp'] for update in updates if update.get('timestamp') is not None), default=None)
+        return self.ptm.update_profiles(profiles, timestamp) and stored
+
+    # Write the pending notes and stop the background threads, at the shutdown of the service
+    def close(self):
+        if self.write_behind is not None:
+            self.write_behind.close()
+        self.ptm.stop_compaction()
     
 
     def _chat_completion_create(self, model, messages, max_tokens, temperature, stream):
@@ -72,45 +277,171 @@ class HeliotLLM:
                     print(event.choices[0].delta.content, end="")
                     yield f"data: {json.dumps({'message': event.choices[0].delta.content})}\n\n"
 
-    def dss_check(self, drug_code: str, allergy: str):
-        print("DRUG CODE", drug_code)
-        
-        if len(allergy) >0:
-            allergy = allergy.lower()
-            with ThreadPoolExecutor() as executor:
-                future_drug = executor.submit(self._internal_search_drug, drug_code)
-                future_translation = executor.submit(self._translate_in_english, allergy)
-                    
-                # Wait for the results
-                drg = future_drug.result()
-                allergy = future_translation.result()
-                al = self.ont.find_standard_name(allergy)
-                allergy_type = "allergic to "+al
-        else:
-            allergy_type = "not allergic"
-            drg = self.dbm.search_drug(drug_code)
+    # Server-sent events of the streamed answer
+    def _message_event(self, content:str) -> str:
+        return f"data: {json.dumps({'message': content})}\n\n"
 
-        composition = drg['composition']
-        excipients = drg['excipients']
-        prescription = drg['drug_name']
+    # Token usage, with the input tokens served from the provider prompt cache
+    def _usage_dict(self, usage) -> Dict:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details is not None else 0
+        return {'input': usage.prompt_tokens, 'output': usage.completion_tokens, 'total':  usage.total_tokens,
+                'cached_input': cached_tokens, 'uncached_input': usage.prompt_tokens - cached_tokens}
 
-        try:
-            response = self.client.chat.completions.create(model="gpt-4o",
-                                    messages=[{"role": "system", "content": SYSTEM_CHECK_ALLERGY_PROMPT.format(drug=prescription, active_ingredients=composition, excipients=excipients)},
-                                            {"role": "user", "content":  USER_CHECK_ALLERGY_PROMPT.format( allergy=allergy_type)}],
+    def _usage_event(self, usage) -> str:
+        print(usage)
+        return f"data: {json.dumps(self._usage_dict(usage))}\n\n"
+
+    # Cache key of the allergy check: the allergy is already mapped to its standard name
+    def _check_cache_key(self, drug_code:str, allergy_type:str):
+        return ("check", drug_code, self.drug_cache.version(), allergy_type.casefold())
+
+    # Cache key of the enhanced allergy check: the whole clinical notes, already rewritten with the standard names, and the stored notes
+    def _enhanced_cache_key(self, drug_code:str, clinical_notes:str, pt:Dict):
+        stored_notes = pt['clinical_notes'] if pt else None
+        return ("enhanced", drug_code, self.drug_cache.version(), context_fingerprint(clinical_notes or "", stored_notes))
+
+    # Replay a cached answer as the same server-sent events, with a zero usage marked as cached
+    def _cached_events(self, cached) -> List:
+        chunks, _ = cached
+        events = [self._message_event(chunk) for chunk in chunks]
+        events.append(f"data: {json.dumps({'input': 0, 'output': 0, 'total': 0, 'cached_input': 0, 'uncached_input': 0, 'cached': True})}\n\n")
+        return events
+
+    # Answer of the rule engine for the patient information, or None if the model must evaluate it
+    def _rule_answer(self, drg:Dict, patient_info:str) -> Dict:
+        if self.rules is None:
+            return None
+        answer = self.rules.evaluate(drg, patient_info)
+        if answer is not None:
+            print("RULE", answer['r'])
+        return answer
+
+    # Send the answer of the rule engine as the same server-sent events of the model, with a zero usage marked as rule
+    def _rule_events(self, answer:Dict) -> List:
+        return [self._message_event(json.dumps(answer)),
+                f"data: {json.dumps({'input': 0, 'output': 0, 'total': 0, 'cached_input': 0, 'uncached_input': 0, 'rule': True})}\n\n"]
+
+    # Stream the final answer of the model as server-sent events, storing the complete answer in the response cache
+    def _stream_answer(self, messages:List, cache_key=None):
+        response = self.client.chat.completions.create(model=LLM_MODEL,
+                                messages=messages,
+                                max_tokens=3000,
+                                temperature = 0,
+                                stream=True,
+                                stream_options= {"include_usage": True})
+        chunks = []
+        usage = None
+        for event in response:
+            if event.choices is not None and len(event.choices)>0 and event.choices[0].delta.content is not None:
+                chunks.append(event.choices[0].delta.content)
+                yield self._message_event(event.choices[0].delta.content)
+            if hasattr(event, 'usage') and event.usage is not None:
+                usage = self._usage_dict(event.usage)
+                yield self._usage_event(event.usage)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, chunks, usage)
+
+    # Prompt messages of the allergy check
+    def _check_messages(self, drg:Dict, allergy_type:str) -> List:
+        return [{"role": "system", "content": SYSTEM_CHECK_ALLERGY_PROMPT.format(drug=drg['drug_name'], active_ingredients=drg['composition'], excipients=drg['excipients'])},
+                {"role": "user", "content":  USER_CHECK_ALLERGY_PROMPT.format( allergy=allergy_type)}]
+
+    # Known cross-reactivity section of the prompt, empty if the leaflet reports none
+    def _cross_reactivity_info(self, drg:Dict) -> str:
+        lines = []
+        if drg.get('cross_reactivity_description'):
+            lines.append(drg['cross_reactivity_description'])
+        if drg.get('cross_reactivity_incidence'):
+            lines.append("Incidence: " + drg['cross_reactivity_incidence'])
+        if drg.get('cross_sensitive_drugs'):
+            lines.append("Cross-sensitive drugs: " + ", ".join(drg['cross_sensitive_drugs']))
+        return "\n".join(lines)
+
+    # Prompt messages of the enhanced allergy check: the static instructions are the prefix, so that the provider can cache them,
+    # followed by the drug sections cut to their token budget
+    def _enhanced_messages(self, drg:Dict, patient_info:str) -> List:
+        drg = fit_drug_fields(drg, self.field_budgets)
+        cross_reactivity = self._cross_reactivity_info(drg)
+        drug_info = SYSTEM_CHECK_ALLERGY_ENHANCED_DRUG_PROMPT.format(drug=drg['drug_name'], active_ingredients=drg['composition'], excipients=drg['excipients'], cross_reactivity=cross_reactivity, contraindications=drg['contraindications'])
+        return [{"role": "system", "content": SYSTEM_CHECK_ALLERGY_ENHANCED_STATIC_PROMPT + drug_info},
+                {"role": "user", "content":  USER_CHECK_ALLERGY_ENHANCED_PROMPT.format( patient_info=patient_info)}]
+
+    # Split the '#' separated list of ingredients extracted from the clinical notes
+    def _split_compositions(self, comps:str) -> List:
+        if not comps or len(comps.strip()) == 0:
+            return []
+        return [x for x in comps.split("#") if x]
+
+    # Replace the ingredients found in the clinical notes with their standard English names
+    def _replace_compositions(self, clinical_notes:str, orig_comps:List, comps:List) -> str:
+        s_ingredients = self.ont.find_standard_names(comps)
+        print(orig_comps, "\n", comps, "\n", s_ingredients)
+        replacements = {orig_comps[i]: s_ingredients[i].get('t') for i in range(len(s_ingredients))}
+        clinical_notes = self.ont.replace_synonyms(clinical_notes, replacements)
+        print("NEW CLINICAL NOTES", clinical_notes)
+        return clinical_notes
+
+    # Look for the ingredients in the clinical notes with the local dictionary.
+    # Return None when an allergy mention is not resolved by the dictionary, so that the model must extract the ingredients
+    def _local_compositions(self, clinical_notes:str):
+        matches = self.ont.find_ingredients(clinical_notes)
+        unresolved = unresolved_allergy_spans(clinical_notes, matches)
+        if unresolved:
+            print("UNRESOLVED", [clinical_notes[start:end] for start, end in unresolved])
+            return None
+        return matches
+
+    # Replace the ingredients found by the local dictionary with their standard English names
+    def _replace_matches(self, clinical_notes:str, matches:List) -> str:
+        print("LOCAL MATCHES", [(m.text, m.value) for m in matches])
+        return replace_matches(clinical_notes, matches)
+
+    # Stream the final answer of the model as server-sent events, asyncio version. The limiter slot is held until the stream ends
+    async def _astream_answer(self, messages:List, cache_key=None) -> AsyncGenerator[str, None]:
+        chunks = []
+        usage = None
+        async with self.executors.allm.slot():
+            response = await self.aclient.chat.completions.create(model=LLM_MODEL,
+                                    messages=messages,
                                     max_tokens=3000,
                                     temperature = 0,
                                     stream=True,
                                     stream_options= {"include_usage": True})
-            for event in response:
+            async for event in response:
                 if event.choices is not None and len(event.choices)>0 and event.choices[0].delta.content is not None:
-                    yield f"data: {json.dumps({'message': event.choices[0].delta.content})}\n\n"
+                    chunks.append(event.choices[0].delta.content)
+                    yield self._message_event(event.choices[0].delta.content)
                 if hasattr(event, 'usage') and event.usage is not None:
-                    print(event.usage)
-                    prompt_tokens = event.usage.prompt_tokens
-                    completion_tokens = event.usage.completion_tokens
-                    total_tokens = event.usage.total_tokens
-                    yield f"data: {json.dumps({'input': prompt_tokens, 'output': completion_tokens, 'total':  total_tokens})}\n\n"
+                    usage = self._usage_dict(event.usage)
+                    yield self._usage_event(event.usage)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, chunks, usage)
+
+    def dss_check(self, drug_code: str, allergy: str, bypass_cache: bool = False):
+        print("DRUG CODE", drug_code)
+        
+        if len(allergy) >0:
+            allergy = allergy.lower()
+            future_drug = self.executors.db.submit(self._internal_search_drug, drug_code, CHECK_DRUG_ATTRS)
+            future_translation = self.executors.llm.submit(self._translate_in_english, allergy)
+
+            # Wait for the results
+            drg = future_drug.result()
+            allergy = future_translation.result()
+            al = self.ont.find_standard_name(allergy)
+            allergy_type = "allergic to "+al
+        else:
+            allergy_type = "not allergic"
+            drg = self._internal_search_drug(drug_code, CHECK_DRUG_ATTRS)
+
+        try:
+            cache_key = self._check_cache_key(drug_code, allergy_type)
+            cached = None if bypass_cache else self.response_cache.get(cache_key)
+            if cached is not None:
+                yield from self._cached_events(cached)
+            else:
+                yield from self._stream_answer(self._check_messages(drg, allergy_type), cache_key)
         except Exception as e:
             stack_trace = traceback.format_exc()
             
@@ -119,93 +450,241 @@ class HeliotLLM:
             print(stack_trace)
             yield None
 
+    # Asyncio version of dss_check: the drug lookup runs in the database executor, concurrently with the translation
+    async def adss_check(self, drug_code: str, allergy: str, bypass_cache: bool = False) -> AsyncGenerator[str, None]:
+        print("DRUG CODE", drug_code)
+        try:
+            if len(allergy) >0:
+                allergy = allergy.lower()
+                drg, allergy = await asyncio.gather(self._arun_db(self._internal_search_drug, drug_code, CHECK_DRUG_ATTRS),
+                                                    self._atranslate_in_english(allergy))
+                al = self.ont.find_standard_name(allergy)
+                allergy_type = "allergic to "+al
+            else:
+                allergy_type = "not allergic"
+                drg = await self._arun_db(self._internal_search_drug, drug_code, CHECK_DRUG_ATTRS)
+
+            cache_key = self._check_cache_key(drug_code, allergy_type)
+            cached = None if bypass_cache else self.response_cache.get(cache_key)
+            if cached is not None:
+                for event in self._cached_events(cached):
+                    yield event
+            else:
+                async for event in self._astream_answer(self._check_messages(drg, allergy_type), cache_key):
+                    yield event
+        except Exception as e:
+            stack_trace = traceback.format_exc()
+
+            # There is an exception
+            print("Exception:")
+            print(stack_trace)
+            yield None
+
+    # Translate the ingredients concurrently, asyncio version
+    async def aparallel_translate(self, comps) -> list:
+        return list(await asyncio.gather(*[self._atranslate_in_english(c) for c in comps]))
+
     def parallel_translate(self,comps)->list:
-        with ThreadPoolExecutor() as executor:
-            # Map: return the results in the same input order
-            translated_comps = list(executor.map(self._translate_in_english, comps))
-        return translated_comps
+        # Map: return the results in the same input order. It must not be called from a task of the llm pool
+        return list(self.executors.llm.map(self._translate_in_english, comps))
 
-    def dss_check_enhanced(self, patient_id: str, drug_code: str, clinical_notes: str, store: bool = False):
+    def dss_check_enhanced(self, patient_id: str, drug_code: str, clinical_notes: str, store: bool = False, bypass_cache: bool = False):
         print("DRUG CODE", drug_code)
         
         # If there are clinical_notes
         if len(clinical_notes.strip()) >0:
             clinical_notes = clinical_notes.lower()
-            with ThreadPoolExecutor() as executor:
-                future_drug = executor.submit(self._internal_search_drug, drug_code)
-                future_patient = executor.submit(self._internal_search_patient, patient_id)
-                future_translation = executor.submit(self._extract_composition_from_clinical_notes, clinical_notes)
-                    
+            future_drug = self.executors.db.submit(self._internal_search_drug, drug_code, CHECK_ENHANCED_DRUG_ATTRS)
+            future_patient = self.executors.db.submit(self._internal_search_patient, patient_id)
+
+            # Try the local dictionary first, the model is used only for the unresolved allergy mentions
+            matches = self._local_compositions(clinical_notes)
+            if matches is not None:
+                clinical_notes = self._replace_matches(clinical_notes, matches)
+                drg = future_drug.result()
+            else:
+                future_translation = self.executors.llm.submit(self._extract_composition_from_clinical_notes, clinical_notes)
+
                 # Wait for the results
                 drg = future_drug.result()
                 comps = future_translation.result()
 
-                # Replace synonyms in text
-                if comps and len(comps.strip())>0:
-                    # preserve the original names
-                    orig_comps = comps.split("#")
-                    orig_comps = [x for x in orig_comps if x]
+                # Replace synonyms in text, preserving the original names
+                orig_comps = self._split_compositions(comps)
+                if orig_comps:
+                    # translate them in English
+                    comps = self.parallel_translate(orig_comps)
+                    clinical_notes = self._replace_compositions(clinical_notes, orig_comps, comps)
+
+            patient_info = clinical_notes
+            pt = future_patient.result()
+            print("PATIENT", pt)
+            if pt:
+                patient_info += "\n"+pt['clinical_notes']
+
+        else:
+            patient_info = "not allergic"
+            future_drug = self.executors.db.submit(self._internal_search_drug, drug_code, CHECK_ENHANCED_DRUG_ATTRS)
+            future_patient = self.executors.db.submit(self._internal_search_patient, patient_id)
+            drg = future_drug.result()
+            pt = future_patient.result()
+            print("PATIENT", pt)
+            if pt:
+                patient_info = pt['clinical_notes']
+
+        # Provide the final answer  
+        try:
+            answer = self._rule_answer(drg, patient_info)
+            if answer is not None:
+                yield from self._rule_events(answer)
+            else:
+                messages = self._enhanced_messages(drg, patient_info)
+                cache_key = self._enhanced_cache_key(drug_code, clinical_notes, pt)
+                cached = None if bypass_cache else self.response_cache.get(cache_key)
+                if cached is not None:
+                    yield from self._cached_events(cached)
+                else:
+                    yield from self._stream_answer(messages, cache_key)
+    
+            if store and clinical_notes:
+                self._store_patient(patient_id, clinical_notes)
+                if answer is None:
+                    print(messages[0]["content"])
+                    print("\n",messages[1]["content"])
+        except Exception as e:
+            stack_trace = traceback.format_exc()
+            
+            # There is an exception
+            print("Exception:")
+            print(stack_trace)
+            yield None
+
+    # Asyncio version of dss_check_enhanced: drug lookup, patient lookup and ingredients extraction run concurrently,
+    # the lookups in the database executor and the model calls with the asyncio client
+    # The drug and patient records already read in bulk, e.g. by adss_check_batch, can be passed as prefetched
+    async def adss_check_enhanced(self, patient_id: str, drug_code: str, clinical_notes: str, store: bool = False, bypass_cache: bool = False, prefetched: Dict = None) -> AsyncGenerator[str, None]:
+        print("DRUG CODE", drug_code)
+        try:
+            # If there are clinical_notes
+            if len(clinical_notes.strip()) >0:
+                clinical_notes = clinical_notes.lower()
+
+                # Try the local dictionary first, the model is used only for the unresolved allergy mentions
+                matches = self._local_compositions(clinical_notes)
+                if matches is not None:
+                    drg, pt = await asyncio.gather(self._afetch(prefetched, 'drug', self._internal_search_drug, drug_code, CHECK_ENHANCED_DRUG_ATTRS),
+                                                   self._afetch(prefetched, 'patient', self._internal_search_patient, patient_id))
+                    clinical_notes = self._replace_matches(clinical_notes, matches)
+                else:
+                    drg, pt, comps = await asyncio.gather(self._afetch(prefetched, 'drug', self._internal_search_drug, drug_code, CHECK_ENHANCED_DRUG_ATTRS),
+                                                          self._afetch(prefetched, 'patient', self._internal_search_patient, patient_id),
+                                                          self._aextract_composition_from_clinical_notes(clinical_notes))
+
+                    # Replace synonyms in text, preserving the original names
+                    orig_comps = self._split_compositions(comps)
                     if orig_comps:
                         # translate them in English
-                        comps = self.parallel_translate(orig_comps)
-                        s_ingredients = self.ont.find_standard_names(comps)
-                        print(orig_comps, "\n", comps, "\n", s_ingredients)
-                    for i in range(len(s_ingredients)):
-                        clinical_notes = clinical_notes.replace(orig_comps[i],s_ingredients[i].get('t'))  
-                    print("NEW CLINICAL NOTES", clinical_notes)
+                        comps = await self.aparallel_translate(orig_comps)
+                        clinical_notes = self._replace_compositions(clinical_notes, orig_comps, comps)
 
                 patient_info = clinical_notes
-                pt = future_patient.result()
                 print("PATIENT", pt)
                 if pt:
                     patient_info += "\n"+pt['clinical_notes']
-
-        else:
-            patient_info = "not allergic"
-            with ThreadPoolExecutor() as executor:
-                future_drug = executor.submit(self._internal_search_drug, drug_code)
-                future_patient = executor.submit(self._internal_search_patient, patient_id)
-                drg = future_drug.result()
-                pt = self._internal_search_patient(patient_id)
+            else:
+                patient_info = "not allergic"
+                drg, pt = await asyncio.gather(self._afetch(prefetched, 'drug', self._internal_search_drug, drug_code, CHECK_ENHANCED_DRUG_ATTRS),
+                                               self._afetch(prefetched, 'patient', self._internal_search_patient, patient_id))
                 print("PATIENT", pt)
                 if pt:
                     patient_info = pt['clinical_notes']
 
-        composition = drg['composition']
-        excipients = drg['excipients']
-        prescription = drg['drug_name']
-        contraindications = drg['contraindications']
-        cross_reactivity = drg['cross_reactivity']
-        if cross_reactivity.find("{'description': '', 'incidence': '', 'da': '', 'cross_sensitive_drugs': []}") !=-1:
-            cross_reactivity = ""
+            # Provide the final answer: clear-cut cases are answered by the rule engine, the others by the model,
+            # replaying the answer if an equivalent check is cached
+            answer = self._rule_answer(drg, patient_info)
+            if answer is not None:
+                for event in self._rule_events(answer):
+                    yield event
+            else:
+                cache_key = self._enhanced_cache_key(drug_code, clinical_notes, pt)
+                cached = None if bypass_cache else self.response_cache.get(cache_key)
+                if cached is not None:
+                    for event in self._cached_events(cached):
+                        yield event
+                else:
+                    async for event in self._astream_answer(self._enhanced_messages(drg, patient_info), cache_key):
+                        yield event
 
-        # Provide the final answer  
-        try:
-            response = self.client.chat.completions.create(model="gpt-4o",
-                                    messages=[{"role": "system", "content": SYSTEM_CHECK_ALLERGY_ENHANCED_PROMPT.format(drug=prescription, active_ingredients=composition, excipients=excipients, cross_reactivity=cross_reactivity, contraindications=contraindications)},
-                                            {"role": "user", "content":  USER_CHECK_ALLERGY_ENHANCED_PROMPT.format( patient_info=patient_info)}],
-                                    max_tokens=3000,
-                                    temperature = 0,
-                                    stream=True,
-                                    stream_options= {"include_usage": True})
-            for event in response:
-                if event.choices is not None and len(event.choices)>0 and event.choices[0].delta.content is not None:
-                    yield f"data: {json.dumps({'message': event.choices[0].delta.content})}\n\n"
-                if hasattr(event, 'usage') and event.usage is not None:
-                    print(event.usage)
-                    prompt_tokens = event.usage.prompt_tokens
-                    completion_tokens = event.usage.completion_tokens
-                    total_tokens = event.usage.total_tokens
-                    yield f"data: {json.dumps({'input': prompt_tokens, 'output': completion_tokens, 'total':  total_tokens})}\n\n"
-    
             if store and clinical_notes:
-                self.ptm.update_patient(patient_id,clinical_notes)
-                print(SYSTEM_CHECK_ALLERGY_ENHANCED_PROMPT.format(drug=prescription, active_ingredients=composition, excipients=excipients, cross_reactivity=cross_reactivity, contraindications=contraindications))
-                print("\n",USER_CHECK_ALLERGY_ENHANCED_PROMPT.format( patient_info=patient_info))
+                await self._arun_db(self._store_patient, patient_id, clinical_notes)
         except Exception as e:
             stack_trace = traceback.format_exc()
-            
+
             # There is an exception
             print("Exception:")
             print(stack_trace)
-            yield None
\ No newline at end of file
+            yield None
+    # Run the enhanced check of a batch item, collecting the streamed answer and its token usage
+    async def _abatch_item(self, index:int, item:Dict, prefetched:Dict, semaphore:asyncio.Semaphore, bypass_cache:bool) -> Dict:
+        chunks = []
+        usage = None
+        error = False
+        queued_time = time.time()
+        async with semaphore:
+            # timing is the latency of the check alone, the wait for a free slot of the batch is reported as queue_wait
+            start_time = time.time()
+            async for event in self.adss_check_enhanced(item['patient_id'], item['drug_code'], item['clinical_notes'], item.get('store', False), bypass_cache, prefetched):
+                if event is None:
+                    error = True
+                    continue
+                data = json.loads(event[len("data: "):])
+                if 'message' in data:
+                    chunks.append(data['message'])
+                else:
+                    usage = data
+            timing = time.time() - start_time
+
+        text = "".join(chunks)
+        try:
+            result = json.loads(text) if text else None
+        except ValueError:
+            result = None
+        return {'index': index, 'patient_id': item['patient_id'], 'drug_code': item['drug_code'],
+                'result': result, 'text': text, 'usage': usage, 'error': error or result is None,
+                'timing': timing, 'queue_wait': start_time - queued_time}
+
+    # Enhanced checks of many (patient, drug, clinical notes) items. The drug and patient records are read in bulk,
+    # then the checks run with at most concurrency of them in flight. Every result is yielded as an NDJSON line as soon as it completes
+    async def adss_check_batch(self, items:List[Dict], concurrency:int = 8, bypass_cache:bool = False) -> AsyncGenerator[str, None]:
+        if not items:
+            return
+        concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+        print("BATCH", len(items), "items, concurrency", concurrency)
+
+        # One read for all the drugs and one for all the patients. Missing records are looked up again by the single check,
+        # which reports the error of its item. The notes stored by the items of the batch are not seen by the others
+        drugs, patients = await asyncio.gather(self._arun_db(self.search_drugs, [item['drug_code'] for item in items], CHECK_ENHANCED_DRUG_ATTRS),
+                                               self._arun_db(self._search_patients, [item['patient_id'] for item in items]),
+                                               return_exceptions=True)
+        # A failed bulk read is not taken as "no patient history": each check reads its patient again
+        if isinstance(patients, Exception):
+            print(f"Error reading the patients of the batch: {patients}")
+            patients = None
+        if isinstance(drugs, Exception):
+            raise drugs
+
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = []
+        for index, item in enumerate(items):
+            prefetched = {'patient': patients.get(item['patient_id'])} if patients is not None else {}
+            if item['drug_code'] in drugs:
+                prefetched['drug'] = drugs[item['drug_code']]
+            tasks.append(asyncio.create_task(self._abatch_item(index, item, prefetched, semaphore, bypass_cache)))
+
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task) + "\n"
+        finally:
+            # The client went away: do not keep calling the model for a response nobody reads
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,137 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Reaction types mentioned in the patient context, in Italian and in English
+REACTION_TYPES = {
+    "anaphylaxis": r"anafilass\w*|anaphyla\w*|shock",
+    "angioedema": r"angioedem\w*|edema della glottide|edema\w* (?:del )?(?:volto|labbra|lingua)|quincke",
+    "urticaria": r"orticari\w*|urticari\w*|pomfi",
+    "rash": r"rash|esantem\w*|eruzion\w* cutane\w*|eritem\w*|exanthem\w*|eruption",
+    "pruritus": r"prurit\w*|prurigin\w*|itch\w*",
+    "bronchospasm": r"broncospasm\w*|bronchospasm\w*|asma|asthma|dispnea|dyspn\w*|wheez\w*",
+    "severe_cutaneous": r"stevens[- ]johnson|lyell|necrolisi|necrolysis|dress|sjs|ten",
+    "gastrointestinal": r"nause\w*|vomit\w*|diarre\w*|diarrh\w*",
+}
+
+# Tolerance and negation expressions, which change the answer for the same ingredients
+CONTEXT_CUES = {
+    "tolerated": r"toller\w*|tolera\w*",
+    "negated": r"non (?:e |è )?allergic\w*|nessuna allergia|non allergi\w*|not allergic|no known allerg\w*|negativ\w*|nega|negano|negat[aoie]|esclus[aoie]|denie[sd]|ruled out",
+    "desensitized": r"desensibilizz\w*|desensiti\w*",
+    "intolerance": r"intolleran\w*|intoleran\w*",
+}
+
+# Expressions match whole words only, e.g. "asma" is not found in "plasma"
+_REACTION_RES = {name: re.compile(rf"\b(?:{pattern})\b", re.IGNORECASE) for name, pattern in REACTION_TYPES.items()}
+_CUE_RES = {name: re.compile(rf"\b(?:{pattern})\b", re.IGNORECASE) for name, pattern in CONTEXT_CUES.items()}
+
+def reaction_types(text: str) -> List[str]:
+    """
+    Return the names of the reaction types mentioned in the text, in the order of REACTION_TYPES.
+    """
+    return [name for name, rx in _REACTION_RES.items() if rx.search(text)]
+
+def context_cues(text: str) -> List[str]:
+    """
+    Return the names of the tolerance and negation cues found in the text, in the order of CONTEXT_CUES.
+    """
+    return [name for name, rx in _CUE_RES.items() if rx.search(text)]
+
+def normalize_notes(text: str) -> str:
+    """
+    Normalize the clinical notes for the cache key: casefold and collapse the whitespace. Everything else is kept,
+    since the words and their order decide which substance is the allergen and which reaction goes with it.
+    """
+    return " ".join(text.casefold().split()) if text else ""
+
+def context_fingerprint(text: str, stored_notes: str = None) -> str:
+    """
+    Fingerprint of a patient context: a hash of the whole normalized notes of the request, already rewritten with the
+    standard ingredient names, plus a hash of the notes stored for the patient. The same allergies written with
+    different synonyms share the fingerprint; notes with a different meaning never do.
+
+    Parameters:
+    - text: the patient context, e.g. the clinical notes of the request.
+    - stored_notes: the notes stored for the patient, if any.
+
+    Returns:
+    - The hex digest of the fingerprint.
+    """
+    parts = [
+        "n:" + normalize_notes(text),
+        "p:" + (hashlib.sha1(stored_notes.encode("utf-8")).hexdigest() if stored_notes else ""),
+    ]
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+# Bounded LRU cache of the streamed answers of the model, with a time to live.
+# An entry keeps the message chunks in order, so a cached answer is replayed as the same stream
+class ResponseCache:
+    def __init__(self, max_size: int = 2048, ttl: float = 3600):
+        """
+        Initialize the cache.
+
+        Parameters:
+        - max_size: maximum number of answers kept in memory.
+        - ttl: seconds after which an answer is considered expired.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key) -> Optional[Tuple[List[str], Dict]]:
+        """
+        Return the cached (message chunks, usage) of the answer, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1]), dict(entry[2])
+
+    def put(self, key, chunks: List[str], usage: Dict = None):
+        """
+        Store a complete answer, evicting the least recently used one if the cache is full.
+        """
+        if not chunks:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, list(chunks), dict(usage or {}))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict:
+        """
+        Return the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions
+            }
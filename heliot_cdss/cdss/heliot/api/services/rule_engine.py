@@ -0,0 +1,155 @@
+import re
+from typing import Dict, List, Optional
+
+from ...ingredient_matcher import allergy_mentions, unresolved_allergy_spans
+from ...name_matcher import normalize_name, strip_hydrates
+from .response_cache import context_cues, reaction_types
+
+# Answer classes and reaction types of the enhanced check, as in SYSTEM_CHECK_ALLERGY_ENHANCED_STATIC_PROMPT
+NO_DOCUMENTED_REACTIONS = "NO DOCUMENTED REACTIONS OR INTOLERANCES"
+DIRECT_ACTIVE_INGREDIENT = "DIRECT ACTIVE INGREDIENT REACTIVITY"
+DIRECT_EXCIPIENT = "DIRECT EXCIPIENT REACTIVITY"
+
+NO_REACTION = "None"
+LIFE_THREATENING = "Life-threatening"
+IMMUNE_MEDIATED = "Non life-threatening immune-mediated"
+NON_IMMUNE_MEDIATED = "Non life-threatening non immune-mediated"
+
+# Reaction types of response_cache.REACTION_TYPES by severity
+LIFE_THREATENING_REACTIONS = {"anaphylaxis", "angioedema", "bronchospasm", "severe_cutaneous"}
+IMMUNE_MEDIATED_REACTIONS = {"urticaria", "rash", "pruritus"}
+NON_IMMUNE_MEDIATED_REACTIONS = {"gastrointestinal"}
+
+# Sentences stating that the patient has no allergies. "not allergic" is the patient information of a check without notes
+NO_ALLERGY_RE = re.compile(r"(?:(?:il |la )?paziente )?(?:nega allergie(?: note)?|non riferisce allergie(?: note)?|nessuna allergia(?: nota| riferita)?"
+                           r"|allergie:? nessuna|non (?:e |è )?allergic[oa]|nkda|no known (?:drug )?allergies|not allergic)")
+
+_SENTENCE_SPLIT_RE = re.compile(r"[.;\n]+")
+
+# Hedged or unconfirmed allergies, e.g. "sospetta allergia alla penicillina", are not documented reactions
+HEDGE_RE = re.compile(r"\b(?:sospett\w*|possibil\w*|probabil\w*|presunt\w*|dubbi\w*|forse|ipotizzat\w*|da (?:confermare|accertare|verificare|escludere)"
+                      r"|non (?:confermat\w*|accertat\w*|documentat\w*)|suspect\w*|possibl\w*|probabl\w*|presum\w*|unconfirmed)\b", re.IGNORECASE)
+
+def _key(name: str) -> str:
+    return strip_hydrates(normalize_name(name)) if isinstance(name, str) else ""
+
+# Deterministic answers of the enhanced check for the clear-cut cases: no documented allergies, and an allergen of the patient
+# that is an active ingredient or an excipient of the drug. Every other case returns None and is left to the model
+class AllergyRuleEngine:
+    def __init__(self, ont):
+        """
+        Parameters:
+        - ont: the SynonymManager used to find the ingredients in the patient information and to map the drug ingredients to their standard names.
+        """
+        self.ont = ont
+
+    def _has_no_allergies(self, patient_info: str) -> bool:
+        """
+        True if every sentence of the patient information states that there are no allergies.
+        """
+        sentences = [" ".join(s.casefold().split()).strip(" ,:") for s in _SENTENCE_SPLIT_RE.split(patient_info)]
+        sentences = [s for s in sentences if s]
+        return not sentences or all(NO_ALLERGY_RE.fullmatch(s) for s in sentences)
+
+    def _sentence(self, text: str, start: int, end: int):
+        """
+        Return the (start, end) offsets of the sentence of the text containing the span.
+        """
+        left = max(text.rfind(c, 0, start) for c in ".;\n") + 1
+        rights = [i for i in (text.find(c, end) for c in ".;\n") if i != -1]
+        return left, min(rights) if rights else len(text)
+
+    def _reaction_type(self, sentences: List[str]) -> Optional[str]:
+        """
+        Return the most severe reaction type mentioned in the sentences, or None if no reaction is described.
+        """
+        text = "\n".join(sentences)
+        reactions = set(reaction_types(text))
+        if reactions & LIFE_THREATENING_REACTIONS:
+            return LIFE_THREATENING
+        if reactions & IMMUNE_MEDIATED_REACTIONS:
+            return IMMUNE_MEDIATED
+        if reactions & NON_IMMUNE_MEDIATED_REACTIONS or "intolerance" in context_cues(text):
+            return NON_IMMUNE_MEDIATED
+        return None
+
+    def _drug_ingredients(self, names: List) -> Optional[Dict[str, str]]:
+        """
+        Map the normalized standard name, and the normalized name itself, of each drug ingredient to the name in the drug record.
+        The names are resolved by the exact or normalized lookup only; returns None if an ingredient is not resolved,
+        since it may be the allergen under another name.
+        """
+        names = [n for n in names or [] if isinstance(n, str) and n]
+        keys = {}
+        for name in names:
+            standard_name = self.ont.lookup_standard_name(name)
+            if standard_name is None:
+                return None
+            keys.setdefault(_key(standard_name), name)
+            keys.setdefault(_key(name), name)
+        keys.pop("", None)
+        return keys
+
+    def evaluate(self, drg: Dict, patient_info: str) -> Optional[Dict]:
+        """
+        Answer the enhanced check without the model if the case is clear-cut.
+
+        Parameters:
+        - drg: the drug record, with drug_name, composition and excipients.
+        - patient_info: the patient information of the prompt, with the ingredients already replaced by their standard names.
+
+        Returns:
+        - The answer as {"a", "r", "rt"}, or None if the case must be evaluated by the model.
+        """
+        if not drg:
+            return None
+        if self._has_no_allergies(patient_info or ""):
+            return {"a": "The patient has no documented allergies, reactions or intolerances.", "r": NO_DOCUMENTED_REACTIONS, "rt": NO_REACTION}
+
+        # Tolerance, negation, desensitization and hedged allergies change the answer: leave them to the model
+        if set(context_cues(patient_info)) - {"intolerance"} or HEDGE_RE.search(patient_info):
+            return None
+
+        matches = self.ont.find_ingredients(patient_info)
+        # An allergen not in the dictionary may be a drug class or a cross-reactive substance
+        if unresolved_allergy_spans(patient_info, matches):
+            return None
+        mentions = allergy_mentions(patient_info, matches)
+        if not mentions:
+            return None
+
+        active = self._drug_ingredients(drg.get('composition'))
+        excipients = self._drug_ingredients(drg.get('excipients'))
+        # An ingredient of the drug not in the dictionary cannot be compared with the allergens
+        if active is None or excipients is None:
+            return None
+        hits = {DIRECT_ACTIVE_INGREDIENT: [], DIRECT_EXCIPIENT: []}
+        for m in mentions:
+            key = _key(m.value)
+            if key in active:
+                hits[DIRECT_ACTIVE_INGREDIENT].append(m)
+            elif key in excipients:
+                hits[DIRECT_EXCIPIENT].append(m)
+
+        # Direct reactivity to an active ingredient is reported before the one to an excipient
+        response = DIRECT_ACTIVE_INGREDIENT if hits[DIRECT_ACTIVE_INGREDIENT] else DIRECT_EXCIPIENT
+        found = hits[response]
+        if not found:
+            return None
+
+        sentences = []
+        for m in found:
+            start, end = self._sentence(patient_info, m.start, m.end)
+            # With several allergens in the same sentence the reaction cannot be attributed
+            if len({_key(o.value) for o in mentions if start <= o.start and o.end <= end}) > 1:
+                return None
+            sentences.append(patient_info[start:end])
+
+        rt = self._reaction_type(sentences)
+        if rt is None:
+            return None
+
+        allergens = ", ".join(dict.fromkeys(m.value for m in found))
+        role = "an active ingredient" if response == DIRECT_ACTIVE_INGREDIENT else "an excipient"
+        return {"a": f"The patient has a documented reaction to {allergens}, which is {role} of {drg.get('drug_name', 'the prescribed drug')}.",
+                "r": response, "rt": rt}
@@ -0,0 +1,93 @@
+import threading
+from typing import Dict
+
+# Maximum number of tokens of the drug leaflet sections that can be very long
+DEFAULT_FIELD_BUDGETS = {
+    "contraindications": 1500,
+    "cross_reactivity_description": 800,
+}
+
+TRUNCATION_MARK = " [...]"
+
+# Average number of characters per token, used when the tokenizer is not available
+_CHARS_PER_TOKEN = 4
+
+_encoding = None
+_encoding_lock = threading.Lock()
+_encoding_loader = None
+
+def _load_encoding(name: str):
+    global _encoding
+    try:
+        import tiktoken
+        _encoding = tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"Unable to load the {name} encoding, token counts are estimated: {e}")
+
+def get_encoding(name: str = "o200k_base"):
+    """
+    Return the tiktoken encoding of the model (o200k_base for gpt-4o), or None while it is not available.
+    The first call starts loading it in a background thread, since tiktoken may download the encoding files:
+    until it is loaded, or if it cannot be loaded (e.g. offline), the token counts are estimated from the text length.
+    """
+    global _encoding_loader
+    if _encoding is None and _encoding_loader is None:
+        with _encoding_lock:
+            if _encoding_loader is None:
+                _encoding_loader = threading.Thread(target=_load_encoding, args=(name,), name="heliot-tiktoken", daemon=True)
+                _encoding_loader.start()
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """
+    Return the number of tokens of the text.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + _CHARS_PER_TOKEN - 1) // _CHARS_PER_TOKEN
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut the text to at most max_tokens tokens, marking the cut.
+
+    Parameters:
+    - text: the text to cut.
+    - max_tokens: the token budget of the text.
+
+    Returns:
+    - The text itself if it fits in the budget, otherwise its beginning followed by the truncation mark.
+    """
+    if not text or max_tokens is None:
+        return text
+    encoding = get_encoding()
+    if encoding is None:
+        max_chars = max_tokens * _CHARS_PER_TOKEN
+        if len(text) <= max_chars:
+            return text
+        cut = text[:max_chars]
+        # do not cut a word in half
+        space = cut.rfind(" ")
+        return (cut[:space] if space > max_chars // 2 else cut) + TRUNCATION_MARK
+
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + TRUNCATION_MARK
+
+def fit_drug_fields(drg: Dict, budgets: Dict = None) -> Dict:
+    """
+    Return a copy of the drug record with the long text fields cut to their token budget.
+
+    Parameters:
+    - drg: the drug record.
+    - budgets: maximum number of tokens of each field, DEFAULT_FIELD_BUDGETS if None.
+    """
+    budgets = DEFAULT_FIELD_BUDGETS if budgets is None else budgets
+    fitted = dict(drg)
+    for field, max_tokens in budgets.items():
+        if isinstance(fitted.get(field), str):
+            fitted[field] = truncate_to_tokens(fitted[field], max_tokens)
+    return fitted
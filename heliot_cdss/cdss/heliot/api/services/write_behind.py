@@ -0,0 +1,156 @@
+import atexit
+import threading
+import time
+from typing import Callable, Dict, List
+
+# Write-behind queue of the patient notes stored by the checks. The updates of many requests are written together by a
+# background thread, every flush_interval seconds or as soon as max_items are pending, so a check does not wait for the
+# database and each batch produces one fragment per array. The pending updates stay readable (read-your-writes) until written.
+# The queue holds at most max_pending updates: when it is full the request writes the queue itself, and the oldest updates
+# of a failed write are dropped (and logged) instead of growing the queue while the database is down
+class PatientWriteBehind:
+    def __init__(self, write_fn: Callable[[List[Dict]], bool], flush_interval: float = 0.2, max_items: int = 64,
+                 max_pending: int = 10000):
+        """
+        Initialize the queue and start the flushing thread.
+
+        Parameters:
+        - write_fn: writes a batch of updates, in arrival order, and returns True if they were stored. It is called from one thread at a time.
+        - flush_interval: maximum number of seconds an update waits before being written.
+        - max_items: number of pending updates that triggers a write without waiting for the interval.
+        - max_pending: maximum number of updates kept in the queue.
+        """
+        self.write_fn = write_fn
+        self.flush_interval = flush_interval
+        self.max_items = max_items
+        self.max_pending = max(max_pending, max_items)
+        self._pending = []
+        # Updates taken by the running write, still visible to pending() until they are stored
+        self._writing = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.sync_flushes = 0
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, name="heliot-write-behind", daemon=True)
+        self._thread.start()
+        # The pending updates are written also when the interpreter exits without a shutdown of the service
+        atexit.register(self.close)
+
+    def put(self, patient_id: str, clinical_notes: str, **fields) -> Dict:
+        """
+        Queue an update of the notes of a patient. If the queue is full, the pending updates are written before returning.
+
+        Parameters:
+        - patient_id: the patient.
+        - clinical_notes: the notes to store.
+        - fields: other fields of the update passed to write_fn, e.g. the allergen profile extracted from the notes.
+
+        Returns:
+        - The queued update, with the timestamp (ms) of the version.
+        """
+        update = dict(fields, patient_id=patient_id, clinical_notes=clinical_notes, timestamp=int(time.time() * 1000))
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The write-behind queue is closed")
+            self._pending.append(update)
+            self.enqueued += 1
+            full = len(self._pending) + len(self._writing) >= self.max_pending
+            if full:
+                self.sync_flushes += 1
+            else:
+                self._cond.notify()
+        if full:
+            # Write in the request, after the running write, so a slow database slows down the checks instead of filling the memory
+            self.flush()
+        return update
+
+    def pending(self, patient_id: str) -> List[Dict]:
+        """
+        Return the updates of a patient not yet stored, in arrival order.
+        """
+        with self._cond:
+            return [u for u in self._writing + self._pending if u['patient_id'] == patient_id]
+
+    def flush(self) -> bool:
+        """
+        Write all the pending updates now. The updates of a failed write are queued again before the newer ones,
+        dropping the oldest ones beyond max_pending.
+
+        Returns:
+        - True if there was nothing to write or the write succeeded.
+        """
+        with self._flush_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                self._writing = batch
+            if not batch:
+                return True
+
+            try:
+                stored = self.write_fn(batch)
+            except Exception as e:
+                print(f"Error writing {len(batch)} patient updates: {e}")
+                stored = False
+
+            with self._cond:
+                self._writing = []
+                self.batches += 1
+                if stored:
+                    self.written += len(batch)
+                else:
+                    self.failures += 1
+                    self._pending = batch + self._pending
+                    overflow = len(self._pending) - self.max_pending
+                    if overflow > 0:
+                        dropped, self._pending = self._pending[:overflow], self._pending[overflow:]
+                        self.dropped += len(dropped)
+                        print(f"Dropped {len(dropped)} patient updates, the write-behind queue is full ({self.max_pending}): "
+                              f"{', '.join(sorted({u['patient_id'] for u in dropped}))}")
+            return stored
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Wait for max_items updates, or for flush_interval seconds after the oldest one
+                while not self._closed and len(self._pending) < self.max_items:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    remaining = self._pending[0]['timestamp'] / 1000 + self.flush_interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+            if not self.flush():
+                # Do not retry a failing database in a busy loop
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        """
+        Stop the flushing thread and write the pending updates. Calling it again has no effect.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        if not self.flush():
+            print(f"{len(self._pending)} patient updates could not be written")
+
+    def stats(self) -> Dict:
+        """
+        Return the number of pending updates and the counters of the queue.
+        """
+        with self._cond:
+            return {"pending": len(self._pending) + len(self._writing), "enqueued": self.enqueued, "written": self.written,
+                    "batches": self.batches, "failures": self.failures, "max_pending": self.max_pending,
+                    "sync_flushes": self.sync_flushes, "dropped": self.dropped}
@@ -2,19 +2,270 @@ import tiledb
 import pandas as pd
 import time
 from itertools import product
-import gc
 from unidecode import unidecode
 import numpy as np
 from typing import List, Dict
 import traceback
+import json
+import ast
+import os
+
+# Structured cross-reactivity of each drug, parsed from the cross_reactivity dictionary when the drugs are loaded.
+# cross_sensitive_drugs is stored '#' separated, as composition and excipients in the csv file, and read as a list
+CROSS_REACTIVITY_ATTRIBUTES = ["cross_reactivity_description", "cross_reactivity_incidence", "cross_sensitive_drugs"]
+
+# Descriptive attributes stored for each drug
+DRUG_ATTRIBUTES = ["drug_name", "drug_form", "therapeutic_indications", "posology", "cross_reactivity", "contraindications", "special_warnings", "drug_interactions", "pregnancy_info", "driving_effects", "side_effects", "over_dose", "incompatibilities", "leaflet"] + CROSS_REACTIVITY_ATTRIBUTES
+
+def parse_cross_reactivity(value) -> Dict:
+    """
+    Parse the cross-reactivity extracted from the leaflet, written as JSON or, by older pipelines, as the str() of a Python dict.
+
+    Parameters:
+    - value: the cross_reactivity value, e.g. {"description": "...", "incidence": "rare", "da": "amoxicillin", "cross_sensitive_drugs": [{"ai": "ampicillin"}]}.
+
+    Returns:
+    - Dict with cross_reactivity_description, cross_reactivity_incidence and cross_sensitive_drugs (a list of names).
+      A value that is not a dictionary is kept as the description.
+    """
+    result = {"cross_reactivity_description": "", "cross_reactivity_incidence": "", "cross_sensitive_drugs": []}
+    data = value
+    if isinstance(value, str):
+        if not value.strip():
+            return result
+        try:
+            data = json.loads(value, strict=False)
+        except ValueError:
+            try:
+                data = ast.literal_eval(value)
+            except (ValueError, SyntaxError, MemoryError, RecursionError):
+                data = value
+    if not isinstance(data, dict):
+        result["cross_reactivity_description"] = data.strip() if isinstance(data, str) else ""
+        return result
+
+    drugs = []
+    for drug in data.get("cross_sensitive_drugs") or []:
+        name = drug.get("ai") if isinstance(drug, dict) else drug
+        if isinstance(name, str) and name.strip():
+            drugs.append(name.replace("#", " ").strip())
+    result["cross_reactivity_description"] = str(data.get("description") or "").strip()
+    result["cross_reactivity_incidence"] = str(data.get("incidence") or "").strip()
+    result["cross_sensitive_drugs"] = list(dict.fromkeys(drugs))
+    return result
+
+# Attributes never compressed, even when compress_attrs is set
+UNCOMPRESSED_ATTRIBUTES = ["drug_name", "drug_form", "leaflet"]
+
+# Inverted index of the drugs database, stored as memory-mapped NumPy sidecar files in a directory:
+# - drug_codes.npy: sorted drug codes. The position of a code is its integer drug id
+# - <field>_terms.npy: sorted normalized terms (compositions, excipients or cross-sensitive drugs)
+# - <field>_offsets.npy, <field>_postings.npy: the sorted drug ids of terms[i] are postings[offsets[i]:offsets[i+1]]
+# - atc_keys.npy, atc_drug_ids.npy: the ATC code of each drug sorted by ATC, with the aligned drug ids,
+#   for exact, prefix and range lookups at any ATC level
+# - meta.json: the database version (last fragment timestamp) the index was built from
+class DrugIndex:
+    FIELDS = ["composition", "excipients", "cross_sensitive_drugs"]
+
+    def __init__(self, index_uri: str):
+        self.index_uri = index_uri
+        with open(os.path.join(index_uri, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.version = self.meta["version"]
+        self.drug_codes = np.load(os.path.join(index_uri, "drug_codes.npy"), mmap_mode="r")
+        self.terms = {}
+        self.offsets = {}
+        self.postings = {}
+        for field in self.meta["fields"]:
+            self.terms[field] = np.load(os.path.join(index_uri, f"{field}_terms.npy"), mmap_mode="r")
+            self.offsets[field] = np.load(os.path.join(index_uri, f"{field}_offsets.npy"), mmap_mode="r")
+            self.postings[field] = np.load(os.path.join(index_uri, f"{field}_postings.npy"), mmap_mode="r")
+        self.atc_keys = np.load(os.path.join(index_uri, "atc_keys.npy"), mmap_mode="r")
+        self.atc_drug_ids = np.load(os.path.join(index_uri, "atc_drug_ids.npy"), mmap_mode="r")
+
+    @staticmethod
+    def build(index_uri: str, links: Dict[str, pd.DataFrame], atc: pd.DataFrame, version: int):
+        """
+        Build the index files.
+
+        Parameters:
+        - index_uri: directory of the index.
+        - links: field -> DataFrame with the drug_code and field columns.
+        - atc: DataFrame with the drug_code and atc columns.
+        - version: version of the database the links were read from.
+        """
+        os.makedirs(index_uri, exist_ok=True)
+        drug_codes = np.unique(np.concatenate([df["drug_code"].to_numpy(dtype=str) for df in list(links.values()) + [atc]]))
+        np.save(os.path.join(index_uri, "drug_codes.npy"), drug_codes)
+
+        atc = atc[["drug_code", "atc"]].drop_duplicates("drug_code")
+        atc_keys = atc["atc"].to_numpy(dtype=str)
+        atc_drug_ids = np.searchsorted(drug_codes, atc["drug_code"].to_numpy(dtype=str)).astype(np.int32)
+        order = np.argsort(atc_keys, kind="stable")
+        np.save(os.path.join(index_uri, "atc_keys.npy"), atc_keys[order])
+        np.save(os.path.join(index_uri, "atc_drug_ids.npy"), atc_drug_ids[order])
+
+        for field, df in links.items():
+            df = df[["drug_code", field]].drop_duplicates()
+            terms, term_ids = np.unique(df[field].to_numpy(dtype=str), return_inverse=True)
+            drug_ids = np.searchsorted(drug_codes, df["drug_code"].to_numpy(dtype=str)).astype(np.int32)
+
+            # Sort by term and then by drug id, so that each posting list is sorted
+            order = np.lexsort((drug_ids, term_ids))
+            offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum(np.bincount(term_ids, minlength=len(terms)))
+
+            np.save(os.path.join(index_uri, f"{field}_terms.npy"), terms)
+            np.save(os.path.join(index_uri, f"{field}_offsets.npy"), offsets)
+            np.save(os.path.join(index_uri, f"{field}_postings.npy"), drug_ids[order])
+
+        # meta.json is written last: an index without it is incomplete
+        with open(os.path.join(index_uri, "meta.json"), "w") as f:
+            json.dump({"version": int(version), "fields": list(links.keys()), "built_at": time.time()}, f)
+
+    def drug_ids(self, field: str, term: str) -> np.ndarray:
+        """
+        Return the sorted drug ids of the given term, empty if the term is unknown.
+        """
+        terms = self.terms[field]
+        i = np.searchsorted(terms, term)
+        if i < len(terms) and terms[i] == term:
+            return self.postings[field][self.offsets[field][i]:self.offsets[field][i + 1]]
+        return np.empty(0, dtype=np.int32)
+
+    def drug_ids_all_of(self, field: str, terms: List) -> np.ndarray:
+        """
+        Return the sorted ids of the drugs linked to all the given terms.
+        """
+        result = None
+        for term in terms:
+            ids = self.drug_ids(field, term)
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+            if len(result) == 0:
+                break
+        return np.empty(0, dtype=np.int32) if result is None else result
+
+    def drug_ids_any_of(self, field: str, terms: List) -> np.ndarray:
+        """
+        Return the sorted ids of the drugs linked to at least one of the given terms.
+        """
+        if not terms:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate([self.drug_ids(field, term) for term in terms]))
+
+    def drug_ids_by_atc_range(self, start: str, end: str) -> np.ndarray:
+        """
+        Return the sorted ids of the drugs whose ATC code is in [start, end).
+        """
+        lo = np.searchsorted(self.atc_keys, start, side="left")
+        hi = np.searchsorted(self.atc_keys, end, side="left")
+        return np.sort(self.atc_drug_ids[lo:hi])
+
+    def drug_ids_by_atc(self, atc_code: str, prefix: bool = False) -> np.ndarray:
+        """
+        Return the sorted ids of the drugs with the given ATC code or, if prefix is set, with an ATC code starting with it
+        (e.g. 'J01C' for all the beta-lactam antibacterials, penicillins).
+        """
+        if prefix:
+            # chr(0x10FFFF) is greater than any character of an ATC code
+            return self.drug_ids_by_atc_range(atc_code, atc_code + chr(0x10FFFF))
+        lo = np.searchsorted(self.atc_keys, atc_code, side="left")
+        hi = np.searchsorted(self.atc_keys, atc_code, side="right")
+        return np.sort(self.atc_drug_ids[lo:hi])
+
+    def codes(self, drug_ids: np.ndarray) -> List:
+        """
+        Convert drug ids to drug codes.
+        """
+        return [str(code) for code in self.drug_codes[drug_ids]]
+
 
 class DatabaseManagement:
-    def __init__(self, db_uri="drugs_db", store_lower_case=False, compress_attrs=False, tiles=None):
+    def __init__(self, db_uri="drugs_db", store_lower_case=False, compress_attrs=False, tiles=None, normalized=False, handles=None, index_uri=None):
         self.db_uri = db_uri
         self.store_lower_case = store_lower_case
         self.compress_attrs = compress_attrs
         self.tiles = tiles
 
+        # Optional TileDBHandleManager keeping the read handles open across calls.
+        # Without it, every call opens and closes the array
+        self.handles = handles
+        self.ctx = handles.ctx if handles is not None else None
+
+        # Sidecar directory of the drug index, see build_drug_index
+        self.index_uri = index_uri if index_uri else f"{db_uri}_index"
+        self._index = None
+
+        # With the normalized layout db_uri is a TileDB group holding three arrays:
+        # - drugs: one cell per drug_code with atc and all the descriptive attributes
+        # - composition: one cell per (drug_code, composition) link
+        # - excipients: one cell per (drug_code, excipients) link
+        # instead of a single array with a cell for each (composition, excipient) pair
+        self.normalized = normalized
+        self.drugs_uri = f"{db_uri}/drugs"
+        self.composition_uri = f"{db_uri}/composition"
+        self.excipients_uri = f"{db_uri}/excipients"
+
+        # Attributes of the schema of each array, to read databases created before an attribute was added
+        self._schema_attributes = {}
+
+
+    # Open the array in write or delete mode
+    def _write(self, uri: str, mode: str = "w"):
+        if self.handles is not None:
+            return self.handles.write(uri, mode=mode)
+        return tiledb.open(uri, mode=mode)
+
+    # Run a read on the array: on the shared handle, reopened and retried once if it fails, or on a newly opened array
+    def _query(self, uri: str, fn):
+        if self.handles is not None:
+            return self.handles.query(uri, fn)
+        with tiledb.open(uri, mode="r") as array:
+            return fn(array)
+
+    # Names of the attributes of the array
+    def _attributes(self, uri: str) -> set:
+        if uri not in self._schema_attributes:
+            self._schema_attributes[uri] = self._query(uri, lambda array: {array.schema.attr(i).name for i in range(array.schema.nattr)})
+        return self._schema_attributes[uri]
+
+    # Attributes to read from the array for the requested ones. Databases created before the structured cross-reactivity
+    # do not have its attributes: cross_reactivity is read instead, and parsed by _structure_cross_reactivity
+    def _projection(self, uri: str, attrs: List) -> List:
+        available = self._attributes(uri)
+        projection = [a for a in attrs if a in available]
+        if any(a not in available for a in CROSS_REACTIVITY_ATTRIBUTES if a in attrs) and "cross_reactivity" not in projection:
+            projection.append("cross_reactivity")
+        return projection
+
+    # Set the structured cross-reactivity of a drug read from the database: cross_sensitive_drugs becomes a list,
+    # and the attributes missing in older databases are parsed from cross_reactivity
+    def _structure_cross_reactivity(self, drug_info: Dict) -> Dict:
+        if "cross_reactivity" in drug_info and any(a not in drug_info for a in CROSS_REACTIVITY_ATTRIBUTES):
+            parsed = parse_cross_reactivity(drug_info["cross_reactivity"])
+            parsed["cross_sensitive_drugs"] = "#".join(self._encode_terms(parsed["cross_sensitive_drugs"]))
+            for key, value in parsed.items():
+                drug_info.setdefault(key, value)
+        if isinstance(drug_info.get("cross_sensitive_drugs"), str):
+            drug_info["cross_sensitive_drugs"] = [d for d in drug_info["cross_sensitive_drugs"].split("#") if d]
+        return drug_info
+
+    # Convert the names to ascii, lower case if required, as the compositions are stored
+    def _encode_terms(self, names: List) -> List:
+        names = [self.utf8_to_ascii_unidecode(name).strip() for name in names]
+        if self.store_lower_case:
+            names = [self.to_lower_case(name) for name in names]
+        return list(dict.fromkeys(name for name in names if name))
+
+    # Add the structured cross-reactivity columns parsed from the cross_reactivity column, if they are not in the frame.
+    # It runs before the texts are lower cased, which would turn None into an invalid Python literal
+    def _add_cross_reactivity_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        if all(a in df.columns for a in CROSS_REACTIVITY_ATTRIBUTES) or "cross_reactivity" not in df.columns:
+            return df
+        parsed = [parse_cross_reactivity(value) if isinstance(value, str) else parse_cross_reactivity("") for value in df["cross_reactivity"]]
+        return df.assign(cross_reactivity_description=[p["cross_reactivity_description"] for p in parsed],
+                         cross_reactivity_incidence=[p["cross_reactivity_incidence"] for p in parsed],
+                         cross_sensitive_drugs=["#".join(self._encode_terms(p["cross_sensitive_drugs"])) for p in parsed])
 
     # Transform the potential utf-8 text into ascii unidecode
     def utf8_to_ascii_unidecode(self, text:str) -> str:
@@ -24,7 +275,21 @@ class DatabaseManagement:
     def clean_text(self, text:str) -> str:
         return text.replace('\xa0', ' ').strip()
 
+    # Build the descriptive attributes, compressing the large texts if required
+    def _drug_attrs(self) -> List:
+        attrs = []
+        for name in DRUG_ATTRIBUTES:
+            if self.compress_attrs and name not in UNCOMPRESSED_ATTRIBUTES:
+                attrs.append(tiledb.Attr(name=name, dtype=str, filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])))
+            else:
+                attrs.append(tiledb.Attr(name=name, dtype=str))
+        return attrs
+
     def create_DBSchema(self):
+        if self.normalized:
+            self.create_normalized_DBSchema()
+            return
+
         # TileDB dimensions. Note: dimensions cannot have dtype=str, it is unsupported.
         drug_code_dim = tiledb.Dim(name="drug_code", tile=self.tiles, dtype="ascii")
         atc_dim = tiledb.Dim(name="atc", tile=self.tiles, dtype="ascii") 
@@ -34,41 +299,7 @@ class DatabaseManagement:
         # Create the tileDB domain 
         domain = tiledb.Domain(drug_code_dim, atc_dim, composition_dim, excipients_dim)
 
-        if self.compress_attrs:
-            attrs = [
-                tiledb.Attr(name="drug_name", dtype=str),
-                tiledb.Attr(name="drug_form", dtype=str),
-                tiledb.Attr(name="therapeutic_indications", dtype=str, filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="posology", dtype=str,filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="cross_reactivity", dtype=str, filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="contraindications", dtype=str,filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="special_warnings", dtype=str, filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="drug_interactions", dtype=str, filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="pregnancy_info", dtype=str, filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="driving_effects", dtype=str,filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="side_effects", dtype=str,filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="over_dose", dtype=str,filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="incompatibilities", dtype=str,filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)])),
-                tiledb.Attr(name="leaflet", dtype=str)
-            ]
-        else:
-            # Attribute definition
-            attrs = [
-                tiledb.Attr(name="drug_name", dtype=str),
-                tiledb.Attr(name="drug_form", dtype=str),
-                tiledb.Attr(name="therapeutic_indications", dtype=str),
-                tiledb.Attr(name="posology", dtype=str),
-                tiledb.Attr(name="cross_reactivity", dtype=str),
-                tiledb.Attr(name="contraindications", dtype=str),
-                tiledb.Attr(name="special_warnings", dtype=str),
-                tiledb.Attr(name="drug_interactions", dtype=str),
-                tiledb.Attr(name="pregnancy_info", dtype=str),
-                tiledb.Attr(name="driving_effects", dtype=str),
-                tiledb.Attr(name="side_effects", dtype=str),
-                tiledb.Attr(name="over_dose", dtype=str),
-                tiledb.Attr(name="incompatibilities", dtype=str),
-                tiledb.Attr(name="leaflet", dtype=str)
-            ]
+        attrs = self._drug_attrs()
 
         # Create the array schema
         schema = tiledb.ArraySchema(
@@ -80,6 +311,220 @@ class DatabaseManagement:
         # Create the tileDB array
         tiledb.Array.create(self.db_uri, schema)
 
+    # Create the normalized layout: a group with the drugs array and the composition/excipients link arrays
+    def create_normalized_DBSchema(self):
+        tiledb.group_create(self.db_uri)
+
+        # Drug attributes, one cell per drug. The atc is an attribute because drug_code is already unique
+        drugs_schema = tiledb.ArraySchema(
+            domain=tiledb.Domain(tiledb.Dim(name="drug_code", tile=self.tiles, dtype="ascii")),
+            attrs=[tiledb.Attr(name="atc", dtype=str)] + self._drug_attrs(),
+            sparse=True
+        )
+        tiledb.Array.create(self.drugs_uri, drugs_schema)
+
+        # Link arrays. The position attribute keeps the original order of the ingredients in the drug
+        for uri, name in [(self.composition_uri, "composition"), (self.excipients_uri, "excipients")]:
+            link_schema = tiledb.ArraySchema(
+                domain=tiledb.Domain(tiledb.Dim(name="drug_code", tile=self.tiles, dtype="ascii"),
+                                     tiledb.Dim(name=name, tile=self.tiles, dtype="ascii")),
+                attrs=[tiledb.Attr(name="position", dtype=np.uint32)],
+                sparse=True
+            )
+            tiledb.Array.create(uri, link_schema)
+
+        with tiledb.Group(self.db_uri, mode="w") as group:
+            group.add("drugs", name="drugs", relative=True)
+            group.add("composition", name="composition", relative=True)
+            group.add("excipients", name="excipients", relative=True)
+
+    # Write drug rows (drug_code, atc, attributes) and link rows (drug_code, composition|excipients) into the normalized layout
+    def _write_normalized(self, drugs_df: pd.DataFrame, composition_df: pd.DataFrame, excipients_df: pd.DataFrame):
+        if not drugs_df.empty:
+            with self._write(self.drugs_uri) as array:
+                # Databases created before the structured cross-reactivity do not have its attributes
+                array[drugs_df["drug_code"].to_numpy(dtype=object)] = {k: drugs_df[k].to_numpy(dtype=object) for k in ["atc"] + DRUG_ATTRIBUTES if array.schema.has_attr(k)}
+
+        for uri, name, links in [(self.composition_uri, "composition", composition_df), (self.excipients_uri, "excipients", excipients_df)]:
+            if links.empty:
+                continue
+            if "position" not in links:
+                links = links.assign(position=links.groupby("drug_code").cumcount())
+            with self._write(uri) as array:
+                array[links["drug_code"].to_numpy(dtype=object), links[name].to_numpy(dtype=object)] = {"position": links["position"].to_numpy(dtype=np.uint32)}
+
+    # Read the link rows of the given drug codes (all of them if drug_codes is None)
+    def _read_links(self, uri: str, name: str, drug_codes: List = None) -> pd.DataFrame:
+        data = self._query(uri, lambda array: array.df[:] if drug_codes is None else array.df[list(drug_codes)])
+        return data.sort_values(["drug_code", "position"])[["drug_code", name]]
+
+    # Assemble the drug dictionaries from the normalized arrays, keeping the same shape of the cartesian layout
+    def _assemble_normalized(self, drugs_df: pd.DataFrame, composition_df: pd.DataFrame, excipients_df: pd.DataFrame) -> List[Dict]:
+        compositions = composition_df.groupby("drug_code")["composition"].agg(list)
+        excipients = excipients_df.groupby("drug_code")["excipients"].agg(list)
+
+        result = []
+        for drug_info in drugs_df.to_dict("records"):
+            drug_code = drug_info["drug_code"]
+            drug_info["composition"] = compositions.get(drug_code, [])
+            drug_info["excipients"] = excipients.get(drug_code, [])
+            result.append(self._structure_cross_reactivity(drug_info))
+        return result
+
+    # Read the drug rows and the links of the given drug codes from the normalized layout. attrs=None reads all the attributes
+    def _read_normalized(self, drug_codes: List, attrs: List = None):
+        drugs_df = self._query(self.drugs_uri, lambda array: array.query(attrs=self._projection(self.drugs_uri, attrs)).df[list(drug_codes)] if attrs is not None else array.df[list(drug_codes)])
+        codes = drugs_df["drug_code"].tolist()
+        if not codes:
+            return drugs_df, pd.DataFrame(columns=["drug_code", "composition"]), pd.DataFrame(columns=["drug_code", "excipients"])
+        return (drugs_df,
+                self._read_links(self.composition_uri, "composition", codes),
+                self._read_links(self.excipients_uri, "excipients", codes))
+
+    # Read and assemble the given drug codes from the normalized layout, reading only attrs if given
+    def _search_drugs_normalized(self, drug_codes: List, attrs: List = None) -> List[Dict]:
+        drugs_df, composition_df, excipients_df = self._read_normalized(drug_codes, ["atc"] + list(attrs) if attrs is not None else None)
+        if drugs_df.empty:
+            return []
+        return self._assemble_normalized(drugs_df, composition_df, excipients_df)
+
+    # Build the (composition, excipients) rows of the given drugs, as the cartesian layout would return them.
+    # If compositions is given, only the matching composition rows are kept
+    def _cartesian_rows_normalized(self, drug_codes: List, compositions: List = None) -> pd.DataFrame:
+        columns = ["drug_code", "atc", "composition", "excipients", "drug_name"]
+        if len(drug_codes) == 0:
+            return pd.DataFrame(columns=columns)
+        composition_df = self._read_links(self.composition_uri, "composition", drug_codes)
+        if compositions is not None:
+            composition_df = composition_df[composition_df["composition"].isin(compositions)]
+        excipients_df = self._read_links(self.excipients_uri, "excipients", drug_codes)
+        drugs_df = self._query(self.drugs_uri, lambda array: array.query(attrs=["atc", "drug_name"]).df[list(drug_codes)])
+        rows = composition_df.merge(excipients_df, on="drug_code").merge(drugs_df, on="drug_code")
+        return rows[columns]
+
+    # Find the drug codes linked to at least one of the given compositions
+    def _drug_codes_by_composition_normalized(self, compositions: List) -> List:
+        data = self._query(self.composition_uri, lambda array: array.query(attrs=[]).df[:, list(compositions)])
+        return data["drug_code"].unique().tolist()
+
+    # Split the '#' separated cross_sensitive_drugs of each drug into one (drug_code, cross_sensitive_drugs) row per drug name
+    def _cross_sensitive_links(self, drugs_df: pd.DataFrame) -> pd.DataFrame:
+        drugs_df = drugs_df.drop_duplicates("drug_code")
+        links = drugs_df[["drug_code"]].assign(cross_sensitive_drugs=drugs_df["cross_sensitive_drugs"].fillna("").str.split("#")).explode("cross_sensitive_drugs")
+        links["cross_sensitive_drugs"] = links["cross_sensitive_drugs"].fillna("").str.strip()
+        return links[links["cross_sensitive_drugs"] != ""].drop_duplicates()
+
+    # Read the (drug_code, cross_sensitive_drugs) pairs of all the drugs, None if the database was created before the structured cross-reactivity
+    def _read_cross_sensitive_links(self):
+        uri = self.drugs_uri if self.normalized else self.db_uri
+        if "cross_sensitive_drugs" not in self._attributes(uri):
+            return None
+        data = self._query(uri, lambda array: array.query(attrs=["cross_sensitive_drugs"], dims=["drug_code"]).df[:])
+        return self._cross_sensitive_links(data)
+
+    # Read the (drug_code, composition), (drug_code, excipients), (drug_code, cross_sensitive_drugs) and (drug_code, atc) pairs of all the drugs
+    def read_index_links(self) -> Dict[str, pd.DataFrame]:
+        if self.normalized:
+            atc = self._query(self.drugs_uri, lambda array: array.query(attrs=["atc"]).df[:])
+            links = {"composition": self._read_links(self.composition_uri, "composition"),
+                     "excipients": self._read_links(self.excipients_uri, "excipients"),
+                     "atc": atc}
+        else:
+            coords = self._query(self.db_uri, lambda array: array.query(attrs=[]).df[:])
+            links = {"composition": coords[["drug_code", "composition"]].drop_duplicates(),
+                     "excipients": coords[["drug_code", "excipients"]].drop_duplicates(),
+                     "atc": coords[["drug_code", "atc"]].drop_duplicates()}
+        cross_sensitive = self._read_cross_sensitive_links()
+        if cross_sensitive is not None:
+            links["cross_sensitive_drugs"] = cross_sensitive
+        return links
+
+    # Find the codes of the drugs that are cross-sensitive to at least one of the given active ingredients, e.g. the allergens of a patient,
+    # according to the cross-reactivity of their leaflets
+    def find_drug_codes_cross_sensitive_to(self, ingredients: List) -> List:
+        terms = self._encode_terms(ingredients)
+        if not terms:
+            return []
+        index = self.get_drug_index()
+        if index is not None and "cross_sensitive_drugs" in index.terms:
+            return index.codes(index.drug_ids_any_of("cross_sensitive_drugs", terms))
+
+        # No index available: scan the cross-sensitive drugs of all the drugs
+        links = self._read_cross_sensitive_links()
+        if links is None:
+            return []
+        return sorted(links.loc[links["cross_sensitive_drugs"].isin(terms), "drug_code"].unique().tolist())
+
+    # Build the drug index (composition -> drug codes, excipient -> drug codes, cross-sensitive drug -> drug codes, sorted ATC -> drug codes) in index_uri
+    def build_drug_index(self):
+        start_time = time.time()  # Start measurement time
+        version = self.last_fragment_timestamp()
+        links = self.read_index_links()
+        atc = links.pop("atc")
+        DrugIndex.build(self.index_uri, links, atc, version)
+        self._index = None
+        end_time = time.time()  # End duration masurement
+        print(f"Execution time for the index creation: {end_time - start_time:.2f} seconds")
+
+    # Return the drug index if it exists and it is up to date with the database, None otherwise
+    def get_drug_index(self):
+        if not os.path.exists(os.path.join(self.index_uri, "meta.json")):
+            return None
+        version = self.last_fragment_timestamp()
+        if self._index is None or self._index.version != version:
+            try:
+                index = DrugIndex(self.index_uri)
+            except Exception as e:
+                print(f"Unable to load the index {self.index_uri}: {e}")
+                return None
+            if index.version != version:
+                print(f"Index {self.index_uri} is out of date, rebuild it with build_drug_index")
+                return None
+            self._index = index
+        return self._index
+
+    # Migrate the old cartesian drugs_db into the normalized layout. The drug attributes are read batch_size drugs at a time
+    def migrate_to_normalized(self, source_uri="drugs_db", batch_size=500):
+        if not self.normalized:
+            raise ValueError("migrate_to_normalized requires a DatabaseManagement with normalized=True")
+
+        start_time = time.time()  # Start measurement time
+        if tiledb.object_type(self.db_uri) is None:
+            self.create_normalized_DBSchema()
+
+        with tiledb.open(source_uri, mode="r") as array:
+            # A source created before the structured cross-reactivity has only cross_reactivity, parsed during the migration
+            source_attrs = [a for a in DRUG_ATTRIBUTES if array.schema.has_attr(a)]
+
+            # Read only the dimensions to rebuild the links
+            coords = array.query(attrs=[]).df[:]
+            composition_df = coords[["drug_code", "composition"]].drop_duplicates().sort_values(["drug_code", "composition"])
+            excipients_df = coords[["drug_code", "excipients"]].drop_duplicates().sort_values(["drug_code", "excipients"])
+            self._write_normalized(pd.DataFrame(), composition_df, excipients_df)
+
+            drug_codes = coords["drug_code"].drop_duplicates().tolist()
+            del coords
+            print(f"Migrating {len(drug_codes)} drugs from {source_uri} to {self.db_uri}")
+
+            for i in range(0, len(drug_codes), batch_size):
+                batch = drug_codes[i:i + batch_size]
+                data = array.query(attrs=source_attrs).df[batch]
+                drugs_df = self._add_cross_reactivity_columns(data.drop_duplicates("drug_code"))[["drug_code", "atc"] + DRUG_ATTRIBUTES]
+                self._write_normalized(drugs_df, pd.DataFrame(), pd.DataFrame())
+                print(f"Migrated drugs {min(i + batch_size, len(drug_codes))} out of {len(drug_codes)}")
+
+        end_time = time.time()  # End duration masurement
+        print(f"Execution time for the migration: {end_time - start_time:.2f} seconds")
+
+    # Timestamp (ms) of the most recent fragment of the database, used to detect changes
+    def last_fragment_timestamp(self) -> int:
+        uris = [self.drugs_uri, self.composition_uri, self.excipients_uri] if self.normalized else [self.db_uri]
+        last = 0
+        for uri in uris:
+            for _, end in tiledb.array_fragments(uri, ctx=self.ctx).timestamp_range:
+                last = max(last, end)
+        return last
+
     def to_lower_case(self, value):
         return value.lower() if isinstance(value, str) else value
 
@@ -101,12 +546,23 @@ class DatabaseManagement:
             "side_effects": str,
             "over_dose": str,
             "incompatibilities": str,
-            "leaflet": str
+            "leaflet": str,
+            "cross_reactivity_description": str,
+            "cross_reactivity_incidence": str,
+            "cross_sensitive_drugs": str
         }
         data = {key: [] for key in dtype_dict.keys() if key != "composition" and key != "excipients"}
         data["composition"] = []
         data["excipients"] = []
 
+        # Structured cross-reactivity, parsed before the texts are lower cased
+        if not isinstance(cross_reactivity, str):
+            cross_reactivity = json.dumps(cross_reactivity, ensure_ascii=False) if cross_reactivity is not None else ""
+        cross = parse_cross_reactivity(cross_reactivity)
+        cross_reactivity_description = cross["cross_reactivity_description"]
+        cross_reactivity_incidence = cross["cross_reactivity_incidence"]
+        cross_sensitive_drugs = "#".join(self._encode_terms(cross["cross_sensitive_drugs"]))
+
         if self.store_lower_case:
             composition = [self.to_lower_case(comp) for comp in composition]
             excipients = [self.to_lower_case(exc) for exc in excipients]
@@ -125,6 +581,18 @@ class DatabaseManagement:
             over_dose = self.to_lower_case(over_dose)
             incompatibilities = self.to_lower_case(incompatibilities)
             leaflet = self.to_lower_case(leaflet)
+            cross_reactivity_description = self.to_lower_case(cross_reactivity_description)
+            cross_reactivity_incidence = self.to_lower_case(cross_reactivity_incidence)
+
+        if self.normalized:
+            values = [drug_name, drug_form, therapeutic_indications, posology, cross_reactivity, contraindications, special_warnings, drug_interactions, pregnancy_info, driving_effects, side_effects, over_dose, incompatibilities, leaflet,
+                      cross_reactivity_description, cross_reactivity_incidence, cross_sensitive_drugs]
+            drugs_df = pd.DataFrame([dict(zip(["drug_code", "atc"] + DRUG_ATTRIBUTES, [drug_code, atc] + values))])
+            # Remove duplicated ingredients preserving their order
+            composition_df = pd.DataFrame({"drug_code": drug_code, "composition": list(dict.fromkeys(composition))})
+            excipients_df = pd.DataFrame({"drug_code": drug_code, "excipients": list(dict.fromkeys(excipients))})
+            self._write_normalized(drugs_df, composition_df, excipients_df)
+            return True
 
         product_list = list(product(composition, excipients))
         data["drug_code"].extend([drug_code] * len(product_list))
@@ -145,6 +613,9 @@ class DatabaseManagement:
         data["over_dose"].extend([over_dose] * len(product_list))
         data["incompatibilities"].extend([incompatibilities] * len(product_list))
         data["leaflet"].extend([leaflet] * len(product_list))
+        data["cross_reactivity_description"].extend([cross_reactivity_description] * len(product_list))
+        data["cross_reactivity_incidence"].extend([cross_reactivity_incidence] * len(product_list))
+        data["cross_sensitive_drugs"].extend([cross_sensitive_drugs] * len(product_list))
         unique_data = {}
         for j in range(len(data["drug_code"])):
             key = (data["drug_code"][j], data["atc"][j], data["composition"][j], data["excipients"][j])
@@ -175,167 +646,159 @@ class DatabaseManagement:
         attr_length = len(next(iter(formatted_data.values())))
         print(f"Coord length: {coord_length}, Attr length: {attr_length}")
         result = True
-        with tiledb.open(self.db_uri, mode="w") as array:
+        with self._write(self.db_uri) as array:
             # Sanity check. If it is ok, we can write data
             if coord_length == attr_length:
-                array[formatted_coords["drug_code"], formatted_coords["atc"], formatted_coords["composition"], formatted_coords["excipients"]] = {k: np.array(v) for k, v in formatted_data.items()}
+                # Databases created before the structured cross-reactivity attributes do not have them
+                array[formatted_coords["drug_code"], formatted_coords["atc"], formatted_coords["composition"], formatted_coords["excipients"]] = {k: np.array(v) for k, v in formatted_data.items() if array.schema.has_attr(k)}
             else:
                 print("Length mismatch between coordinates and attributes!")
                 result = False
         return result
 
-    # Create the TileDB database for drugs
-    def create_and_populate_DBFromCSV(self, csv_file='leaflet_info.csv'):
-        start_time = time.time()  # Start measurement time
-
-        # Specify the datatypes for the cvs file to read. No dataype is specified for 'composition' and 'excipients'
-        # This is why we want to use lists during the insertion phase for 'composition' and 'excipients'
-        dtype_dict = {
-            "drug_code": str,
-            "drug_name": str,
-            "atc": str,
-            "drug_form": str,
-            "therapeutic_indications": str,
-            "posology": str,
-            "cross_reactivity": str,
-            "contraindications": str,
-            "special_warnings": str,
-            "drug_interactions": str,
-            "pregnancy_info": str,
-            "driving_effects": str,
-            "side_effects": str,
-            "over_dose": str,
-            "incompatibilities": str,
-            "leaflet": str
-        }
-
-        # Read the CSV file
-        df = pd.read_csv(csv_file, dtype=dtype_dict, encoding='utf-8')
-
-        # Convert all columns into strings and update NaN to ''
+    # Clean all the columns (\xa0 and surrounding spaces) and lower case them if required, with vectorized string operations
+    def _normalize_frame(self, df: pd.DataFrame) -> pd.DataFrame:
         df = df.fillna('').astype(str)
         for col in df.columns:
-            df[col] = df[col].apply(self.clean_text)
+            df[col] = df[col].str.replace('\xa0', ' ', regex=False).str.strip()
             if self.store_lower_case:
-                df[col] = df[col].apply(self.to_lower_case)
+                df[col] = df[col].str.lower()
+        return df
+
+    # Split a '#' separated column (composition or excipients) into one (drug_code, value) row per value.
+    # Values are converted to ascii, calling unidecode once per distinct value
+    def _explode_column(self, df: pd.DataFrame, name: str) -> pd.DataFrame:
+        links = df[["drug_code", name]].assign(**{name: df[name].str.split('#')}).explode(name)
+        values = links[name].str.strip()
+        uniques = values.unique()
+        links[name] = values.map(dict(zip(uniques, [self.utf8_to_ascii_unidecode(v) for v in uniques])))
+        return links.drop_duplicates()
+
+    # Write the normalized drugs frame into the database, in fragments of at most fragment_rows cells.
+    # The seconds spent in each stage are added to timings. Returns the number of cells written
+    def _write_frame(self, df: pd.DataFrame, fragment_rows: int, timings: Dict) -> int:
+        t = time.time()
+        composition_df = self._explode_column(df, "composition")
+        excipients_df = self._explode_column(df, "excipients")
+        drugs_df = df.drop_duplicates("drug_code")[["drug_code", "atc"] + DRUG_ATTRIBUTES]
+        timings["explode"] = timings.get("explode", 0) + time.time() - t
+
+        t = time.time()
+        if self.normalized:
+            self._write_normalized(drugs_df, composition_df, excipients_df)
+            timings["write"] = timings.get("write", 0) + time.time() - t
+            return len(drugs_df) + len(composition_df) + len(excipients_df)
+
+        # Cartesian product of compositions and excipients of each drug, as a join on drug_code
+        cells = composition_df.merge(excipients_df, on="drug_code")
+        cells = cells.merge(drugs_df, on="drug_code")
+        cells = cells.drop_duplicates(["drug_code", "atc", "composition", "excipients"])
+        timings["product"] = timings.get("product", 0) + time.time() - t
+
+        t = time.time()
+        with self._write(self.db_uri) as array:
+            for start in range(0, len(cells), fragment_rows):
+                chunk = cells.iloc[start:start + fragment_rows]
+                coords = [chunk[dim].to_numpy(dtype=object) for dim in ["drug_code", "atc", "composition", "excipients"]]
+                array[coords[0], coords[1], coords[2], coords[3]] = {k: chunk[k].to_numpy(dtype=object) for k in DRUG_ATTRIBUTES}
+        timings["write"] = timings.get("write", 0) + time.time() - t
+        return len(cells)
+
+    # Consolidate the fragments of the database and remove the consolidated ones.
+    # buffer_size bounds the memory used by the consolidation buffers
+    def consolidate(self, buffer_size=50000000):
+        config = tiledb.Config({"sm.consolidation.buffer_size": str(buffer_size)})
+        uris = [self.drugs_uri, self.composition_uri, self.excipients_uri] if self.normalized else [self.db_uri]
+        for uri in uris:
+            tiledb.consolidate(uri, config=config)
+            tiledb.vacuum(uri)
+            # Consolidate also the fragment metadata, so that opening the array reads a single file
+            tiledb.consolidate(uri, config=tiledb.Config({"sm.consolidation.mode": "fragment_meta"}))
+            tiledb.vacuum(uri, config=tiledb.Config({"sm.vacuum.mode": "fragment_meta"}))
+            if self.handles is not None:
+                self.handles.invalidate(uri)
+
+    # Create the TileDB database for drugs.
+    # If chunksize is given, the CSV is streamed chunksize rows at a time: each chunk is normalized and written
+    # as its own fragments, so that the memory used does not depend on the catalogue size. Fragments are
+    # consolidated at the end
+    def create_and_populate_DBFromCSV(self, csv_file='leaflet_info.csv', fragment_rows=1000000, chunksize=None) -> Dict:
+        timings = {}
+        start_time = time.time()  # Start measurement time
 
-        #check_special_characters(df)
+        # Specify the datatypes for the cvs file to read. No dataype is specified for 'composition' and 'excipients'
+        # because they are '#' separated lists, exploded during the insertion phase
+        dtype_dict = {key: str for key in ["drug_code", "atc"] + DRUG_ATTRIBUTES}
 
         self.create_DBSchema()
 
-        total_rows = len(df)
-        batch_size = 100  # Batch size to insert data into TileDB
-        data = {key: [] for key in dtype_dict.keys() if key != "composition" and key != "excipients"}
-        data["composition"] = []
-        data["excipients"] = []
+        # Read the CSV file, as a single chunk if not streaming
+        t = time.time()
+        reader = pd.read_csv(csv_file, dtype=dtype_dict, encoding='utf-8', chunksize=chunksize)
+        chunks = reader if chunksize else [reader]
 
-        with tiledb.open("drugs_db", mode="w") as array:
-            for i, row in df.iterrows():
-                compositions = [self.utf8_to_ascii_unidecode(x.strip()) for x in row['composition'].split('#')]
-                excipients = [self.utf8_to_ascii_unidecode(x.strip()) for x in row['excipients'].split('#')]
-
-                product_list = list(product(compositions, excipients))
-
-                #print(f"Drug code: {row['drug_code']}, Compositions: {compositions}, Excipients: {excipients}, Combinations: {len(product_list)}")
-
-                data["drug_code"].extend([row["drug_code"]] * len(product_list))
-                data["composition"].extend([comp for comp, exc in product_list])
-                data["excipients"].extend([exc for comp, exc in product_list])
-                data["drug_name"].extend([row["drug_name"]] * len(product_list))
-                data["atc"].extend([row["atc"]] * len(product_list))
-                data["drug_form"].extend([row["drug_form"]] * len(product_list))
-                data["therapeutic_indications"].extend([row["therapeutic_indications"]] * len(product_list))
-                data["posology"].extend([row["posology"]] * len(product_list))
-                data["cross_reactivity"].extend([row["cross_reactivity"]] * len(product_list))
-                data["contraindications"].extend([row["contraindications"]] * len(product_list))
-                data["special_warnings"].extend([row["special_warnings"]] * len(product_list))
-                data["drug_interactions"].extend([row["drug_interactions"]] * len(product_list))
-                data["pregnancy_info"].extend([row["pregnancy_info"]] * len(product_list))
-                data["driving_effects"].extend([row["driving_effects"]] * len(product_list))
-                data["side_effects"].extend([row["side_effects"]] * len(product_list))
-                data["over_dose"].extend([row["over_dose"]] * len(product_list))
-                data["incompatibilities"].extend([row["incompatibilities"]] * len(product_list))
-                data["leaflet"].extend([row["leaflet"]] * len(product_list))
-
-                # Write data when we reach the batch size
-                if (i + 1) % batch_size == 0 or (i + 1) == total_rows:
-                    print("I", i, len(data))
-
-                    # Remove duplicates. It shouldn't happend
-                    unique_data = {}
-                    for j in range(len(data["drug_code"])):
-                        key = (data["drug_code"][j], data["atc"][j], data["composition"][j], data["excipients"][j])
-                        if key not in unique_data:
-                            unique_data[key] = {attr: data[attr][j] for attr in data}
-
-                    # Prepare data for batch insertion
-                    formatted_coords = {
-                        "drug_code": [],
-                        "atc": [],
-                        "composition": [],
-                        "excipients": [],
-                    }
-                    formatted_data = {attr: [] for attr in data if attr not in ["drug_code", "atc", "composition", "excipients"]}
-
-                    # Populate the attributes and dimensions for batch insertion
-                    for key, value in unique_data.items():
-                        formatted_coords["drug_code"].append(key[0])
-                        formatted_coords["atc"].append(key[1])
-                        formatted_coords["composition"].append(key[2])
-                        formatted_coords["excipients"].append(key[3])
-                        for attr in value:
-                            if attr in formatted_data:
-                                formatted_data[attr].append(value[attr])
-
-                    # Check the coordinates and attributes sizes just for debugging
-                    coord_length = len(formatted_coords["drug_code"])
-                    attr_length = len(next(iter(formatted_data.values())))
-                    print(f"Coord length: {coord_length}, Attr length: {attr_length}")
-
-                    # Sanity check. It is ok, we can write data
-                    if coord_length == attr_length:
-                        array[formatted_coords["drug_code"], formatted_coords["atc"], formatted_coords["composition"], formatted_coords["excipients"]] = {k: np.array(v) for k, v in formatted_data.items()}
-                    else:
-                        print("Length mismatch between coordinates and attributes!")
-                    
-                    print("End Writing")
+        drugs = 0
+        cells = 0
+        for df in chunks:
+            timings["read"] = timings.get("read", 0) + time.time() - t
+
+            # Convert all columns into strings, update NaN to '' and clean the texts.
+            # The cross-reactivity is parsed into its structured columns first
+            t = time.time()
+            df = self._normalize_frame(self._add_cross_reactivity_columns(df))
+            timings["normalize"] = timings.get("normalize", 0) + time.time() - t
 
-                    # Reset Dictionary
-                    data = {key: [] for key in dtype_dict.keys() if key != "composition" and key != "excipients"}
-                    data["composition"] = []
-                    data["excipients"] = []
+            #check_special_characters(df)
 
-                    # Enforce garbage collection
-                    gc.collect()
+            cells += self._write_frame(df, fragment_rows, timings)
+            drugs += len(df)
+            if chunksize:
+                print(f"Processed drugs {drugs}")
+            del df
+            t = time.time()
 
-                # Print the progress every 100 processed drugs
-                if (i + 1) % 100 == 0 or (i + 1) == total_rows:
-                    print(f"Processed drugs {i + 1} out of {total_rows}")
+        if chunksize:
+            t = time.time()
+            self.consolidate()
+            timings["consolidate"] = time.time() - t
 
         end_time = time.time()  # End duration masurement
+        timings["total"] = end_time - start_time
+
+        # Timing report
+        print(f"Drugs: {drugs}, cells written: {cells}")
+        for stage, seconds in timings.items():
+            print(f"  {stage:<12} {seconds:.2f} seconds")
         print(f"Execution time for the database creation: {end_time - start_time:.2f} seconds")
+        return {"drugs": drugs, "cells": cells, "timings": timings}
 
 
     # Search a drug given its code
-    def search_drug(self, drug_code:str) -> Dict:
-        # Open TileDB in read mode
-        with tiledb.open(self.db_uri, mode="r") as array:
-            # Conditional query for the given drug_code 
-            data = array.query(attrs=["drug_name", "drug_form", "therapeutic_indications", "posology", "cross_reactivity", "contraindications", "special_warnings", "drug_interactions", "pregnancy_info", "driving_effects", "side_effects", "over_dose", "incompatibilities", "leaflet"]).df[drug_code]
+    # attrs projects the descriptive attributes to read (all of them if None): large texts not requested are
+    # neither read nor decompressed. drug_code, atc, composition and excipients are always returned
+    def search_drug(self, drug_code:str, attrs:List = None) -> Dict:
+        return self.search_drugs([drug_code], attrs).get(drug_code)
 
-            if data.empty:
-                return None
+    # Search many drugs given their codes, with a single read. Returns drug_code -> drug record, missing codes are omitted
+    def search_drugs(self, drug_codes: List, attrs: List = None) -> Dict[str, Dict]:
+        # Remove duplicated codes preserving their order
+        drug_codes = list(dict.fromkeys(drug_codes))
+        if not drug_codes:
+            return {}
 
-            # Aggregate composition and excipients as sets
-            compositions = set(data['composition'])
-            excipients = set(data['excipients'])
+        if attrs is not None:
+            unknown = set(attrs) - set(DRUG_ATTRIBUTES)
+            if unknown:
+                raise ValueError(f"Unknown drug attributes: {sorted(unknown)}")
 
-            # Create the dictionary to return
-            drug_info = data.iloc[0].to_dict()
-            drug_info['composition'] = list(compositions)
-            drug_info['excipients'] = list(excipients)
+        if self.normalized:
+            return {drug["drug_code"]: drug for drug in self._search_drugs_normalized(drug_codes, attrs)}
 
-        return drug_info
+        # Multi-point query over the drug_code dimension
+        data = self._query(self.db_uri, lambda array: array.query(attrs=self._projection(self.db_uri, list(attrs) if attrs is not None else DRUG_ATTRIBUTES)).df[drug_codes])
+
+        # Aggregate composition and excipients by drug_code
+        return self._assemble_cartesian(data)
 
 
     def find_by_compositions(self, compositions) -> Dict:
@@ -345,13 +808,15 @@ class DatabaseManagement:
         else:
             encoded_compositions = [self.utf8_to_ascii_unidecode(comp) for comp in compositions]
 
+        if self.normalized:
+            return self._cartesian_rows_normalized(self._drug_codes_by_composition_normalized(encoded_compositions), encoded_compositions)
+
         # Open TileDB in read mode
-        with tiledb.open(self.db_uri, mode="r") as array:
-            # Filter by composition using a query filter
-            condition = " and ".join(["composition == \"\"\""+comp.replace('\"', "'")+"\"\"\"" for comp in encoded_compositions])
-            data = array.query(attrs=["drug_name"], cond=condition).multi_index[:, encoded_compositions, :]
-            r = pd.DataFrame.from_dict(data)
-            return r
+        # Filter by composition using a query filter
+        condition = " and ".join(["composition == \"\"\""+comp.replace('\"', "'")+"\"\"\"" for comp in encoded_compositions])
+        data = self._query(self.db_uri, lambda array: array.query(attrs=["drug_name"], cond=condition).multi_index[:, :, encoded_compositions, :])
+        r = pd.DataFrame.from_dict(data)
+        return r
 
     def find_by_compositions_direct_slice(self, composition) ->Dict:
 
@@ -360,31 +825,53 @@ class DatabaseManagement:
         #else:
         #    encoded_compositions = [self.utf8_to_ascii_unidecode(comp) for comp in composition]
 
+        if self.normalized:
+            compositions = [composition] if isinstance(composition, str) else list(composition)
+            return self._cartesian_rows_normalized(self._drug_codes_by_composition_normalized(compositions), compositions)
+
         # Open TileDB in read mode
-        with tiledb.open(self.db_uri, mode="r") as array:
-            #data = array.multi_index[:,encoded_compositions,:]
-            data = array.query(attrs=["drug_name"]).df[:, composition, :]
-            #print(type(data))
-            #print(data)
-            #data = array.query(cond=query)[:]
-            return pd.DataFrame.from_dict(data)
+        #data = array.multi_index[:,encoded_compositions,:]
+        data = self._query(self.db_uri, lambda array: array.query(attrs=["drug_name"]).df[:, :, composition, :])
+        #print(type(data))
+        #print(data)
+        #data = array.query(cond=query)[:]
+        return pd.DataFrame.from_dict(data)
             #print(r)
             #return r
 
         
     # Filter the database by composition. Composition is a list
     def filter_by_composition(self, uri, compositions) ->Dict:
+        if self.normalized:
+            return self._cartesian_rows_normalized(self._drug_codes_by_composition_normalized(compositions), compositions)
+
         # Open TileDB in read mode
-        with tiledb.open(self.db_uri, mode="r") as array:
-            # Create a DataFrame to combine the results for each composition in the list
+        # Create a DataFrame to combine the results for each composition in the list
+        def read(array):
             dfs = []
             for comp in compositions:
-                result = array.query(coords=True).multi_index[:, comp, :]
+                result = array.query(coords=True).multi_index[:, :, comp, :]
                 df = pd.DataFrame.from_dict(result)
                 dfs.append(df)
-            combined_df = pd.concat(dfs)
+            return pd.concat(dfs)
+        combined_df = self._query(self.db_uri, read)
         return combined_df
 
+    # Assemble the cartesian rows into drug records, collecting compositions and excipients as lists,
+    # with a single groupby. Returns drug_code -> record, in order of appearance
+    def _assemble_cartesian(self, data: pd.DataFrame) -> Dict[str, Dict]:
+        if data.empty:
+            return {}
+        grouped = data.groupby('drug_code', sort=False)
+        drugs = data.drop_duplicates('drug_code').set_index('drug_code', drop=False)
+        drugs = drugs.assign(composition=grouped['composition'].unique().map(list),
+                             excipients=grouped['excipients'].unique().map(list))
+        return {drug_code: self._structure_cross_reactivity(drug_info) for drug_code, drug_info in drugs.to_dict('index').items()}
+
+    # Aggregate the cartesian rows by drug_code into a list of drug records
+    def _aggregate_cartesian(self, data: pd.DataFrame) -> List[Dict]:
+        return list(self._assemble_cartesian(data).values())
+
     # Search drugs that have the given compositions as active ingredients and do not contain the given excipients (one is enough to exclude a drug)
     def search_drugs_by_composition_and_excipients(self, compositions:List, excipients:List) -> Dict:
         #start_time = time.time()  # Start the measurement time
@@ -397,52 +884,37 @@ class DatabaseManagement:
             encoded_compositions = [self.utf8_to_ascii_unidecode(comp) for comp in compositions]
             encoded_excipients = [self.utf8_to_ascii_unidecode(exc) for exc in excipients]
 
-        # filter the database by active ingredients
+        index = self.get_drug_index()
+        if index is not None:
+            # Set intersection on the compositions and set difference on the excipients, then a single read
+            drug_ids = np.setdiff1d(index.drug_ids_all_of("composition", encoded_compositions),
+                                    index.drug_ids_any_of("excipients", encoded_excipients), assume_unique=True)
+            if len(drug_ids) == 0:
+                return None
+            drug_codes = index.codes(drug_ids)
+            if self.normalized:
+                return self._assemble_normalized(*self._read_normalized(drug_codes, ["atc", "drug_name"]))
+            return self._aggregate_cartesian(self._query(self.db_uri, lambda array: array.query(attrs=["drug_name"]).df[drug_codes]))
+
+        # No index available: filter the database by active ingredients
         #data_df = self.filter_by_composition("drugs_db", encoded_compositions)
-        data_df = self.find_by_compositions_direct_slice(encoded_compositions)        
+        data_df = self.find_by_compositions_direct_slice(encoded_compositions)
         #end_time = time.time()  # End of measurement time
         #print(f"Tempo di esecuzione filter_by_composition: {end_time - start_time:.2f} secondi")
-        # Debug: Print filtered data for the fiven compositions
-        #print("Filtered data for the fiven compositions:")
-        #print(data_df.head())
 
-        # Filter the results of the previous query to exclude the drugs that contain at least an excipient in the given list 
-        filtered_data = data_df[~data_df['excipients'].isin(encoded_excipients)]
+        # Keep the drugs having all the given compositions
+        counts = data_df.groupby('drug_code')['composition'].nunique()
+        data_df = data_df[data_df['drug_code'].isin(counts[counts == len(set(encoded_compositions))].index)]
 
-        # Debug: Filtered data for the fiven excipients
-        #print("Filtered data for the fiven excipients:")
-        #print(filtered_data.head())
+        # Exclude the drugs that contain at least an excipient in the given list
+        excluded = data_df.loc[data_df['excipients'].isin(encoded_excipients), 'drug_code']
+        filtered_data = data_df[~data_df['drug_code'].isin(excluded)]
 
         if filtered_data.empty:
             return None
 
         # Aggregate the result by drug_code
-        aggregated_result = []
-        grouped_data = filtered_data.groupby('drug_code')
-        for drug_code, data in grouped_data:
-            compositions = set(data['composition'])
-            excipients = set(data['excipients'])
-
-            # Create the dictionary to return
-            drug_info = data.iloc[0].to_dict()
-            drug_info['composition'] = list(compositions)
-            drug_info['excipients'] = list(excipients)
-
-            #CONVERSION
-            if isinstance(drug_code, bytes):
-                drug_info['drug_code'] = drug_code.decode('utf-8')  # Decode bytes and create a string value
-            # Convert byte columns to strings 
-            for key in drug_info.keys():
-                if isinstance(drug_info[key], bytes):
-                    drug_info[key] = drug_info[key].decode('utf-8')
-            #END CONVERSION
-
-            aggregated_result.append(drug_info)
-
-        #end_time = time.time()  # End of measurement time
-        #print(f"Tempo di esecuzione per la ricerca dei farmaci: {end_time - start_time:.2f} secondi")
-
-        return aggregated_result
+        return self._aggregate_cartesian(filtered_data)
 
     # delete drugs by code
     def delete_drug_by_code(self, drug_code: str) -> bool:
@@ -451,9 +923,11 @@ class DatabaseManagement:
             cond = f"drug_code == '{drug_code}'"
 
             # Issue the delete query with the condition
-            with tiledb.open(self.db_uri, mode="d") as array:
-                array.query(cond=cond).submit()
-                print(f"Deleted rows with drug_code: {drug_code}")
+            uris = [self.drugs_uri, self.composition_uri, self.excipients_uri] if self.normalized else [self.db_uri]
+            for uri in uris:
+                with self._write(uri, mode="d") as array:
+                    array.query(cond=cond).submit()
+            print(f"Deleted rows with drug_code: {drug_code}")
             return True
         except Exception as e:
             print(f"Error deleting rows with drug_code {drug_code}: {e}")
@@ -477,6 +951,19 @@ class DatabaseManagement:
                     else:
                         existing_data[key] = value
 
+            # A new cross_reactivity replaces the structured one, stored with cross_sensitive_drugs '#' separated
+            if "cross_reactivity" in update_data:
+                cross_reactivity = update_data["cross_reactivity"]
+                if not isinstance(cross_reactivity, str):
+                    cross_reactivity = json.dumps(cross_reactivity, ensure_ascii=False) if cross_reactivity is not None else ""
+                existing_data["cross_reactivity"] = self.to_lower_case(cross_reactivity) if self.store_lower_case else cross_reactivity
+                cross = parse_cross_reactivity(cross_reactivity)
+                if self.store_lower_case:
+                    cross = {k: self.to_lower_case(v) if isinstance(v, str) else v for k, v in cross.items()}
+                existing_data.update(cross)
+            if isinstance(existing_data.get("cross_sensitive_drugs"), list):
+                existing_data["cross_sensitive_drugs"] = "#".join(self._encode_terms(existing_data["cross_sensitive_drugs"]))
+
             # Extract necessary details for re-insertion
             composition = existing_data.pop("composition", [])
             excipients = existing_data.pop("excipients", [])
@@ -485,6 +972,21 @@ class DatabaseManagement:
                 composition = [self.to_lower_case(self.utf8_to_ascii_unidecode(comp)) for comp in composition]
                 excipients = [self.to_lower_case(self.utf8_to_ascii_unidecode(comp)) for comp in excipients]
 
+            if self.normalized:
+                drugs_df = pd.DataFrame([{key: existing_data[key] for key in ["drug_code", "atc"] + DRUG_ATTRIBUTES}])
+                links = [pd.DataFrame(), pd.DataFrame()]
+                # Rewrite the links only if they changed
+                if "composition" in update_data or "excipients" in update_data:
+                    cond = f"drug_code == '{drug_code}'"
+                    for uri in [self.composition_uri, self.excipients_uri]:
+                        with self._write(uri, mode="d") as array:
+                            array.query(cond=cond).submit()
+                    links = [pd.DataFrame({"drug_code": drug_code, "composition": list(dict.fromkeys(composition))}),
+                             pd.DataFrame({"drug_code": drug_code, "excipients": list(dict.fromkeys(excipients))})]
+                self._write_normalized(drugs_df, *links)
+                print(f"Updated drug with drug_code: {drug_code}")
+                return
+
             # Prepare data for updating
             update_coords = {
                 "drug_code": [drug_code] * len(composition) * len(excipients),
@@ -498,9 +1000,9 @@ class DatabaseManagement:
             combined_data = {**update_coords, **update_attrs}
             
             # Perform update/insert
-            with tiledb.open(self.db_uri, mode="w") as array:
+            with self._write(self.db_uri) as array:
                 array[update_coords["drug_code"], update_coords["atc"], update_coords["composition"], update_coords["excipients"]] = {
-                    k: np.array(v) for k, v in combined_data.items() if k not in ["drug_code", "atc", "composition", "excipients"]
+                    k: np.array(v) for k, v in combined_data.items() if k not in ["drug_code", "atc", "composition", "excipients"] and array.schema.has_attr(k)
                 }
 
             print(f"Updated drug with drug_code: {drug_code}")
@@ -508,116 +1010,102 @@ class DatabaseManagement:
         except Exception as e:
             print(f"Error updating drug with drug_code {drug_code}: {e}")
 
+    # Count the cells of the array. With the normalized layout this is the number of drugs
     def count_records(self) -> int:
         # Open TileDB in read mode
-        with tiledb.open(self.db_uri, mode="r") as A:
-            q = A.query()
-    
-            # count the number of records in the array
-            d = q.agg("count")[:]
-            return d["drug_name"]["count"]
+        # count the number of records in the array
+        d = self._query(self.drugs_uri if self.normalized else self.db_uri, lambda A: A.query().agg("count")[:])
+        return d["drug_name"]["count"]
 
 
     def get_all_drugs(self) -> List[Dict]:
         try:
-            # Open TileDB in read mode
-            with tiledb.open(self.db_uri, mode="r") as array:
-                # Query all data
-                data = array.query(attrs=["drug_name", "drug_form", "therapeutic_indications", "posology", "cross_reactivity", "contraindications", "special_warnings", "drug_interactions", "pregnancy_info", "driving_effects", "side_effects", "over_dose", "incompatibilities", "leaflet"]).df[:]
+            if self.normalized:
+                drugs_df = self._query(self.drugs_uri, lambda array: array.df[:])
+                return self._assemble_normalized(drugs_df,
+                                                 self._read_links(self.composition_uri, "composition"),
+                                                 self._read_links(self.excipients_uri, "excipients"))
+
+            # Query all data
+            data = self._query(self.db_uri, lambda array: array.query(attrs=self._projection(self.db_uri, DRUG_ATTRIBUTES)).df[:])
             
-            if data.empty:
-                return []
-
-            # Aggregate composition and excipients as sets
-            aggregated_result = []
-            grouped_data = data.groupby('drug_code')
-            for drug_code, data in grouped_data:
-                compositions = set(data['composition'])
-                excipients = set(data['excipients'])
-
-                # Create the dictionary to return
-                drug_info = data.iloc[0].to_dict()
-                drug_info['composition'] = list(compositions)
-                drug_info['excipients'] = list(excipients)
-
-                # Convert byte columns to strings if necessary
-                if isinstance(drug_code, bytes):
-                    drug_info['drug_code'] = drug_code.decode('utf-8')  # Decode bytes and create a string value
-                for key in drug_info.keys():
-                    if isinstance(drug_info[key], bytes):
-                        drug_info[key] = drug_info[key].decode('utf-8')
-
-                aggregated_result.append(drug_info)
-
-            return aggregated_result
+            # Aggregate composition and excipients by drug_code
+            return self._aggregate_cartesian(data)
 
         except Exception as e:
             print(f"Error retrieving all drugs: {e}")
             return []
 
-    def find_drugs_by_atc(self, atc_code: str, drug_code_to_exclude: str = None) -> List[Dict]:
+    # Cerca i farmaci con il codice ATC dato. Con prefix=True restituisce tutti i farmaci il cui ATC inizia con atc_code,
+    # a qualsiasi livello (es. 'J01C' per tutte le penicilline)
+    def find_drugs_by_atc(self, atc_code: str, drug_code_to_exclude: str = None, prefix: bool = False) -> List[Dict]:
         try:
             # Converti in minuscolo se necessario
             if self.store_lower_case:
                 atc_code = self.to_lower_case(atc_code)
-            
+
             print(f"Cercando farmaci con ATC: {atc_code}")
 
-            # Apri TileDB in modalità lettura
-            with tiledb.open(self.db_uri, mode="r") as array:
-                # Query per il codice ATC specifico
-                condition = f"atc == \"\"\"{atc_code}\"\"\""
-                print(f"Condizione query: {condition}")
-                
-                # Prima verifichiamo se ci sono dati con questo ATC
-                test_data = array.query(coords=True).df[:, atc_code, :]
-                print(f"Dati trovati (test): {len(test_data) if not test_data.empty else 0} righe")
-
-                # Query completa
-                data = array.query(attrs=["drug_name", "drug_form", "therapeutic_indications", 
-                                        "posology", "cross_reactivity", "contraindications", 
-                                        "special_warnings", "drug_interactions", "pregnancy_info", 
-                                        "driving_effects", "side_effects", "over_dose", 
-                                        "incompatibilities", "leaflet"]).df[:, atc_code, :]
-                
-                print(f"Dati trovati (query completa): {len(data) if not test_data.empty else 0} righe")
-
-            if data.empty:
-                print("Nessun dato trovato")
-                return []
-
-            # Aggrega i risultati per drug_code
-            aggregated_result = []
-            grouped_data = data.groupby('drug_code')
-            
-            for drug_code, group_data in grouped_data:
-                if drug_code_to_exclude and drug_code == drug_code_to_exclude:
-                    continue
-                compositions = set(group_data['composition'])
-                excipients = set(group_data['excipients'])
+            index = self.get_drug_index()
+            if index is not None:
+                # Ricerca binaria sull'indice ATC ordinato
+                drug_codes = index.codes(index.drug_ids_by_atc(atc_code, prefix))
+            elif prefix:
+                drug_codes = self._drug_codes_by_atc_range(atc_code, atc_code + chr(0x7f))
+            elif self.normalized:
+                # Layout normalizzato: l'ATC è un attributo dell'array dei farmaci
+                drug_codes = self._query(self.drugs_uri, lambda array: array.query(attrs=[], cond=f"atc == \"\"\"{atc_code}\"\"\"").df[:]["drug_code"].tolist())
+            else:
+                # Slice sulla dimensione atc, leggendo solo le coordinate
+                drug_codes = self._query(self.db_uri, lambda array: array.query(attrs=[], dims=["drug_code"]).df[:, atc_code]["drug_code"].unique().tolist())
 
-                # Crea il dizionario per il farmaco
-                drug_info = group_data.iloc[0].to_dict()
-                drug_info['composition'] = list(compositions)
-                drug_info['excipients'] = list(excipients)
+            return self._drugs_by_codes(drug_codes, drug_code_to_exclude)
 
-                # Converti i bytes in stringhe se necessario
-                if isinstance(drug_code, bytes):
-                    drug_info['drug_code'] = drug_code.decode('utf-8')
-                for key in drug_info.keys():
-                    if isinstance(drug_info[key], bytes):
-                        drug_info[key] = drug_info[key].decode('utf-8')
+        except Exception as e:
+            print(f"Errore nella ricerca dei farmaci per codice ATC {atc_code}: {e}")
+            traceback.print_exc()  # Stampa lo stack trace completo
+            return []
 
-                aggregated_result.append(drug_info)
+    # Cerca i farmaci con codice ATC compreso in [start_atc, end_atc)
+    def find_drugs_by_atc_range(self, start_atc: str, end_atc: str, drug_code_to_exclude: str = None) -> List[Dict]:
+        try:
+            if self.store_lower_case:
+                start_atc = self.to_lower_case(start_atc)
+                end_atc = self.to_lower_case(end_atc)
 
-            print(f"Numero di farmaci trovati dopo aggregazione: {len(aggregated_result)}")
-            return aggregated_result
+            index = self.get_drug_index()
+            if index is not None:
+                drug_codes = index.codes(index.drug_ids_by_atc_range(start_atc, end_atc))
+            else:
+                drug_codes = self._drug_codes_by_atc_range(start_atc, end_atc)
+
+            return self._drugs_by_codes(drug_codes, drug_code_to_exclude)
 
         except Exception as e:
-            print(f"Errore nella ricerca dei farmaci per codice ATC {atc_code}: {e}")
+            print(f"Errore nella ricerca dei farmaci per intervallo ATC [{start_atc}, {end_atc}): {e}")
             traceback.print_exc()  # Stampa lo stack trace completo
             return []
 
+    # Senza indice: codici dei farmaci con ATC in [start_atc, end_atc), leggendo solo drug_code e atc
+    def _drug_codes_by_atc_range(self, start_atc: str, end_atc: str) -> List:
+        if self.normalized:
+            data = self._query(self.drugs_uri, lambda array: array.query(attrs=["atc"]).df[:])
+        else:
+            # Il range sulla dimensione atc è chiuso, l'estremo superiore viene filtrato dopo
+            data = self._query(self.db_uri, lambda array: array.query(attrs=[], dims=["drug_code", "atc"]).df[:, start_atc:end_atc])
+        data = data[(data["atc"] >= start_atc) & (data["atc"] < end_atc)]
+        return data["drug_code"].unique().tolist()
+
+    # Legge in un'unica query i farmaci dati, escludendo drug_code_to_exclude
+    def _drugs_by_codes(self, drug_codes: List, drug_code_to_exclude: str = None) -> List[Dict]:
+        drug_codes = [code for code in drug_codes if code != drug_code_to_exclude]
+        if not drug_codes:
+            print("Nessun dato trovato")
+            return []
+        result = list(self.search_drugs(drug_codes).values())
+        print(f"Numero di farmaci trovati: {len(result)}")
+        return result
+
     
 if __name__ == "__main__":
     # Create the database
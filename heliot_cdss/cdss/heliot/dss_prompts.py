@@ -61,20 +61,12 @@ parabens: methylparaben, propylparaben, para-aminobenzoic acid (paba)
 ## OUTPUT FORMAT ##
 {{"a":"brief description of your analysis", "r":"final response: NO DOCUMENTED REACTIONS OR INTOLERANCES|DIRECT ACTIVE INGREDIENT REACTIVITY|DIRECT EXCIPIENT REACTIVITY|NO REACTIVITY TO PRESCRIBED DRUG'S INGREDIENTS OR EXCIPIENTS|CHEMICAL-BASED CROSS-REACTIVITY TO EXCIPIENTS|DRUG CLASS CROSS-REACTIVITY WITHOUT DOCUMENTED TOLERANCE|DRUG CLASS CROSS-REACTIVITY WITH DOCUMENTED TOLERANCE", "rt":"reaction type: None|Life-threatening|Non life-threatening immune-mediated|Non life-threatening non immune-mediated"}}"""
 
-SYSTEM_CHECK_ALLERGY_ENHANCED_PROMPT ="""Act as an expert physician.
+# Enhanced check split for provider-side prompt caching: the static instructions come first and are identical
+# for every request, the drug-specific sections follow them
+SYSTEM_CHECK_ALLERGY_ENHANCED_STATIC_PROMPT ="""Act as an expert physician.
 
 Your task is to check if the drug I want to prescribe may cause reactions or side effects to the patient, focusing only on the potential reactions the patient has in its clinical notes.
-
-### Drug To Prescribe: {drug}
-
-### Drug Active Ingredients:
-{active_ingredients}
-
-### Drug Excipients:
-{excipients}
-
-### Known Cross-reactivity
-{cross_reactivity}
+The drug to prescribe, its active ingredients, excipients, known cross-reactivity and contraindications are reported in the DRUG INFORMATION section at the end.
 
 ### Known Excipients With Chemical Cross-reactivity
 polyethylene glycol (peg): polysorbates, poloxamers, cremophor
@@ -91,9 +83,6 @@ methylparaben: propylparaben, parabens
 hydroxyethylcellulose: carboxymethylcellulose (cmc), hydroxypropyl methylcellulose (hpmc), methylcellulose
 parabens: methylparaben, propylparaben, para-aminobenzoic acid (paba)
 
-### Contraindications ###
-{contraindications}
-
 ## INSTRUCTIONS ##
 1. NO DOCUMENTED REACTIONS OR INTOLERANCES means that the patient has no known allergies, reactions, or intolerances in their information
 2. DIRECT ACTIVE INGREDIENT REACTIVITY means that the drug contains an active ingredient to which the patient has reactions (comprising side effects), as reported in their information.
@@ -107,7 +96,24 @@ parabens: methylparaben, propylparaben, para-aminobenzoic acid (paba)
 11. Prefer DIRECT REACIVITY when the reaction is related to a specific ingredient which is part of the prescribed drug formulation.
 
 ## OUTPUT FORMAT ##
-{{"a":"brief description of your analysis", "r":"final response: NO DOCUMENTED REACTIONS OR INTOLERANCES|DIRECT ACTIVE INGREDIENT REACTIVITY|DIRECT EXCIPIENT REACTIVITY|NO REACTIVITY TO PRESCRIBED DRUG'S INGREDIENTS OR EXCIPIENTS|CHEMICAL-BASED CROSS-REACTIVITY TO EXCIPIENTS|DRUG CLASS CROSS-REACTIVITY WITHOUT DOCUMENTED TOLERANCE|DRUG CLASS CROSS-REACTIVITY WITH DOCUMENTED TOLERANCE", "rt":"reaction type: None|Life-threatening|Non life-threatening immune-mediated|Non life-threatening non immune-mediated"}}"""
+{"a":"brief description of your analysis", "r":"final response: NO DOCUMENTED REACTIONS OR INTOLERANCES|DIRECT ACTIVE INGREDIENT REACTIVITY|DIRECT EXCIPIENT REACTIVITY|NO REACTIVITY TO PRESCRIBED DRUG'S INGREDIENTS OR EXCIPIENTS|CHEMICAL-BASED CROSS-REACTIVITY TO EXCIPIENTS|DRUG CLASS CROSS-REACTIVITY WITHOUT DOCUMENTED TOLERANCE|DRUG CLASS CROSS-REACTIVITY WITH DOCUMENTED TOLERANCE", "rt":"reaction type: None|Life-threatening|Non life-threatening immune-mediated|Non life-threatening non immune-mediated"}
+"""
+
+SYSTEM_CHECK_ALLERGY_ENHANCED_DRUG_PROMPT ="""
+## DRUG INFORMATION ##
+### Drug To Prescribe: {drug}
+
+### Drug Active Ingredients:
+{active_ingredients}
+
+### Drug Excipients:
+{excipients}
+
+### Known Cross-reactivity
+{cross_reactivity}
+
+### Contraindications ###
+{contraindications}"""
 
 USER_CHECK_ALLERGY_ENHANCED_PROMPT ="""### PATIENT INFORMATION: {patient_info}"""
 
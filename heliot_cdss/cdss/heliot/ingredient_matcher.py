@@ -0,0 +1,219 @@
+import re
+from collections import deque
+from typing import List, NamedTuple, Tuple
+
+from unidecode import unidecode
+
+_TOKEN_RE = re.compile(r"\w+")
+
+# Expressions introducing an allergy or an intolerance in the Italian clinical notes, followed by the substance
+ALLERGY_CUE_RE = re.compile(r"\b(?:allergi\w*|allergic\w*|intolleran\w*|ipersensibil\w*|reazion\w*\s+avvers\w*|anafilass\w*)\b"
+                            r"(?:\s+(?:nota|note|noto|noti|grave|gravi|lieve|lievi)\b)?"
+                            r"(?:\s+(?:a|ad|al|allo|alla|all|ai|agli|alle|verso|per|da|di|del|della|dei|delle|con)\b)?[\s']*"
+                            r"(?P<obj>[^.;:\n()]*)", re.IGNORECASE)
+
+# Separators of the substances listed after a cue
+_ITEM_SPLIT_RE = re.compile(r",|/|\b(?:e|ed|o|oppure)\b")
+
+# Words that do not name a substance, e.g. "nessuna allergia nota", "allergie farmacologiche riferite"
+_NON_SUBSTANCE_WORDS = {"nota", "note", "noto", "noti", "nessuna", "nessun", "non", "riferita", "riferite", "riferito", "riferiti",
+                        "conosciuta", "conosciute", "segnalata", "segnalate", "farmacologica", "farmacologiche", "alimentare", "alimentari",
+                        "stagionale", "stagionali", "il", "lo", "la", "i", "gli", "le", "un", "una", "uno", "paziente", "negativa", "negative"}
+
+def tokenize(text: str) -> List[Tuple[str, int, int]]:
+    """
+    Split the text in word tokens, each one transliterated to ASCII and casefolded.
+
+    Returns:
+    - The list of (token, start, end), with start and end offsets in the original text.
+    """
+    return [(unidecode(m.group()).casefold(), m.start(), m.end()) for m in _TOKEN_RE.finditer(text)]
+
+# A dictionary entry found in a text: offsets in the text, the matched text and the value of the entry
+class TokenMatch(NamedTuple):
+    start: int
+    end: int
+    text: str
+    value: str
+
+# Aho-Corasick automaton over word tokens: patterns only match whole tokens, so a name is never found inside another word.
+# Matching is linear in the number of tokens of the text
+class TokenAutomaton:
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        # (number of tokens, value) of the pattern ending in each state
+        self._value = [None]
+        # for each state: (number of tokens, value) of all the patterns ending there, longest first
+        self._out = [[]]
+        self._built = False
+        self.size = 0
+
+    def add(self, pattern: str, value: str) -> bool:
+        """
+        Add a pattern. A pattern added twice keeps the last value.
+
+        Parameters:
+        - pattern: the text to look for.
+        - value: the value returned when the pattern is found.
+
+        Returns:
+        - False if the pattern has no tokens.
+        """
+        tokens = [t for t, _, _ in tokenize(pattern)]
+        if not tokens:
+            return False
+        state = 0
+        for token in tokens:
+            nxt = self._goto[state].get(token)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][token] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._value.append(None)
+                self._out.append([])
+            state = nxt
+        if self._value[state] is None:
+            self.size += 1
+        self._value[state] = (len(tokens), value)
+        self._built = False
+        return True
+
+    def build(self):
+        """
+        Compute the failure links. Called automatically before the first search.
+        """
+        self._out = [[v] if v is not None else [] for v in self._value]
+        queue = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+        while queue:
+            state = queue.popleft()
+            for token, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and token not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(token, 0)
+                self._fail[nxt] = f if f != nxt else 0
+                if self._out[self._fail[nxt]]:
+                    self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+        self._built = True
+
+    def find_all(self, text: str) -> List[TokenMatch]:
+        """
+        Find the patterns in the text. Overlapping matches are resolved keeping the leftmost and then the longest one.
+
+        Parameters:
+        - text: the text to search.
+
+        Returns:
+        - The non overlapping matches, in text order.
+        """
+        if not self._built:
+            self.build()
+        tokens = tokenize(text)
+        candidates = []
+        state = 0
+        for i, (token, _, _) in enumerate(tokens):
+            while state and token not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token, 0)
+            for length, value in self._out[state]:
+                candidates.append((i - length + 1, -length, value))
+
+        matches = []
+        next_free = 0
+        for first, neg_length, value in sorted(candidates, key=lambda c: (c[0], c[1])):
+            if first < next_free:
+                continue
+            last = first - neg_length - 1
+            start, end = tokens[first][1], tokens[last][2]
+            matches.append(TokenMatch(start, end, text[start:end], value))
+            next_free = last + 1
+        return matches
+
+    def replace(self, text: str) -> str:
+        """
+        Replace, in a single pass, every pattern found in the text with its value.
+        Overlapping patterns are resolved as in find_all and a replaced value is never matched again.
+
+        Parameters:
+        - text: the text to rewrite.
+
+        Returns:
+        - The rewritten text.
+        """
+        return replace_matches(text, self.find_all(text))
+
+def merge_matches(*match_lists: List[TokenMatch]) -> List[TokenMatch]:
+    """
+    Merge the matches found by several automata, keeping the leftmost and then the longest one among the overlapping matches.
+    On the same span, the match of the first list wins.
+    """
+    candidates = sorted(((m.start, m.start - m.end, rank, m) for rank, matches in enumerate(match_lists) for m in matches),
+                        key=lambda c: c[:3])
+    merged = []
+    next_free = 0
+    for start, _, _, m in candidates:
+        if start < next_free:
+            continue
+        merged.append(m)
+        next_free = m.end
+    return merged
+
+def replace_matches(text: str, matches: List[TokenMatch]) -> str:
+    """
+    Replace the matches, sorted and non overlapping, with their values.
+    """
+    parts = []
+    pos = 0
+    for m in matches:
+        parts.append(text[pos:m.start])
+        parts.append(m.value)
+        pos = m.end
+    parts.append(text[pos:])
+    return "".join(parts)
+
+def unresolved_allergy_spans(text: str, matches: List[TokenMatch]) -> List[Tuple[int, int]]:
+    """
+    Find the substances mentioned after an allergy cue that are not covered by a dictionary match.
+
+    Parameters:
+    - text: the clinical notes.
+    - matches: the dictionary matches found in the text.
+
+    Returns:
+    - The (start, end) offsets of the unresolved substances.
+    """
+    unresolved = []
+    for cue in ALLERGY_CUE_RE.finditer(text):
+        obj_start = cue.start("obj")
+        obj = cue.group("obj")
+        pos = 0
+        for sep in list(_ITEM_SPLIT_RE.finditer(obj)) + [None]:
+            item_end = sep.start() if sep else len(obj)
+            start, end = obj_start + pos, obj_start + item_end
+            pos = sep.end() if sep else len(obj)
+            words = [t for t, _, _ in tokenize(text[start:end])]
+            if not words or all(w in _NON_SUBSTANCE_WORDS or w.isdigit() for w in words):
+                continue
+            if not any(m.start < end and m.end > start for m in matches):
+                unresolved.append((start, end))
+    return unresolved
+
+def allergy_mentions(text: str, matches: List[TokenMatch]) -> List[TokenMatch]:
+    """
+    Keep the dictionary matches mentioned after an allergy cue, e.g. "lattosio" in "intolleranza al lattosio".
+
+    Parameters:
+    - text: the clinical notes.
+    - matches: the dictionary matches found in the text.
+
+    Returns:
+    - The matches inside the substances introduced by a cue, in text order.
+    """
+    spans = [(cue.start("obj"), cue.end("obj")) for cue in ALLERGY_CUE_RE.finditer(text)]
+    return [m for m in matches if any(start <= m.start and m.end <= end for start, end in spans)]
@@ -1,47 +1,216 @@
 import pandas as pd
+import os
+import threading
 import time
+from typing import Dict, List
+from .ingredient_matcher import TokenAutomaton, TokenMatch, merge_matches
+from .name_matcher import NameMatcher
+from .synonym_deltas import DeltaLog, SynonymDeltas, default_log_path
+from .synonym_index import SynonymIndex, default_index_path, matcher_pairs, read_synonyms_csv, synonym_pairs
 
 # Class to handle drug synonyms
 class SynonymManager:
-    def __init__(self, initial_data_path):
+    def __init__(self, initial_data_path, index_path=None, fuzzy=False, log_path=None, reload_interval=2.0):
         """
         Initialize SynonymManager loading the synonyms dataset.
+        If the compiled index (see synonym_index.py) exists and is up to date, it is memory-mapped instead of reading the csv file.
+        The matcher of the ingredient names and the normalized name lookup are built here, so no request pays for them.
+        The ingredients added later are kept in an append-only log, replayed at startup and polled every reload_interval seconds.
         
         Parameters:
         - initial_data_path: path of the synonyms cvs file.
+        - index_path: path of the compiled index, by default the csv path with the .idx extension.
+        - fuzzy: if True, find_standard_names returns the approximate candidates of the synonyms it cannot resolve. They never replace the synonym.
+        - log_path: path of the log of the added ingredients, by default the csv path with the .delta.jsonl extension.
+        - reload_interval: minimum number of seconds between two checks of the log.
         """
+        self.initial_data_path = initial_data_path
+        self.fuzzy = fuzzy
+        self._df = None
+        self.index = self._load_index(index_path or default_index_path(initial_data_path))
+
+        if self.index is not None:
+            self.synonym_to_ingredient = self.index
+        else:
+            self._df = read_synonyms_csv(initial_data_path)
+            self.synonym_to_ingredient = {}
+            self._populate_synonym_dict()
+
+        # Local matcher of the ingredient names and normalized name lookup
+        self._matcher = self._build_matcher()
+        self._name_matcher = self._build_name_matcher()
+
+        # Ingredients added after the dataset was loaded
+        self.delta_log = DeltaLog(log_path or default_log_path(initial_data_path))
+        self.reload_interval = reload_interval
+        self._deltas = SynonymDeltas()
+        self._deltas_lock = threading.Lock()
+        self._last_reload = 0.0
+        self.refresh()
+
+    def _load_index(self, index_path):
+        """
+        Map the compiled index if it exists and was built from the current csv file, otherwise return None.
+        """
+        if not os.path.exists(index_path):
+            return None
         try:
-            self.df = pd.read_csv(initial_data_path,dtype=str)
-        except:
-            self.df = pd.read_csv(initial_data_path, delimiter=';',dtype=str)
-            
-        self.synonym_to_ingredient = {}
-        self._populate_synonym_dict()
+            index = SynonymIndex(index_path)
+        except Exception as e:
+            print(f"Unable to load the synonym index {index_path}: {e}")
+            return None
+        if not index.is_fresh(self.initial_data_path):
+            print(f"The synonym index {index_path} is out of date, loading {self.initial_data_path}")
+            return None
+        return index
+
+    @property
+    def df(self):
+        """
+        The synonyms dataset, read at the first access when the compiled index is used.
+        """
+        if self._df is None:
+            self._df = read_synonyms_csv(self.initial_data_path)
+        return self._df
+
+    @df.setter
+    def df(self, value):
+        self._df = value
+
+    def refresh(self):
+        """
+        Apply the ingredients appended to the log since the last check, also by other processes.
+        The lookups keep using the previous snapshot until the new one is ready.
+        """
+        with self._deltas_lock:
+            self._last_reload = time.monotonic()
+            rows = self.delta_log.read_new()
+            if rows:
+                self._deltas = self._deltas.with_rows(rows)
+                print(f"Applied {len(rows)} new ingredients from {self.delta_log.path}")
+
+    def _get_deltas(self) -> SynonymDeltas:
+        """
+        Return the current snapshot of the added ingredients, checking the log at most every reload_interval seconds.
+        """
+        if time.monotonic() - self._last_reload >= self.reload_interval:
+            self._last_reload = time.monotonic()
+            if self.delta_log.has_changes():
+                self.refresh()
+        return self._deltas
+
+    def _lookup(self, synonym, deltas: SynonymDeltas):
+        """
+        Return the English name of the synonym: the added ingredients win over the dataset.
+        """
+        standard_name = deltas.synonym_to_ingredient.get(synonym)
+        if standard_name is None:
+            standard_name = self.synonym_to_ingredient.get(synonym)
+        return standard_name
 
     def _populate_synonym_dict(self):
         """
         Populate the dictionary starting from the DataFrame.
         """
-        for idx, row in self.df.iterrows():
-            synonyms = row['synonyms']
-            if pd.notna(synonyms):
-                for synonym in synonyms.split('#'):
-                    self.synonym_to_ingredient[synonym] = row['english_name']
+        self.synonym_to_ingredient.update(synonym_pairs(self.df))
 
     def update_dataset(self, new_data_path):
         """
-        Update the dataset and the dictionary with new data.
+        Update the dictionary with new data. The new rows are appended to the log of the added ingredients,
+        so the base dataset and its index are not rebuilt.
         
         Parameters:
         - new_data_path: path of the CVS to process to add new synonyms.
         """
-        new_df = pd.read_csv(new_data_path)
-        self.df = pd.concat([self.df, new_df], ignore_index=True)
-        for idx, row in new_df.iterrows():
-            synonyms = row['synonyms']
-            if pd.notna(synonyms):
-                for synonym in synonyms.split('#'):
-                    self.synonym_to_ingredient[synonym] = row['english_name']
+        new_df = read_synonyms_csv(new_data_path)
+        rows = []
+        for row in new_df.to_dict('records'):
+            if pd.isna(row.get('english_name')):
+                continue
+            rows.append({
+                'ingredient': row.get('ingredient') if pd.notna(row.get('ingredient')) else None,
+                'english_name': row['english_name'],
+                'type': row.get('type') if pd.notna(row.get('type')) else None,
+                'synonyms': row['synonyms'].split('#') if pd.notna(row.get('synonyms')) else []
+            })
+        self.delta_log.append(rows)
+        self.refresh()
+
+    def _build_matcher(self) -> TokenAutomaton:
+        """
+        Build the token-level Aho-Corasick automaton mapping every name to the English name of the ingredient.
+        """
+        start_time = time.time()
+        matcher = TokenAutomaton()
+        for name, english_name in self._matcher_pairs():
+            matcher.add(name, english_name)
+        matcher.build()
+        print(f"Ingredient matcher built with {matcher.size} names in {time.time() - start_time:.2f} seconds")
+        return matcher
+
+    def _matcher_pairs(self):
+        """
+        Return the (name, English name) pairs of the Italian and English names and of the short synonyms.
+        """
+        if isinstance(self.synonym_to_ingredient, SynonymIndex):
+            return self.index.matcher_items()
+        return matcher_pairs(self.df)
+
+    def _build_name_matcher(self) -> NameMatcher:
+        """
+        Build the normalized lookup of the ingredient names and of the synonyms.
+        """
+        start_time = time.time()
+        pairs = list(self._matcher_pairs()) + list(self.synonym_to_ingredient.items())
+        name_matcher = NameMatcher(pairs)
+        print(f"Name matcher built in {time.time() - start_time:.2f} seconds")
+        return name_matcher
+
+    def get_name_matcher(self) -> NameMatcher:
+        """
+        Return the normalized lookup of the ingredient names.
+        """
+        return self._name_matcher
+
+    def get_matcher(self) -> TokenAutomaton:
+        """
+        Return the local matcher of the ingredient names.
+        """
+        return self._matcher
+
+    def find_ingredients(self, text) -> List[TokenMatch]:
+        """
+        Look for the known ingredients mentioned in a text, without calling the language model.
+
+        Parameters:
+        - text: the text to search, e.g. the clinical notes.
+
+        Returns:
+        - The non overlapping mentions found, each one with the English name of the ingredient as value.
+        """
+        deltas = self._get_deltas()
+        matches = self.get_matcher().find_all(text)
+        if len(deltas):
+            matches = merge_matches(deltas.find_all(text), matches)
+        return matches
+
+    def replace_synonyms(self, text, replacements: Dict[str, str]):
+        """
+        Replace, in a single pass, the given names in a text. Names only match whole words, ignoring case and accents;
+        overlapping names are resolved keeping the leftmost and then the longest one.
+
+        Parameters:
+        - text: the text to rewrite, e.g. the clinical notes.
+        - replacements: the names to replace, with their replacement, e.g. the ingredients extracted from the text with their standard names.
+
+        Returns:
+        - The rewritten text.
+        """
+        automaton = TokenAutomaton()
+        for name, replacement in replacements.items():
+            if name and replacement:
+                automaton.add(name, replacement)
+        return automaton.replace(text)
 
     def find_standard_name(self, synonym):
         """
@@ -51,28 +220,78 @@ class SynonymManager:
         - synonym: synonym for the ingredient to look for.
 
         Returns:
-        - Standard ingredient name for the synonym or None it didn't find one.
+        - Standard ingredient name for the synonym or the synonym itself if it didn't find one.
+        """
+        standard_name = self.lookup_standard_name(synonym)
+        return standard_name if standard_name is not None else synonym
+
+    def lookup_standard_name(self, synonym):
+        """
+        Look for the standard name of the ingredient, exact or normalized (case, accents, hydrates) only, never approximate.
+
+        Parameters:
+        - synonym: synonym for the ingredient to look for.
+
+        Returns:
+        - Standard ingredient name for the synonym, or None if it didn't find one.
         """
-        return self.synonym_to_ingredient.get(synonym, synonym)
+        deltas = self._get_deltas()
+        standard_name = self._lookup(synonym, deltas)
+        # Only the same name written differently: a similar name may be a different molecule
+        if standard_name is None and isinstance(synonym, str):
+            standard_name = deltas.lookup(synonym) or self.get_name_matcher().lookup(synonym)
+        return standard_name
 
     def find_standard_names(self, synonyms):
         """
-        Look for the standard name of the ingredient starting from its synonym.
+        Look for the standard names of a list of ingredients starting from their synonyms.
+        The synonyms not found as they are are looked up normalized (case, accents, hydrates), each distinct one once.
         
         Parameters:
-        - synonym: synonym for the ingredient to look for.
+        - synonyms: synonyms of the ingredients to look for.
+
+        Returns:
+        - List of {"n": synonym, "t": standard name}, with the synonym itself as standard name if it didn't find one.
+          With fuzzy, the synonyms not found also have "c": the (standard name, score) candidates of find_candidates.
+        """
+        deltas = self._get_deltas()
+        standard_names = [self._lookup(s, deltas) for s in synonyms]
+        for name_matcher in (deltas, self.get_name_matcher()):
+            missing = [i for i, t in enumerate(standard_names) if t is None and isinstance(synonyms[i], str)]
+            if missing:
+                found = name_matcher.lookup_many([synonyms[i] for i in missing])
+                for i, t in zip(missing, found):
+                    standard_names[i] = t
+        results = [{"n":s, "t":t if t is not None else s} for s, t in zip(synonyms, standard_names)]
+        if self.fuzzy:
+            for result, t in zip(results, standard_names):
+                if t is None and isinstance(result["n"], str):
+                    result["c"] = self.find_candidates(result["n"])
+        return results
+
+    def find_candidates(self, synonym, limit=5):
+        """
+        Look for the ingredients whose name is close to the synonym, e.g. to suggest them for a name not found.
+        The candidates may be different molecules and must be confirmed by the caller.
+
+        Parameters:
+        - synonym: synonym of the ingredient.
+        - limit: maximum number of candidates.
 
         Returns:
-        - Standard ingredient name for the synonym or None it didn't find one.
+        - List of (standard name, score) pairs by decreasing score, the added ingredients first.
         """
-        res = []
-        for s in synonyms:
-            res.append({"n":s, "t":self.synonym_to_ingredient.get(s, s)})
-        return res
+        deltas = self._get_deltas()
+        candidates = {}
+        for name_matcher in (deltas, self.get_name_matcher()):
+            for value, score in name_matcher.candidates(synonym, limit):
+                candidates.setdefault(value, score)
+        return sorted(candidates.items(), key=lambda c: -c[1])[:limit]
 
     def add_ingredient(self, ingredient, english_name, type_, synonyms):
         """
-        Add a new ingredient and update the dictionary.
+        Add a new ingredient and update the dictionary. The ingredient is appended to the log of the added ingredients,
+        so the other processes using the same dataset see it too.
         
         Parameters:
         - ingredient: ingredient name.
@@ -86,12 +305,11 @@ class SynonymManager:
             'ingredient': ingredient, 
             'english_name': english_name, 
             'type': type_, 
-            'synonyms': '#'.join(synonyms)
+            'synonyms': list(synonyms)
         }
         
-        self.df = self.df.append(new_row, ignore_index=True)
-        for synonym in synonyms:
-            self.synonym_to_ingredient[synonym] = ingredient
+        self.delta_log.append([new_row])
+        self.refresh()
 
     
 
@@ -0,0 +1,159 @@
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from unidecode import unidecode
+
+# Hydrate words stripped from the ingredient names, e.g. "amoxicillin trihydrate" -> "amoxicillin".
+# Salt and ion words are kept: sodium, potassium, calcium or a counter-ion can be the active ingredient or change it
+HYDRATE_WORDS = {
+    "anhydrous", "hydrate", "monohydrate", "dihydrate", "trihydrate", "hemihydrate", "sesquihydrate", "pentahydrate", "heptahydrate",
+    "anidro", "anidra", "idrato", "monoidrato", "diidrato", "triidrato", "emiidrato", "sesquiidrato", "pentaidrato", "eptaidrato",
+}
+
+def normalize_name(name: str) -> str:
+    """
+    Normalize an ingredient name: transliterate to ASCII, casefold and collapse the whitespace.
+    Punctuation is kept, e.g. "(+)-ketoprofen" (dexketoprofen) is not "ketoprofen".
+    """
+    return " ".join(unidecode(name).casefold().split())
+
+def strip_hydrates(normalized: str) -> str:
+    """
+    Remove the hydrate words from a normalized name. The name is returned unchanged if nothing else is left.
+    """
+    words = [w for w in normalized.split() if w not in HYDRATE_WORDS]
+    return " ".join(words) if words else normalized
+
+def _same_molecule(a: str, b: str) -> bool:
+    """
+    True if the two standard names differ at most by case, accents and hydrate words.
+    """
+    return strip_hydrates(normalize_name(a)) == strip_hydrates(normalize_name(b))
+
+def _trigrams(text: str) -> List[str]:
+    padded = f"  {text} "
+    return list({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+def bounded_edit_distance(a: str, b: str, max_distance: int) -> int:
+    """
+    Levenshtein distance between a and b, or max_distance + 1 as soon as it is known to be larger than max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i] + [0] * len(b)
+        for j, cb in enumerate(b, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+# Lookup of the ingredient names: exact match on the normalized name (case and accents), then on the name without hydrates.
+# A name is never replaced by a different one: the names close to an unknown one, sharing character trigrams within an
+# edit distance bound, are only returned as scored candidates by candidates()
+class NameMatcher:
+    def __init__(self, pairs: Iterable[Tuple[str, str]], max_length: int = 40, max_candidates: int = 32):
+        """
+        Build the lookup tables.
+
+        Parameters:
+        - pairs: the (name, standard name) pairs. A normalized name of different molecules is ambiguous and is not indexed;
+          among the hydrates of the same molecule the last pair wins, as in a dict.
+        - max_length: longer names are not indexed, e.g. the systematic chemical names.
+        - max_candidates: number of names sharing the most trigrams with the query that are compared by edit distance.
+        """
+        self.max_candidates = max_candidates
+        self._normalized: Dict[str, str] = {}
+        self._stripped: Dict[str, str] = {}
+        ambiguous = set()
+        for name, value in pairs:
+            if not isinstance(name, str) or not isinstance(value, str) or len(name) > max_length:
+                continue
+            key = normalize_name(name)
+            if key:
+                if key in self._normalized and not _same_molecule(self._normalized[key], value):
+                    ambiguous.add(key)
+                self._normalized[key] = value
+        for key in ambiguous:
+            del self._normalized[key]
+
+        ambiguous = set()
+        for key, value in self._normalized.items():
+            stripped = strip_hydrates(key)
+            if stripped != key:
+                if stripped in self._stripped and not _same_molecule(self._stripped[stripped], value):
+                    ambiguous.add(stripped)
+                self._stripped.setdefault(stripped, value)
+        for key in ambiguous:
+            del self._stripped[key]
+
+        self._names = list(self._normalized)
+        self._postings: Dict[str, List[int]] = {}
+        for i, key in enumerate(self._names):
+            for gram in _trigrams(key):
+                self._postings.setdefault(gram, []).append(i)
+
+    def max_distance(self, text: str) -> int:
+        """
+        Edit distance allowed for a query: none for very short names, then one error plus one every twelve characters, up to three.
+        """
+        if len(text) <= 4:
+            return 0
+        return min(3, 1 + len(text) // 12)
+
+    def candidates(self, name: str, limit: int = 5) -> List[Tuple[str, float]]:
+        """
+        Return the standard names of the ingredients whose name is close to the given one, for a person or a caller to confirm.
+
+        Parameters:
+        - name: the ingredient name.
+        - limit: maximum number of candidates.
+
+        Returns:
+        - The (standard name, score) pairs by decreasing score, the score being 1 minus the edit distance over the name length.
+        """
+        key = strip_hydrates(normalize_name(name)) if isinstance(name, str) else ""
+        max_distance = self.max_distance(key)
+        if max_distance == 0:
+            return []
+        counts = Counter()
+        for gram in _trigrams(key):
+            counts.update(self._postings.get(gram, ()))
+        scores = {}
+        for i, _ in counts.most_common(self.max_candidates):
+            name = self._names[i]
+            distance = bounded_edit_distance(key, name, max_distance)
+            if distance <= max_distance:
+                value = self._normalized[name]
+                score = 1 - distance / max(len(key), len(name))
+                scores[value] = max(score, scores.get(value, 0))
+        return sorted(scores.items(), key=lambda c: -c[1])[:limit]
+
+    def lookup(self, name: str) -> Optional[str]:
+        """
+        Return the standard name of the ingredient, or None if the normalized name is not known.
+        """
+        key = normalize_name(name)
+        if not key:
+            return None
+        value = self._normalized.get(key)
+        if value is not None:
+            return value
+        stripped = strip_hydrates(key)
+        return self._normalized.get(stripped) or self._stripped.get(stripped)
+
+    def lookup_many(self, names: List[str]) -> List[Optional[str]]:
+        """
+        Batch version of lookup: each distinct normalized name is resolved once.
+        """
+        resolved = {}
+        results = []
+        for name in names:
+            key = normalize_name(name) if isinstance(name, str) else ""
+            if key not in resolved:
+                resolved[key] = self.lookup(name) if key else None
+            results.append(resolved[key])
+        return results
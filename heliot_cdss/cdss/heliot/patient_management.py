@@ -1,11 +1,55 @@
 import tiledb
 import numpy as np
-from typing import Dict, Optional
+import fcntl
+import os
+import threading
+import time
+import zlib
+from contextlib import ExitStack
+from typing import Dict, List, Optional
+from unidecode import unidecode
 
 class MedicalNarrativeDB:
-    def __init__(self, db_uri="medical_narrative", tiles=None):
+    def __init__(self, db_uri="medical_narrative", tiles=None, handles=None, profile_uri=None, log_uri=None):
         self.db_uri = db_uri
         self.tiles = tiles
+        # TileDBHandleManager opzionale che mantiene aperti gli array in lettura tra le chiamate
+        self.handles = handles
+        # Array del profilo allergologico dei pazienti, accanto alle note cliniche
+        self.profile_uri = profile_uri if profile_uri else f"{db_uri}_profile"
+        # Log append-only delle versioni delle note, per le letture a una data (audit)
+        self.log_uri = log_uri if log_uri else f"{db_uri}_log"
+        # Lock per paziente (a strisce) che serializzano lettura, unione e scrittura del profilo
+        self._profile_locks = [threading.Lock() for _ in range(64)]
+        # Serializza la creazione del log e del profilo nei database creati prima di essi
+        self._schema_lock = threading.Lock()
+        # Thread di compattazione in background, avviato da start_compaction. Compatta solo il processo che tiene
+        # il lock del file {db_uri}_compaction.lock, così i worker che condividono il database non compattano insieme
+        self._compactor = None
+        self._compaction_stop = threading.Event()
+        self._compaction_lock_file = None
+        # Ora del consolidamento degli array con frammenti ancora da rimuovere (vacuum)
+        self._consolidated = {}
+        # Array di cui è già stata verificata l'esistenza
+        self._existing = set()
+
+    def _query(self, uri: str, fn):
+        """
+        Esegue una lettura sull'array: sull'handle condiviso, riaperto e riprovato una volta se la lettura fallisce,
+        o su un array aperto per l'occasione
+        """
+        if self.handles is not None:
+            return self.handles.query(uri, fn)
+        with tiledb.open(uri, mode="r") as array:
+            return fn(array)
+
+    def _write(self, uri: str, mode: str = "w"):
+        """
+        Apre l'array in scrittura (o cancellazione)
+        """
+        if self.handles is not None:
+            return self.handles.write(uri, mode=mode)
+        return tiledb.open(uri, mode=mode)
 
     def create_DBSchema(self):
         """
@@ -41,71 +85,503 @@ class MedicalNarrativeDB:
             print(f"Errore durante la creazione del database: {e}")
             raise
 
-    def search_patient(self, patient_id: str) -> Optional[Dict]:
+        self.create_log_schema()
+        self.create_profile_schema()
+
+    def create_log_schema(self):
+        """
+        Crea lo schema del log delle note con due dimensioni (patient_id, timestamp)
+        e un attributo (clinical_notes). Ogni aggiornamento aggiunge una cella, le precedenti non vengono modificate
+        """
+        try:
+            domain = tiledb.Domain(
+                tiledb.Dim(name="patient_id", tile=self.tiles, dtype="ascii"),
+                # Timestamp in millisecondi
+                tiledb.Dim(name="timestamp", domain=(0, np.iinfo(np.int64).max - 1), tile=None, dtype=np.int64)
+            )
+
+            attrs = [
+                tiledb.Attr(name="clinical_notes",
+                           dtype=str,
+                           filters=tiledb.FilterList([tiledb.ZstdFilter(level=3)]))
+            ]
+
+            schema = tiledb.ArraySchema(domain=domain, attrs=attrs, sparse=True)
+            tiledb.Array.create(self.log_uri, schema)
+            print(f"Log {self.log_uri} creato con successo")
+
+        except Exception as e:
+            print(f"Errore durante la creazione del log: {e}")
+            raise
+
+    def create_profile_schema(self):
+        """
+        Crea lo schema del profilo allergologico con due dimensioni (patient_id, allergen)
+        e gli attributi status, reactions, first_seen e last_seen
+        """
+        try:
+            domain = tiledb.Domain(
+                tiledb.Dim(name="patient_id", tile=self.tiles, dtype="ascii"),
+                tiledb.Dim(name="allergen", tile=self.tiles, dtype="ascii")
+            )
+
+            attrs = [
+                # allergy, intolerance o tolerated
+                tiledb.Attr(name="status", dtype=str),
+                # Tipi di reazione separati da '#'
+                tiledb.Attr(name="reactions", dtype=str),
+                # Timestamp (ms) della prima e dell'ultima nota che riporta l'allergene
+                tiledb.Attr(name="first_seen", dtype=np.int64),
+                tiledb.Attr(name="last_seen", dtype=np.int64)
+            ]
+
+            # Una scrittura sulle stesse coordinate sostituisce la cella precedente
+            schema = tiledb.ArraySchema(domain=domain, attrs=attrs, sparse=True)
+            tiledb.Array.create(self.profile_uri, schema)
+            print(f"Profilo {self.profile_uri} creato con successo")
+
+        except Exception as e:
+            print(f"Errore durante la creazione del profilo: {e}")
+            raise
+
+    def _array_exists(self, uri: str) -> bool:
+        """
+        Verifica se l'array esiste, i database creati prima del profilo e del log non li hanno
+        """
+        if uri in self._existing:
+            return True
+        if tiledb.object_type(uri) == "array":
+            self._existing.add(uri)
+            return True
+        return False
+
+    def _ensure_array(self, uri: str, create):
+        """
+        Crea l'array con la funzione data se non esiste ancora
+        """
+        if not self._array_exists(uri):
+            with self._schema_lock:
+                if not self._array_exists(uri):
+                    create()
+
+    def _profile_records(self, data) -> Dict[str, List[Dict]]:
+        """
+        Raggruppa per paziente le righe lette dal profilo, con le reazioni come lista
+        """
+        profiles = {}
+        for record in data.sort_values(["patient_id", "allergen"]).to_dict('records'):
+            record['reactions'] = [r for r in record['reactions'].split('#') if r]
+            profiles.setdefault(record['patient_id'], []).append(record)
+        return profiles
+
+    def search_patient(self, patient_id: str, as_of: int = None) -> Optional[Dict]:
         """
         Cerca i dati clinici di uno specifico paziente
         
         Args:
             patient_id: ID del paziente da cercare
+            as_of: timestamp (ms) per leggere le note valide a quella data dal log; se None legge l'ultima versione
             
         Returns:
             Dict con i dati del paziente o None se non trovato
+
+        Raises:
+            tiledb.TileDBError se la lettura fallisce anche riaprendo l'array, invece di considerare il paziente assente
         """
+        if as_of is not None:
+            history = self.search_patient_history(patient_id, as_of)
+            return history[-1] if history else None
+        if not self._array_exists(self.db_uri):
+            return None
         try:
-            with tiledb.open(self.db_uri, mode="r") as array:
-                # Query per il paziente specifico
-                #data = array.query(coords=True).df[patient_id]
-                
-                data = array.query(attrs=['clinical_notes']).df[patient_id]
+            # Query per il paziente specifico
+            #data = array.query(coords=True).df[patient_id]
+            
+            data = self._query(self.db_uri, lambda array: array.query(attrs=['clinical_notes']).df[patient_id])
 
-                if data.empty:
-                    return None
-                
-                # Converti il risultato in dizionario
-                #patient_data = {
-                #    'patient_id': patient_id,
-                #    'clinical_notes': data['clinical_notes'].iloc[0]
-                #}
-                
-                patient_data = data.iloc[0].to_dict()
-                # Converti da bytes a string se necessario
-                #if isinstance(patient_data['clinical_notes'], bytes):
-                #patient_data['clinical_notes'] = patient_data['clinical_notes'].decode('utf-8')
-                
-                return patient_data
+            if data.empty:
+                return None
+            
+            # Converti il risultato in dizionario
+            #patient_data = {
+            #    'patient_id': patient_id,
+            #    'clinical_notes': data['clinical_notes'].iloc[0]
+            #}
+            
+            patient_data = data.iloc[0].to_dict()
+            # Converti da bytes a string se necessario
+            #if isinstance(patient_data['clinical_notes'], bytes):
+            #patient_data['clinical_notes'] = patient_data['clinical_notes'].decode('utf-8')
+            
+            return patient_data
                 
         except Exception as e:
             print(f"Errore durante la ricerca del paziente {patient_id}: {e}")
-            return None
+            raise
 
-    def update_patient(self, patient_id: str, clinical_notes: str) -> bool:
+    def search_patients(self, patient_ids: List[str]) -> Dict[str, Dict]:
         """
-        Inserisce o aggiorna i dati clinici di uno specifico paziente
+        Cerca i dati clinici di più pazienti con una sola lettura dell'array
+
+        Args:
+            patient_ids: ID dei pazienti da cercare
+
+        Returns:
+            Dict con i dati di ogni paziente trovato, indicizzato per ID; i pazienti non trovati sono assenti
+
+        Raises:
+            tiledb.TileDBError se la lettura fallisce anche riaprendo l'array
+        """
+        # Rimuove gli ID duplicati mantenendo l'ordine
+        patient_ids = list(dict.fromkeys(patient_ids))
+        if not patient_ids or not self._array_exists(self.db_uri):
+            return {}
+        try:
+            # Query multi-punto sulla dimensione patient_id
+            data = self._query(self.db_uri, lambda array: array.query(attrs=['clinical_notes']).df[patient_ids])
+
+            return {record['patient_id']: record for record in data.to_dict('records')}
+
+        except Exception as e:
+            print(f"Errore durante la ricerca di {len(patient_ids)} pazienti: {e}")
+            raise
+
+    def search_patient_history(self, patient_id: str, as_of: int = None) -> List[Dict]:
+        """
+        Legge dal log tutte le versioni delle note di un paziente
+
+        Args:
+            patient_id: ID del paziente
+            as_of: timestamp (ms) dell'ultima versione da leggere; se None tutte le versioni
+
+        Returns:
+            Lista delle versioni (patient_id, timestamp, clinical_notes) in ordine di tempo, vuota se non trovato
+        """
+        if not self._array_exists(self.log_uri):
+            return []
+        try:
+            end = as_of if as_of is not None else np.iinfo(np.int64).max - 1
+            data = self._query(self.log_uri, lambda array: array.query(attrs=['clinical_notes']).df[patient_id, 0:end])
+            return data.sort_values('timestamp').to_dict('records')
+
+        except Exception as e:
+            print(f"Errore durante la lettura del log del paziente {patient_id}: {e}")
+            raise
+
+    def search_profile(self, patient_id: str) -> List[Dict]:
+        """
+        Legge il profilo allergologico di un paziente con una sola query
+
+        Args:
+            patient_id: ID del paziente
+
+        Returns:
+            Lista degli allergeni del paziente (allergen, status, reactions, first_seen, last_seen), vuota se non trovato
+        """
+        return self.search_profiles([patient_id]).get(patient_id, [])
+
+    def search_profiles(self, patient_ids: List[str]) -> Dict[str, List[Dict]]:
+        """
+        Legge i profili allergologici di più pazienti con una sola query
+
+        Args:
+            patient_ids: ID dei pazienti
+
+        Returns:
+            Dict con la lista degli allergeni di ogni paziente trovato, indicizzato per ID
+        """
+        patient_ids = list(dict.fromkeys(patient_ids))
+        if not patient_ids or not self._array_exists(self.profile_uri):
+            return {}
+        try:
+            data = self._query(self.profile_uri, lambda array: array.df[patient_ids])
+            return self._profile_records(data)
+
+        except Exception as e:
+            print(f"Errore durante la lettura del profilo di {len(patient_ids)} pazienti: {e}")
+            raise
+
+    @staticmethod
+    def merge_profile(current: List[Dict], entries: List[Dict], timestamp: int) -> List[Dict]:
+        """
+        Unisce al profilo di un paziente gli allergeni estratti dalle note: gli allergeni nuovi vengono aggiunti,
+        per quelli già presenti le reazioni vengono unite e lo stato diventa quello dell'ultima nota
+
+        Args:
+            current: profilo attuale del paziente
+            entries: allergeni estratti dalle note, ognuno con allergen, status e reactions (lista)
+            timestamp: timestamp (ms) delle note
+
+        Returns:
+            Lista degli allergeni modificati
+        """
+        current = {record['allergen']: record for record in current}
+        rows = {}
+        for entry in entries:
+            # Le dimensioni ascii richiedono nomi senza accenti
+            allergen = unidecode(entry['allergen']).strip().casefold()
+            if not allergen:
+                continue
+            previous = rows.get(allergen) or current.get(allergen)
+            reactions = list(dict.fromkeys((previous['reactions'] if previous else []) + list(entry.get('reactions') or [])))
+            rows[allergen] = {
+                'allergen': allergen,
+                'status': entry['status'],
+                'reactions': reactions,
+                'first_seen': previous['first_seen'] if previous else timestamp,
+                'last_seen': timestamp
+            }
+        return list(rows.values())
+
+    def update_profile(self, patient_id: str, entries: List[Dict], timestamp: int = None) -> bool:
+        """
+        Aggiorna in modo incrementale il profilo allergologico di un paziente (vedi merge_profile).
+        Vengono scritte solo le celle degli allergeni dati
+
+        Args:
+            patient_id: ID del paziente
+            entries: allergeni estratti dalle note, ognuno con allergen, status e reactions (lista)
+            timestamp: timestamp (ms) delle note, l'ora corrente se None
+
+        Returns:
+            bool: True se l'operazione è riuscita, False altrimenti
+        """
+        return self.update_profiles({patient_id: entries}, timestamp)
+
+    def update_profiles(self, entries: Dict[str, List[Dict]], timestamp: int = None) -> bool:
+        """
+        Aggiorna i profili allergologici di più pazienti con una lettura e una scrittura dell'array.
+        Gli aggiornamenti concorrenti degli stessi pazienti nel processo vengono serializzati, così nessun allergene va perso
+
+        Args:
+            entries: allergeni estratti dalle note di ogni paziente, indicizzati per ID
+            timestamp: timestamp (ms) delle note, l'ora corrente se None
+
+        Returns:
+            bool: True se l'operazione è riuscita, False altrimenti
+        """
+        entries = {pid: e for pid, e in entries.items() if e}
+        if not entries:
+            return True
+        timestamp = timestamp if timestamp is not None else int(time.time() * 1000)
+        try:
+            with self._lock_profiles(list(entries)):
+                return self._update_profiles(entries, timestamp)
+
+        except Exception as e:
+            print(f"Errore durante l'aggiornamento del profilo di {len(entries)} pazienti: {e}")
+            return False
+
+    def _lock_profiles(self, patient_ids: List[str]) -> ExitStack:
+        """
+        Acquisisce i lock dei pazienti, sempre nello stesso ordine per evitare deadlock
+        """
+        stack = ExitStack()
+        for index in sorted({zlib.crc32(pid.encode("utf-8")) % len(self._profile_locks) for pid in patient_ids}):
+            stack.enter_context(self._profile_locks[index])
+        return stack
+
+    def _update_profiles(self, entries: Dict[str, List[Dict]], timestamp: int) -> bool:
+        """
+        Legge, unisce e scrive i profili dei pazienti; va chiamato con i lock dei pazienti acquisiti
+        """
+        self._ensure_array(self.profile_uri, self.create_profile_schema)
+        profiles = self.search_profiles(list(entries))
+
+        patient_ids, records = [], []
+        for patient_id, patient_entries in entries.items():
+            rows = self.merge_profile(profiles.get(patient_id, []), patient_entries, timestamp)
+            patient_ids += [patient_id] * len(rows)
+            records += rows
+
+        if not records:
+            return True
+        with self._write(self.profile_uri) as array:
+            array[patient_ids, [r['allergen'] for r in records]] = {
+                'status': np.array([r['status'] for r in records], dtype=object),
+                'reactions': np.array(['#'.join(r['reactions']) for r in records], dtype=object),
+                'first_seen': np.array([r['first_seen'] for r in records], dtype=np.int64),
+                'last_seen': np.array([r['last_seen'] for r in records], dtype=np.int64)
+            }
+        print(f"Profilo di {len(entries)} pazienti aggiornato con {len(records)} allergeni")
+        return True
+
+    def update_patient(self, patient_id: str, clinical_notes: str, timestamp: int = None) -> bool:
+        """
+        Inserisce o aggiorna i dati clinici di uno specifico paziente. L'ultima versione sostituisce la precedente
+        nell'array principale, letto da search_patient, e viene aggiunta al log per le letture a una data
         
         Args:
             patient_id: ID del paziente
             clinical_notes: Note cliniche del paziente
+            timestamp: timestamp (ms) della versione, l'ora corrente se None
             
         Returns:
             bool: True se l'operazione è riuscita, False altrimenti
         """
+        return self.update_patients([{'patient_id': patient_id, 'clinical_notes': clinical_notes, 'timestamp': timestamp}])
+
+    def update_patients(self, updates: List[Dict]) -> bool:
+        """
+        Inserisce o aggiorna le note di più pazienti con una sola scrittura del log e una dell'array principale
+
+        Args:
+            updates: aggiornamenti in ordine di arrivo, ognuno con patient_id, clinical_notes e timestamp (ms, l'ora corrente se None)
+
+        Returns:
+            bool: True se l'operazione è riuscita, False altrimenti
+        """
+        if not updates:
+            return True
+        now = int(time.time() * 1000)
+        # Per ogni cella vale l'ultimo aggiornamento: TileDB non accetta coordinate duplicate nella stessa scrittura
+        versions, latest = {}, {}
+        for update in updates:
+            timestamp = update.get('timestamp')
+            timestamp = timestamp if timestamp is not None else now
+            versions[(update['patient_id'], timestamp)] = update['clinical_notes']
+            latest[update['patient_id']] = update['clinical_notes']
         try:
-            with tiledb.open(self.db_uri, mode="w") as array:
-                # Prepara i dati per l'inserimento
-                data = {
-                    'clinical_notes': np.array([clinical_notes])
+            self._ensure_array(self.log_uri, self.create_log_schema)
+            with self._write(self.log_uri) as array:
+                array[[pid for pid, _ in versions], np.array([ts for _, ts in versions], dtype=np.int64)] = {
+                    'clinical_notes': np.array(list(versions.values()), dtype=object)
                 }
-                
+
+            with self._write(self.db_uri) as array:
                 # Esegui l'inserimento/aggiornamento
-                array[patient_id] = data
-                
-                print(f"Dati del paziente {patient_id} inseriti/aggiornati con successo")
-                return True
-                
+                array[list(latest)] = {'clinical_notes': np.array(list(latest.values()), dtype=object)}
+
+            if len(latest) == 1:
+                print(f"Dati del paziente {next(iter(latest))} inseriti/aggiornati con successo")
+            else:
+                print(f"Dati di {len(latest)} pazienti inseriti/aggiornati con successo")
+            return True
+
         except Exception as e:
-            print(f"Errore durante l'inserimento/aggiornamento del paziente {patient_id}: {e}")
+            print(f"Errore durante l'inserimento/aggiornamento di {len(latest)} pazienti: {e}")
             return False
 
+    def _fragment_count(self, uri: str) -> int:
+        """
+        Numero di frammenti dell'array, letto senza aprirlo
+        """
+        return len(tiledb.array_fragments(uri))
+
+    def compact(self, min_fragments: int = 16, buffer_size: int = 50000000, vacuum_delay: float = 60) -> List[str]:
+        """
+        Consolida i frammenti delle note, del log e del profilo, così le letture aprono un numero limitato di frammenti
+        qualunque sia il numero di aggiornamenti. Le versioni del log vengono mantenute.
+        I frammenti consolidati vengono rimossi (vacuum) solo vacuum_delay secondi dopo, alla chiamata successiva:
+        nel frattempo gli handle aperti dagli altri processi passano ai frammenti consolidati
+
+        Args:
+            min_fragments: numero di frammenti oltre il quale un array viene consolidato
+            buffer_size: memoria usata dai buffer di consolidamento
+            vacuum_delay: secondi tra il consolidamento e la rimozione dei frammenti consolidati (0 li rimuove subito)
+
+        Returns:
+            Lista degli array consolidati
+        """
+        compacted = []
+        for uri in [self.db_uri, self.log_uri, self.profile_uri]:
+            try:
+                if not self._array_exists(uri):
+                    continue
+                self._vacuum_consolidated(uri, vacuum_delay)
+                if self._fragment_count(uri) < min_fragments:
+                    continue
+                tiledb.consolidate(uri, config=tiledb.Config({"sm.consolidation.buffer_size": str(buffer_size)}))
+                # Consolida anche i metadati dei frammenti, così l'apertura dell'array legge un solo file
+                tiledb.consolidate(uri, config=tiledb.Config({"sm.consolidation.mode": "fragment_meta"}))
+                self._consolidated[uri] = time.time()
+                if self.handles is not None:
+                    self.handles.invalidate(uri)
+                compacted.append(uri)
+                print(f"Array {uri} consolidato")
+                if vacuum_delay <= 0:
+                    self._vacuum_consolidated(uri, vacuum_delay)
+
+            except Exception as e:
+                print(f"Errore durante il consolidamento di {uri}: {e}")
+        return compacted
+
+    def _vacuum_consolidated(self, uri: str, vacuum_delay: float):
+        """
+        Rimuove i frammenti già consolidati dell'array se sono passati almeno vacuum_delay secondi dal consolidamento.
+        I frammenti consolidati da un'esecuzione precedente attendono vacuum_delay da quando vengono trovati
+        """
+        if uri not in self._consolidated:
+            if not tiledb.array_fragments(uri).to_vacuum:
+                return
+            self._consolidated[uri] = time.time()
+        if time.time() - self._consolidated[uri] < vacuum_delay:
+            return
+        # L'handle di questo processo viene chiuso prima di rimuovere i file che legge
+        if self.handles is not None:
+            self.handles.drop(uri)
+        tiledb.vacuum(uri)
+        tiledb.vacuum(uri, config=tiledb.Config({"sm.vacuum.mode": "fragment_meta"}))
+        del self._consolidated[uri]
+        print(f"Frammenti consolidati di {uri} rimossi")
+
+    def _own_compaction(self) -> bool:
+        """
+        Acquisisce, se libero, il lock di compattazione del database. Il lock resta al processo fino a stop_compaction
+        o alla sua uscita, poi un altro processo lo acquisisce al controllo successivo
+
+        Returns:
+            True se questo processo è responsabile della compattazione
+        """
+        if self._compaction_lock_file is not None:
+            return True
+        try:
+            lock_file = open(f"{self.db_uri}_compaction.lock", "a")
+        except OSError as e:
+            print(f"Impossibile aprire il lock di compattazione di {self.db_uri}: {e}")
+            return False
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._compaction_lock_file = lock_file
+        print(f"Compattazione di {self.db_uri} eseguita da questo processo ({os.getpid()})")
+        return True
+
+    def start_compaction(self, interval: float = 300, min_fragments: int = 16):
+        """
+        Avvia un thread in background che ogni interval secondi consolida gli array con almeno min_fragments frammenti.
+        Tra i processi che condividono il database compatta solo quello che tiene il lock, gli altri restano in attesa
+
+        Args:
+            interval: secondi tra due controlli
+            min_fragments: numero di frammenti oltre il quale un array viene consolidato
+        """
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compaction_stop.clear()
+
+        def run():
+            while not self._compaction_stop.wait(interval):
+                if self._own_compaction():
+                    self.compact(min_fragments)
+
+        self._compactor = threading.Thread(target=run, name="heliot-narrative-compaction", daemon=True)
+        self._compactor.start()
+
+    def stop_compaction(self):
+        """
+        Ferma il thread di compattazione e rilascia il lock di compattazione
+        """
+        self._compaction_stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        if self._compaction_lock_file is not None:
+            self._compaction_lock_file.close()
+            self._compaction_lock_file = None
+
 if __name__ == "__main__":
 
     # Crea un'istanza della classe
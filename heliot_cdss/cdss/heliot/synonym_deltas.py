@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .ingredient_matcher import TokenAutomaton, TokenMatch, merge_matches
+from .name_matcher import NameMatcher
+from .synonym_index import matcher_names
+
+def default_log_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + ".delta.jsonl"
+
+# Lookup tables of a group of added ingredients
+class _DeltaSegment:
+    def __init__(self, rows: List[Dict]):
+        self.rows = rows
+        self.synonym_to_ingredient = {}
+        pairs = []
+        for row in rows:
+            for synonym in row['synonyms']:
+                self.synonym_to_ingredient[synonym] = row['english_name']
+            pairs.extend((name, row['english_name']) for name in matcher_names({**row, 'synonyms': '#'.join(row['synonyms'])}))
+
+        self.matcher = TokenAutomaton()
+        for name, english_name in pairs:
+            self.matcher.add(name, english_name)
+        self.matcher.build()
+        self.name_matcher = NameMatcher(pairs + list(self.synonym_to_ingredient.items()))
+
+# Immutable snapshot of the ingredients added after the synonyms dataset was loaded.
+# A change builds a new snapshot, which replaces the old one atomically, so readers never wait for writers.
+# The rows are kept in segments, oldest first, shared with the previous snapshot: the new rows get a segment of their
+# own, merged with the previous ones of the same size, so each row is indexed again only a logarithmic number of times
+class SynonymDeltas:
+    def __init__(self, rows: List[Dict] = None, segments: List[_DeltaSegment] = None, synonym_to_ingredient: Dict = None):
+        """
+        Build the lookup tables of the added ingredients.
+
+        Parameters:
+        - rows: the added ingredients, each one with ingredient, english_name, type and synonyms (a list).
+        - segments, synonym_to_ingredient: the tables already built by with_rows, used instead of rows.
+        """
+        if segments is None:
+            segments = [_DeltaSegment(rows)] if rows else []
+            synonym_to_ingredient = dict(segments[0].synonym_to_ingredient) if segments else {}
+        self.segments = segments
+        self.synonym_to_ingredient = synonym_to_ingredient
+
+    @property
+    def rows(self) -> List[Dict]:
+        return [row for segment in self.segments for row in segment.rows]
+
+    def __len__(self) -> int:
+        return sum(len(segment.rows) for segment in self.segments)
+
+    def with_rows(self, rows: List[Dict]) -> "SynonymDeltas":
+        """
+        Return a new snapshot with the given ingredients added. Only the new rows, and the segments they are merged with, are indexed.
+        """
+        if not rows:
+            return self
+        segments = self.segments + [_DeltaSegment(list(rows))]
+        while len(segments) > 1 and len(segments[-2].rows) <= len(segments[-1].rows):
+            last = segments.pop()
+            segments.append(_DeltaSegment(segments.pop().rows + last.rows))
+        return SynonymDeltas(segments=segments, synonym_to_ingredient={**self.synonym_to_ingredient, **segments[-1].synonym_to_ingredient})
+
+    def find_all(self, text: str) -> List[TokenMatch]:
+        """
+        Find the added ingredients mentioned in a text. On the same span, the most recently added one wins.
+        """
+        return merge_matches(*(segment.matcher.find_all(text) for segment in reversed(self.segments)))
+
+    def lookup(self, name: str) -> Optional[str]:
+        """
+        Normalized lookup of an added ingredient, as NameMatcher.lookup. The most recently added one wins.
+        """
+        for segment in reversed(self.segments):
+            standard_name = segment.name_matcher.lookup(name)
+            if standard_name is not None:
+                return standard_name
+        return None
+
+    def lookup_many(self, names: List[str]) -> List[Optional[str]]:
+        """
+        Batch version of lookup.
+        """
+        results = [None] * len(names)
+        for segment in reversed(self.segments):
+            missing = [i for i, r in enumerate(results) if r is None]
+            if not missing:
+                break
+            for i, standard_name in zip(missing, segment.name_matcher.lookup_many([names[i] for i in missing])):
+                results[i] = standard_name
+        return results
+
+    def candidates(self, name: str, limit: int = 5) -> List[Tuple[str, float]]:
+        """
+        Approximate candidates among the added ingredients, as NameMatcher.candidates.
+        """
+        scores = {}
+        for segment in self.segments:
+            for value, score in segment.name_matcher.candidates(name, limit):
+                scores[value] = max(score, scores.get(value, 0))
+        return sorted(scores.items(), key=lambda c: -c[1])[:limit]
+
+# Append-only log of the added ingredients, one JSON record per line. Every process using the same dataset
+# applies the records it has not read yet, so the changes made by a worker reach the others without a restart.
+# The log can be truncated or rotated once folded into the csv file: the change is detected from the file identity,
+# size and first record, and the log is read again from the start
+class DeltaLog:
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        # (device, inode), modification time and first record of the log at the last read
+        self._file_id = None
+        self._mtime = None
+        self._head = b""
+        self._lock = threading.Lock()
+
+    def append(self, rows: List[Dict]):
+        """
+        Append the ingredients to the log with a single write.
+        """
+        if not rows:
+            return
+        now = time.time()
+        data = "".join(json.dumps({"op": "add", "ts": now, **row}, ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def has_changes(self) -> bool:
+        """
+        Return True if the log changed since the last read: it grew, or it was truncated or replaced.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return st.st_size != self.offset or (st.st_dev, st.st_ino) != self._file_id or st.st_mtime_ns != self._mtime
+
+    def _rotated(self, f, st) -> bool:
+        """
+        Return True if the open log is not the one read so far: another file, shorter, or starting with another record.
+        """
+        if self.offset == 0:
+            return False
+        if (st.st_dev, st.st_ino) != self._file_id or st.st_size < self.offset:
+            return True
+        f.seek(0)
+        return f.read(len(self._head)) != self._head
+
+    def read_new(self) -> List[Dict]:
+        """
+        Read the complete records appended since the last read. A record still being written is read next time.
+        """
+        with self._lock:
+            try:
+                with open(self.path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    if self._rotated(f, st):
+                        print(f"The log {self.path} was truncated or rotated, reading it from the start")
+                        self.offset = 0
+                    f.seek(self.offset)
+                    data = f.read()
+            except OSError:
+                return []
+            end = data.rfind(b"\n") + 1
+            if self.offset == 0:
+                self._head = data[:data.find(b"\n") + 1]
+            self.offset += end
+            self._file_id = (st.st_dev, st.st_ino)
+            self._mtime = st.st_mtime_ns
+
+        rows = []
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                print(f"Skipping a malformed record of {self.path}: {e}")
+                continue
+            if record.get("op") == "add":
+                rows.append({k: record.get(k) for k in ("ingredient", "english_name", "type")} | {"synonyms": list(record.get("synonyms") or [])})
+        return rows
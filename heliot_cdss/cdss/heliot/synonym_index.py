@@ -0,0 +1,241 @@
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import time
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Synonyms used by the local matcher: short names only, no registry codes (CAS, EINECS, ChEBI ...) or systematic names
+MATCHER_MAX_TOKENS = 4
+MATCHER_MAX_LENGTH = 40
+_CODE_LIKE_RE = re.compile(r"^[\d\W]|\d{3,}|:")
+
+INDEX_MAGIC = b"HSYN"
+INDEX_VERSION = 1
+
+def read_synonyms_csv(path: str) -> pd.DataFrame:
+    """
+    Read the synonyms dataset, separated by commas or by semicolons.
+    """
+    try:
+        return pd.read_csv(path, dtype=str)
+    except:
+        return pd.read_csv(path, delimiter=';', dtype=str)
+
+def synonym_pairs(df: pd.DataFrame) -> List[Tuple[str, str]]:
+    """
+    Return the (synonym, English name) pairs of the dataset, in dataset order. When a synonym is repeated the last pair wins.
+    """
+    rows = df[['english_name', 'synonyms']].dropna()
+    exploded = rows.assign(synonyms=rows['synonyms'].str.split('#')).explode('synonyms')
+    return list(zip(exploded['synonyms'], exploded['english_name']))
+
+def matcher_names(row: Dict) -> List[str]:
+    """
+    Return the names of a dataset row used by the local matcher: the Italian and English names and the short synonyms.
+    """
+    names = [row['ingredient'], row['english_name']]
+    if pd.notna(row['synonyms']):
+        for synonym in row['synonyms'].split('#'):
+            if len(synonym) <= MATCHER_MAX_LENGTH and len(synonym.split()) <= MATCHER_MAX_TOKENS and not _CODE_LIKE_RE.search(synonym):
+                names.append(synonym)
+    return [n for n in names if pd.notna(n) and len(n.strip()) > 2]
+
+def matcher_pairs(df: pd.DataFrame) -> List[Tuple[str, str]]:
+    """
+    Return the (name, English name) pairs used to build the local matcher.
+    """
+    pairs = []
+    for row in df[['ingredient', 'english_name', 'synonyms']].to_dict('records'):
+        if pd.isna(row['english_name']):
+            continue
+        pairs.extend((name, row['english_name']) for name in matcher_names(row))
+    return pairs
+
+def default_index_path(csv_path: str) -> str:
+    return os.path.splitext(csv_path)[0] + ".idx"
+
+def _source_signature(csv_path: str) -> Dict:
+    st = os.stat(csv_path)
+    return {"source_size": st.st_size, "source_mtime_ns": st.st_mtime_ns}
+
+def _string_table(strings: List[str]) -> Tuple[np.ndarray, bytes]:
+    """
+    Encode the strings as a blob plus the offsets of each string (one more than the strings).
+    """
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+    return offsets, b"".join(encoded)
+
+def build_synonym_index(csv_path: str, index_path: str = None) -> str:
+    """
+    Compile the synonyms dataset into a single binary file that SynonymIndex memory-maps.
+
+    The file has a small JSON header, then:
+    - the sorted synonyms (offsets and UTF-8 blob) with the id of their English name,
+    - the names of the local matcher (offsets and UTF-8 blob) with the id of their English name,
+    - the English names (offsets and UTF-8 blob).
+
+    Parameters:
+    - csv_path: path of the synonyms csv file.
+    - index_path: path of the index, by default the csv path with the .idx extension.
+
+    Returns:
+    - The path of the index.
+    """
+    start_time = time.time()
+    index_path = index_path or default_index_path(csv_path)
+    df = read_synonyms_csv(csv_path)
+
+    # dict: the last pair of a repeated synonym wins, as in the in-memory dictionary
+    synonyms = dict(synonym_pairs(df))
+    matches = matcher_pairs(df)
+
+    values = sorted(set(synonyms.values()) | {v for _, v in matches})
+    value_ids = {v: i for i, v in enumerate(values)}
+    keys = sorted(synonyms, key=lambda k: k.encode("utf-8"))
+
+    sections = []
+    key_offsets, key_blob = _string_table(keys)
+    sections += [("syn_offsets", key_offsets), ("syn_values", np.array([value_ids[synonyms[k]] for k in keys], dtype=np.uint32)), ("syn_blob", key_blob)]
+    match_offsets, match_blob = _string_table([n for n, _ in matches])
+    sections += [("match_offsets", match_offsets), ("match_values", np.array([value_ids[v] for _, v in matches], dtype=np.uint32)), ("match_blob", match_blob)]
+    value_offsets, value_blob = _string_table(values)
+    sections += [("value_offsets", value_offsets), ("value_blob", value_blob)]
+
+    # Section positions are relative to the end of the header; every section is 8-bytes aligned
+    layout = {}
+    body = bytearray()
+    for name, data in sections:
+        raw = data.tobytes() if isinstance(data, np.ndarray) else data
+        body += b"\0" * (-len(body) % 8)
+        layout[name] = [len(body), len(raw)]
+        body += raw
+
+    header = {"version": INDEX_VERSION, "synonyms": len(keys), "matches": len(matches), "values": len(values), "sections": layout}
+    header.update(_source_signature(csv_path))
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-(len(header_bytes) + 8) % 8)
+
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack("<I", len(header_bytes)))
+        f.write(header_bytes)
+        f.write(body)
+    # Atomic replacement: running processes keep the old mapping until they reload
+    os.replace(tmp_path, index_path)
+    print(f"Synonym index {index_path} built with {len(keys)} synonyms in {time.time() - start_time:.2f} seconds")
+    return index_path
+
+# Read-only, memory-mapped view of the compiled synonyms index. The pages are shared by all the processes mapping the same file
+class SynonymIndex:
+    def __init__(self, index_path: str):
+        """
+        Map the index file.
+
+        Parameters:
+        - index_path: path of the index built by build_synonym_index.
+        """
+        self.index_path = index_path
+        with open(index_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:4] != INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a synonym index")
+        header_len = struct.unpack("<I", self._mm[4:8])[0]
+        self.header = json.loads(bytes(self._mm[8:8 + header_len]))
+        if self.header.get("version") != INDEX_VERSION:
+            raise ValueError(f"Unsupported synonym index version {self.header.get('version')}")
+        self._base = 8 + header_len
+
+        self._syn_offsets = self._array("syn_offsets", np.uint64)
+        self._syn_values = self._array("syn_values", np.uint32)
+        self._match_offsets = self._array("match_offsets", np.uint64)
+        self._match_values = self._array("match_values", np.uint32)
+        self._value_offsets = self._array("value_offsets", np.uint64)
+        self._syn_blob = self._section("syn_blob")
+        self._match_blob = self._section("match_blob")
+        self._value_blob = self._section("value_blob")
+        self._keys = _Strings(self._mm, self._syn_blob, self._syn_offsets)
+
+    def _section(self, name: str) -> Tuple[int, int]:
+        start, length = self.header["sections"][name]
+        return self._base + start, length
+
+    def _array(self, name: str, dtype) -> np.ndarray:
+        start, length = self._section(name)
+        return np.frombuffer(self._mm, dtype=dtype, count=length // np.dtype(dtype).itemsize, offset=start)
+
+    def _string(self, blob: Tuple[int, int], offsets: np.ndarray, i: int) -> bytes:
+        return self._mm[blob[0] + int(offsets[i]):blob[0] + int(offsets[i + 1])]
+
+    def _value(self, i: int) -> str:
+        return self._string(self._value_blob, self._value_offsets, int(i)).decode("utf-8")
+
+    def is_fresh(self, csv_path: str) -> bool:
+        """
+        Return True if the index was built from the current version of the csv file.
+        """
+        try:
+            signature = _source_signature(csv_path)
+        except OSError:
+            return True
+        return all(self.header.get(k) == v for k, v in signature.items())
+
+    def get(self, synonym: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        Return the English name of the synonym (binary search over the sorted synonyms), or default.
+        """
+        if not isinstance(synonym, str):
+            return default
+        key = synonym.encode("utf-8")
+        i = bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return self._value(self._syn_values[i])
+        return default
+
+    def __contains__(self, synonym) -> bool:
+        return self.get(synonym) is not None
+
+    def __len__(self) -> int:
+        return self.header["synonyms"]
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        for i in range(len(self)):
+            yield self._keys[i].decode("utf-8"), self._value(self._syn_values[i])
+
+    def matcher_items(self) -> Iterator[Tuple[str, str]]:
+        """
+        Return the (name, English name) pairs of the local matcher.
+        """
+        for i in range(self.header["matches"]):
+            yield self._string(self._match_blob, self._match_offsets, i).decode("utf-8"), self._value(self._match_values[i])
+
+# Sequence of the strings of a blob, used for the binary search
+class _Strings:
+    def __init__(self, mm: mmap.mmap, blob: Tuple[int, int], offsets: np.ndarray):
+        self._mm = mm
+        self._start = blob[0]
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self._mm[self._start + int(self._offsets[i]):self._start + int(self._offsets[i + 1])]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the ingredient synonyms csv into a memory-mapped index")
+    parser.add_argument("csv", nargs="?", default="ingredients_synonyms.csv", help="path of the synonyms csv file")
+    parser.add_argument("-o", "--output", default=None, help="path of the index, by default the csv path with the .idx extension")
+    args = parser.parse_args()
+    build_synonym_index(args.csv, args.output)
@@ -32,48 +32,55 @@ def main():
     # List for the results 
     results = []
     
-    # URL of the HELIO service
-    url = "http://localhost:8000/api/allergy_check_enhanced"
+    # URL of the HELIO batch service
+    url = "http://localhost:8000/api/allergy_check_batch"
+    rows = [row for _, row in df.iterrows()]
     
-    # 2. Process each row
-    for index, row in tqdm(df.iterrows(), total=len(df), desc="Processing results..."):
-
-        
-        payload = {
+    # 2. Send all the rows in a single request, the service runs the checks concurrently
+    payload = {
+        "items": [{
             "patient_id": row['patient_id'],
             "drug_code": row['drug_code'],
             "clinical_notes": row['clinical_note'],
             "store": False  
-        }
+        } for row in rows],
+        "concurrency": 8
+    }
+    
+    try:
+        response = requests.post(url, json=payload, stream=True)
+        if response.status_code != 200:
+            print(f"Error in batch request: {response.status_code}")
+            raise
         
-        try:
-            start_time = time.time()
-            response = requests.post(url, json=payload, stream=False)
-            end = time.time()
+        # The results arrive one per line as soon as they are ready
+        for line in tqdm(response.iter_lines(), total=len(rows), desc="Processing results..."):
+            if not line:
+                continue
+            item = json.loads(line)
+            row = rows[item['index']]
+            result_json = item['result']
             
-            if response.status_code == 200:
-                result_json = process_response(response)
+            if result_json:
+                # Add all the synthetic_patients dataset fields
+                result_row = row.to_dict()
                 
-                if result_json:
-                    # Add all the synthetic_patients dataset fields
-                    result_row = row.to_dict()
-                    
-                    # Add the result fields
-                    result_row['timing'] = end - start_time
-                    result_row['response'] = result_json.get('a', '')
-                    result_row['classification_resp'] = result_json.get('r', '')
-                    result_row['reaction_resp'] = result_json.get('rt', '')
+                # Add the result fields
+                result_row['timing'] = item['timing']
+                result_row['queue_wait'] = item['queue_wait']
+                result_row['response'] = result_json.get('a', '')
+                result_row['classification_resp'] = result_json.get('r', '')
+                result_row['reaction_resp'] = result_json.get('rt', '')
 
-                    results.append(result_row)
+                results.append((item['index'], result_row))
             else:
-                print(f"Error in request for patient_id {row['patient_id']}: {response.status_code}")
-                raise
-                
-        except Exception as e:
-            print(f"Error for patient_id {row['patient_id']}: {str(e)}")
+                print(f"Error for patient_id {row['patient_id']}: {item['text']}")
+            
+    except Exception as e:
+        print(f"Error in batch request: {str(e)}")
     
-    # 3. Create a new DataFrame with results
-    results_df = pd.DataFrame(results)
+    # 3. Create a new DataFrame with results, in the order of the dataset
+    results_df = pd.DataFrame([result_row for _, result_row in sorted(results, key=lambda r: r[0])])
     
     # Save the Excel
     output_filename = 'results_full_synth.xlsx'
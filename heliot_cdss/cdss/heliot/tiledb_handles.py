@@ -0,0 +1,158 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict
+
+import tiledb
+
+# Default configuration of the shared TileDB context, tuned for many small lookups
+DEFAULT_CONFIG = {
+    # Memory budgets of the readers
+    "sm.mem.total_budget": str(1024 * 1024 * 1024),
+    "sm.memory_budget": str(256 * 1024 * 1024),
+    "sm.memory_budget_var": str(512 * 1024 * 1024),
+    # Thread pools used by TileDB for decompression and I/O
+    "sm.compute_concurrency_level": str(os.cpu_count() or 1),
+    "sm.io_concurrency_level": str(os.cpu_count() or 1),
+    # Initial size of the result buffers allocated by TileDB-Py for each attribute
+    "py.init_buffer_bytes": str(16 * 1024 * 1024),
+}
+
+# Keep the TileDB arrays open in read mode across requests, sharing a single configured tiledb.Ctx.
+# A handle is replaced by a fresh one when new fragments are found for its array, or when a read fails because its
+# fragments were consolidated and vacuumed by another handle or process
+class TileDBHandleManager:
+    def __init__(self, config: Dict = None, refresh_interval: float = 1.0):
+        """
+        Initialize the handle manager.
+
+        Parameters:
+        - config: TileDB configuration parameters overriding DEFAULT_CONFIG.
+        - refresh_interval: minimum number of seconds between two checks for new fragments of an array.
+        """
+        cfg = dict(DEFAULT_CONFIG)
+        if config:
+            cfg.update(config)
+        self.ctx = tiledb.Ctx(tiledb.Config(cfg))
+        self.refresh_interval = refresh_interval
+
+        # uri -> (array, fragments signature, time of the last check)
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def _fragments_signature(self, uri: str):
+        """
+        Return the number of fragments and the timestamp of the last one. It only lists the fragments, without loading the schema.
+        """
+        ranges = tiledb.array_fragments(uri, ctx=self.ctx).timestamp_range
+        return len(ranges), max((end for _, end in ranges), default=0)
+
+    def get(self, uri: str) -> tiledb.Array:
+        """
+        Return the open read handle of the array, opening or replacing it if needed.
+
+        Parameters:
+        - uri: the array uri.
+
+        Returns:
+        - The array opened in read mode.
+        """
+        now = time.monotonic()
+        entry = self._handles.get(uri)
+        if entry is not None and now - entry[2] < self.refresh_interval:
+            return entry[0]
+
+        with self._lock:
+            entry = self._handles.get(uri)
+            if entry is not None and now - entry[2] < self.refresh_interval:
+                return entry[0]
+
+            signature = self._fragments_signature(uri)
+            if entry is not None and entry[1] == signature:
+                self._handles[uri] = (entry[0], signature, now)
+                return entry[0]
+
+            # First open or new fragments: open a new handle. The old one is closed when the
+            # queries still using it release it
+            array = tiledb.open(uri, mode="r", ctx=self.ctx)
+            self._handles[uri] = (array, signature, now)
+            return array
+
+    def query(self, uri: str, fn: Callable[[tiledb.Array], Any]) -> Any:
+        """
+        Run a read on the shared handle of the array. If it fails with a TileDBError, e.g. because the fragments of the
+        handle were vacuumed, the handle is reopened and the read retried once.
+
+        Parameters:
+        - uri: the array uri.
+        - fn: the read, called with the array opened in read mode.
+
+        Returns:
+        - The result of fn.
+        """
+        try:
+            return fn(self.get(uri))
+        except tiledb.TileDBError:
+            self.drop(uri)
+            return fn(self.get(uri))
+
+    @contextmanager
+    def read(self, uri: str):
+        """
+        Context manager returning the shared read handle. Unlike tiledb.open, the handle stays open on exit.
+        If the body fails with a TileDBError the handle is dropped, so the next access reopens it.
+        """
+        try:
+            yield self.get(uri)
+        except tiledb.TileDBError:
+            self.drop(uri)
+            raise
+
+    @contextmanager
+    def write(self, uri: str, mode: str = "w"):
+        """
+        Context manager opening the array in write (or delete) mode with the shared context.
+        On exit the read handle of the array is refreshed at the next access.
+        """
+        try:
+            with tiledb.open(uri, mode=mode, ctx=self.ctx) as array:
+                yield array
+        finally:
+            self.invalidate(uri)
+
+    def invalidate(self, uri: str):
+        """
+        Force a check for new fragments at the next access to the array.
+        """
+        with self._lock:
+            entry = self._handles.get(uri)
+            if entry is not None:
+                self._handles[uri] = (entry[0], None, 0.0)
+
+    def drop(self, uri: str):
+        """
+        Drop the handle of the array, so the next access opens a new one. Used after a failed read and before a vacuum.
+        """
+        with self._lock:
+            self._handles.pop(uri, None)
+
+    def close_all(self):
+        """
+        Drop all the open handles.
+        """
+        with self._lock:
+            self._handles.clear()
+
+
+_handle_manager = None
+_handle_manager_lock = threading.Lock()
+
+# Return the process-wide handle manager, so that all the databases share the same tiledb.Ctx
+def get_handle_manager() -> TileDBHandleManager:
+    global _handle_manager
+    if _handle_manager is None:
+        with _handle_manager_lock:
+            if _handle_manager is None:
+                _handle_manager = TileDBHandleManager()
+    return _handle_manager
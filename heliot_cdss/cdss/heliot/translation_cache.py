@@ -0,0 +1,136 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Default location of the SQLite file: the data directory of the service (HELIOT_DATA_DIR, ~/.heliot by default),
+# so the cache is not created in the working directory
+def default_cache_path() -> str:
+    data_dir = os.environ.get("HELIOT_DATA_DIR", os.path.join(os.path.expanduser("~"), ".heliot"))
+    return os.path.join(data_dir, "translation_cache.sqlite")
+
+# Normalize the text to translate, so that equivalent inputs share the same cache entry
+def normalize_text(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+# Persistent cache of the translations made by the language model, keyed by normalized text and model.
+# The most recently used translations are kept in memory; all of them are stored in a SQLite file that survives restarts
+class TranslationCache:
+    def __init__(self, path: Optional[str] = "", max_size: int = 4096):
+        """
+        Initialize the cache.
+
+        Parameters:
+        - path: the SQLite file, default_cache_path() if empty. None keeps the cache in memory only.
+        - max_size: maximum number of translations kept in memory.
+        """
+        path = default_cache_path() if path == "" else path
+        self.path = path
+        self.max_size = max_size
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path:
+            try:
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute("CREATE TABLE IF NOT EXISTS translations ("
+                                   "model TEXT NOT NULL, text TEXT NOT NULL, translation TEXT NOT NULL, created_at REAL NOT NULL, "
+                                   "PRIMARY KEY (model, text))")
+                self._conn.commit()
+            except sqlite3.Error as e:
+                print(f"Unable to open the translation cache {path}: {e}")
+                self._conn = None
+
+    def get(self, text: str, model: str = "gpt-4o") -> Optional[str]:
+        """
+        Return the cached translation of the text or None.
+
+        Parameters:
+        - text: the text to translate.
+        - model: the model used for the translation.
+        """
+        key = (model, normalize_text(text))
+        with self._lock:
+            translation = self._memory.get(key)
+            if translation is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return translation
+
+            if self._conn is not None:
+                try:
+                    row = self._conn.execute("SELECT translation FROM translations WHERE model = ? AND text = ?", key).fetchone()
+                except sqlite3.Error as e:
+                    print(f"Error reading the translation cache: {e}")
+                    row = None
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, translation: str, model: str = "gpt-4o"):
+        """
+        Store the translation of the text. Failed translations (None or empty) are not cached.
+
+        Parameters:
+        - text: the translated text.
+        - translation: its translation.
+        - model: the model used for the translation.
+        """
+        if not translation:
+            return
+        key = (model, normalize_text(text))
+        with self._lock:
+            self._remember(key, translation)
+            if self._conn is not None:
+                try:
+                    self._conn.execute("INSERT OR REPLACE INTO translations (model, text, translation, created_at) VALUES (?, ?, ?, ?)",
+                                       (key[0], key[1], translation, time.time()))
+                    self._conn.commit()
+                except sqlite3.Error as e:
+                    print(f"Error writing the translation cache: {e}")
+
+    def _remember(self, key, translation: str):
+        """
+        Add the translation to the in-memory LRU. The lock must be held.
+        """
+        self._memory[key] = translation
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def stats(self) -> Dict:
+        """
+        Return the cache counters.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._memory),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import tiledb
+
+from cdss.heliot.tiledb_handles import TileDBHandleManager
+
+
+@pytest.fixture
+def notes_uri(tmp_path):
+    uri = str(tmp_path / "notes")
+    schema = tiledb.ArraySchema(
+        domain=tiledb.Domain(tiledb.Dim(name="patient_id", dtype="ascii")),
+        attrs=[tiledb.Attr(name="clinical_notes", dtype=str)],
+        sparse=True,
+    )
+    tiledb.Array.create(uri, schema)
+    # Two fragments, so that consolidation and vacuum remove the files of both
+    for patient_id, notes in (("p1", "allergia a amoxicillina"), ("p2", "nessuna allergia nota")):
+        with tiledb.open(uri, mode="w") as array:
+            array[np.array([patient_id], dtype=object)] = {"clinical_notes": np.array([notes], dtype=object)}
+    return uri
+
+
+def read_notes(array):
+    return array.query(attrs=["clinical_notes"]).df[:].set_index("patient_id")["clinical_notes"].to_dict()
+
+
+def test_read_after_vacuum_from_another_handle(notes_uri):
+    handles = TileDBHandleManager(refresh_interval=3600)
+    expected = {"p1": "allergia a amoxicillina", "p2": "nessuna allergia nota"}
+    assert handles.query(notes_uri, read_notes) == expected
+    stale = handles.get(notes_uri)
+
+    # Another process consolidates and vacuums the array with its own context, while the handle is cached
+    ctx = tiledb.Ctx()
+    tiledb.consolidate(notes_uri, ctx=ctx)
+    tiledb.vacuum(notes_uri, ctx=ctx)
+
+    with pytest.raises(tiledb.TileDBError):
+        read_notes(stale)
+    assert handles.query(notes_uri, read_notes) == expected
+    assert handles.get(notes_uri) is not stale
+
+
+def test_read_drops_the_handle_after_a_failure(notes_uri):
+    handles = TileDBHandleManager(refresh_interval=3600)
+    stale = handles.get(notes_uri)
+    tiledb.consolidate(notes_uri)
+    tiledb.vacuum(notes_uri)
+
+    with pytest.raises(tiledb.TileDBError):
+        with handles.read(notes_uri) as array:
+            read_notes(array)
+    with handles.read(notes_uri) as array:
+        assert array is not stale
+        assert set(read_notes(array)) == {"p1", "p2"}
@@ -27,8 +27,10 @@ class MalformedURLException(Exception):
 
 # Leaflet Data Preprocessing 
 class LeafletInfoPreProcessor:
-    def __init__(self, model ="gpt-4o", dataset_name="drugs_subset.xlsx", path="./documents", dictionary_name="ingredients_synonyms.csv"):
+    def __init__(self, model ="gpt-4o", dataset_name="drugs_subset.xlsx", path="./documents", dictionary_name="ingredients_synonyms.csv", translation_cache=None):
         self.model = model
+        # Optional translation cache shared with the CDSS, any object with get(text, model) and put(text, translation, model)
+        self.translation_cache = translation_cache
         #Load the dataset
         self.dataset_name = dataset_name
         #self.df = pd.read_excel(dataset_name,dtype=str)
@@ -415,6 +417,10 @@ class LeafletInfoPreProcessor:
 
     # Translate the text in English
     def _translate_in_english(self, text) -> str:
+        if self.translation_cache is not None:
+            cached = self.translation_cache.get(text, self.model)
+            if cached is not None:
+                return cached
         try:
             response = client.chat.completions.create(model=self.model,
                                     messages=[{"role": "system", "content": ""},
@@ -422,6 +428,8 @@ class LeafletInfoPreProcessor:
                                     max_tokens=3000,
                                     temperature = 0)
             cleaned_text = response.choices[0].message.content
+            if self.translation_cache is not None:
+                self.translation_cache.put(text, cleaned_text, self.model)
             return cleaned_text
         except Exception as e:
             print(f"Failed to process text with GPT-4 _translate_in_english: {e}")
@@ -598,7 +606,7 @@ class LeafletInfoPreProcessor:
                 "excipients": leaflet.PharmaInfo["excipients"],
                 "therapeutic_indications": leaflet.clinicalInfo["therapeutic_indications"],
                 "posology": leaflet.clinicalInfo["posology"],
-                "cross_reactivity": str(leaflet.cross_reaction),
+                "cross_reactivity": json.dumps(leaflet.cross_reaction, ensure_ascii=False),
                 "contraindications": leaflet.clinicalInfo["contraindications"],
                 "special_warnings": leaflet.clinicalInfo["special_warnings"],
                 "drug_interactions": leaflet.clinicalInfo["drug_interactions"],